@@ -14,6 +14,7 @@ import wave
 import io
 from queue import Queue, Empty
 from threading import Thread
+from tts_engine import TTSEngine
 
 # ---------- 淡入淡出 ----------
 def fade_in_out(audio: np.ndarray, sr: int, fade_duration: float = 0.01) -> np.ndarray:
@@ -40,14 +41,19 @@ for p in [COSYVOICE_ROOT, MATCHA_TTS_PATH]:
 # ---------------------------------
 
 
-class CosyvoiceRealTimeTTS:
-    def __init__(self, model_path: str, reference_audio_path: str = None, max_queue: int = 10):
+class CosyvoiceRealTimeTTS(TTSEngine):
+    name = "cosyvoice"
+
+    def __init__(self, model_path: str, reference_audio_path: str = None, max_queue: int = 10, mmap_weights: bool = False,
+                 thread_budget=None):
         # 延迟导入 CosyVoice2
         from cosyvoice.cli.cosyvoice import CosyVoice2
         from cosyvoice.utils.file_utils import load_wav
         
         print("加载模型中...")
-        self.cosyvoice = CosyVoice2(model_path, load_jit=False, load_trt=False, fp16=True)
+        # mmap_weights：CPU 上多进程共享同一份只读权重（页缓存）
+        self.cosyvoice = CosyVoice2(model_path, load_jit=False, load_trt=False, fp16=True, mmap_weights=mmap_weights,
+                                    thread_budget=thread_budget)
         self.load_wav_func = load_wav
         self.sample_rate = self.cosyvoice.sample_rate
         self.ref_wav = None
@@ -143,6 +149,42 @@ class CosyvoiceRealTimeTTS:
         self.total_audio_dur = 0.0
         self.played_dur = 0.0
 
+    # ------------ 单段合成（引擎接口） ------------
+    def synthesize(self, seg: str, use_clone=True, **kwargs) -> np.ndarray:
+        if use_clone and self.ref_wav is None:
+            use_clone = False
+        results = None
+        try:
+            # 1）生成
+            if use_clone and self._prompt_semantic is not None:
+                results = self.cosyvoice.inference(
+                    seg, prompt_semantic=self._prompt_semantic,
+                    spk_emb=self._spk_emb, stream=False)
+            else:
+                results = self.cosyvoice.inference_zero_shot(
+                    seg, self.sample_text, self.ref_wav, stream=False)
+
+            # ✅ 关键：生成器→列表，防止二次next抛StopIteration
+            results = list(results)
+
+            # 2）缓存音色（第一次）
+            if use_clone and self._prompt_semantic is None:
+                first = results[0]
+                self._prompt_semantic = first.get("prompt_semantic")
+                self._spk_emb = first.get("spk_emb")
+
+            # 3）拿音频
+            audio_result = results[0]
+            audio = audio_result['tts_speech'].squeeze().cpu().numpy().astype(np.float32)
+            if np.max(np.abs(audio)) > 0:
+                audio /= np.max(np.abs(audio))
+            return fade_in_out(audio, self.sample_rate, self.fade_dur)
+        finally:
+            if results is not None:
+                del results
+            gc.collect()
+            torch.cuda.empty_cache()
+
     # ------------ 合成线程（StopIteration 已修复） ------------
     def _synthesis_worker(self, segments, use_clone):
         for idx, seg in enumerate(segments, 1):
@@ -151,32 +193,8 @@ class CosyvoiceRealTimeTTS:
                 print(f"【跳过】段 {idx} 无有效文字")
                 continue
 
-            results = None
             try:
-                # 1）生成
-                if use_clone and self._prompt_semantic is not None:
-                    results = self.cosyvoice.inference(
-                        seg, prompt_semantic=self._prompt_semantic,
-                        spk_emb=self._spk_emb, stream=False)
-                else:
-                    results = self.cosyvoice.inference_zero_shot(
-                        seg, self.sample_text, self.ref_wav, stream=False)
-
-                # ✅ 关键：生成器→列表，防止二次next抛StopIteration
-                results = list(results)
-
-                # 2）缓存音色（第一次）
-                if use_clone and self._prompt_semantic is None:
-                    first = results[0]
-                    self._prompt_semantic = first.get("prompt_semantic")
-                    self._spk_emb = first.get("spk_emb")
-
-                # 3）拿音频
-                audio_result = results[0]
-                audio = audio_result['tts_speech'].squeeze().cpu().numpy().astype(np.float32)
-                if np.max(np.abs(audio)) > 0:
-                    audio /= np.max(np.abs(audio))
-                audio = fade_in_out(audio, self.sample_rate, self.fade_dur)
+                audio = self.synthesize(seg, use_clone)
                 stereo = np.stack([audio, audio], axis=-1)
 
                 # 4）入队 + 回收
@@ -189,12 +207,6 @@ class CosyvoiceRealTimeTTS:
                 print(f"【合成】段 {idx} 失败：{repr(e)}")
                 continue
 
-            finally:
-                if results is not None:
-                    del results
-                gc.collect()
-                torch.cuda.empty_cache()
-
         self.audio_queue.put(None)   # 结束哨兵
 
     # ------------ 对外接口 ------------
@@ -274,33 +286,9 @@ class CosyvoiceRealTimeTTS:
                     print(f"【跳过】段 {idx} 无有效文字")
                     continue
 
-                results = None
                 try:
-                    # 1）生成
-                    if use_clone and self._prompt_semantic is not None:
-                        results = self.cosyvoice.inference(
-                            seg, prompt_semantic=self._prompt_semantic,
-                            spk_emb=self._spk_emb, stream=False)
-                    else:
-                        results = self.cosyvoice.inference_zero_shot(
-                            seg, self.sample_text, self.ref_wav, stream=False)
-
-                    # ✅ 关键：生成器→列表，防止二次next抛StopIteration
-                    results = list(results)
-
-                    # 2）缓存音色（第一次）
-                    if use_clone and self._prompt_semantic is None:
-                        first = results[0]
-                        self._prompt_semantic = first.get("prompt_semantic")
-                        self._spk_emb = first.get("spk_emb")
-
-                    # 3）拿音频
-                    audio_result = results[0]
-                    audio = audio_result['tts_speech'].squeeze().cpu().numpy().astype(np.float32)
-                    if np.max(np.abs(audio)) > 0:
-                        audio /= np.max(np.abs(audio))
-                    audio = fade_in_out(audio, self.sample_rate, self.fade_dur)
-                    
+                    audio = self.synthesize(seg, use_clone)
+
                     # 转换为单声道
                     audio_segments.append(audio)
                     
@@ -311,12 +299,6 @@ class CosyvoiceRealTimeTTS:
                     print(f"【合成】段 {idx} 失败：{repr(e)}")
                     continue
 
-                finally:
-                    if results is not None:
-                        del results
-                    gc.collect()
-                    torch.cuda.empty_cache()
-
             if not audio_segments:
                 print("[提示] 没有生成任何音频")
                 return None
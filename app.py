@@ -5,11 +5,14 @@ import json
 import base64
 import io
 import threading
+from contextlib import nullcontext
 from vosk import Model, KaldiRecognizer
 import pyaudio
 from openai_infer import APIInfer
 from TTS import CosyvoiceRealTimeTTS
-from config import DEEPSEEK_API_KEY, BASE_URL, MODEL
+from tts_engine import MatchaOnnxEngine, TTSRouter, CosyvoiceWorkerPool
+from config import DEEPSEEK_API_KEY, BASE_URL, MODEL, MATCHA_ONNX_PATH, MATCHA_VOCODER_PATH, TTS_SLO, TTS_WORKERS, \
+    THREAD_BUDGET, THREAD_PIN
 
 app = Flask(__name__)
 CORS(app)
@@ -21,6 +24,15 @@ audio_stream = None
 pyaudio_instance = None
 api_infer = None
 tts_engine = None
+thread_budget = None
+
+# 线程预算：统一设置 torch / ONNX Runtime 线程数，并按角色绑核，避免并发时超额订阅
+def init_thread_budget():
+    global thread_budget
+    if THREAD_BUDGET:
+        from cosyvoice.utils.thread_budget import ThreadBudget
+        thread_budget = ThreadBudget.parse(THREAD_BUDGET, pin=THREAD_PIN)
+        print(f"线程预算：{thread_budget}")
 
 # 初始化Vosk模型
 def init_vosk():
@@ -55,19 +67,41 @@ def init_api_infer():
     except Exception as e:
         print(f"AI对话模块初始化失败：{e}")
 
-# 初始化TTS
+# 初始化TTS：先起轻量兜底引擎，CosyVoice2 在后台加载预热完再接入路由
 def init_tts():
     global tts_engine
-    model_path = r"Model\CosyVoice2-0.5B"
-    ref_audio = r"audio\zjj.wav"
+    fallback = None
     try:
-        if os.path.exists(model_path):
-            tts_engine = CosyvoiceRealTimeTTS(model_path, ref_audio)
-            print("TTS模块初始化成功")
-        else:
-            print(f"警告：TTS模型路径不存在：{model_path}")
+        if os.path.exists(MATCHA_ONNX_PATH):
+            fallback = MatchaOnnxEngine(MATCHA_ONNX_PATH, MATCHA_VOCODER_PATH)
+            print("Matcha兜底引擎初始化成功")
     except Exception as e:
-        print(f"TTS模块初始化失败：{e}")
+        print(f"Matcha兜底引擎初始化失败：{e}")
+    tts_engine = TTSRouter(primary=None, fallback=fallback, slo=TTS_SLO)
+
+    def load_cosyvoice():
+        model_path = r"Model\CosyVoice2-0.5B"
+        ref_audio = r"audio\zjj.wav"
+        try:
+            if os.path.exists(model_path) and TTS_WORKERS > 1:
+                # 多副本：子进程各自加载预热，就绪一个即可接流量
+                tts_engine.set_primary(CosyvoiceWorkerPool(model_path, ref_audio, num_workers=TTS_WORKERS))
+                print(f"TTS模块以 {TTS_WORKERS} 个副本启动中")
+            elif os.path.exists(model_path):
+                primary = CosyvoiceRealTimeTTS(model_path, ref_audio, thread_budget=thread_budget)
+                # 预热一次，避免首个请求承担冷启动
+                primary.generate_audio("启动完毕。")
+                tts_engine.set_primary(primary)
+                print("TTS模块初始化成功")
+            else:
+                print(f"警告：TTS模型路径不存在：{model_path}")
+        except Exception as e:
+            print(f"TTS模块初始化失败：{e}")
+
+    if fallback is None:
+        load_cosyvoice()
+    else:
+        threading.Thread(target=load_cosyvoice, daemon=True).start()
 
 @app.route('/')
 def index():
@@ -92,13 +126,14 @@ def recognize_audio():
         # 解码音频数据
         audio_bytes = base64.b64decode(audio_b64)
         
-        # 进行识别
-        if recognizer.AcceptWaveform(audio_bytes):
-            result = json.loads(recognizer.Result())
+        # 进行识别，只有识别本身绑定到 asr 核心，退出后请求线程恢复原来的核心
+        with thread_budget.enter('asr') if thread_budget is not None else nullcontext():
+            complete = recognizer.AcceptWaveform(audio_bytes)
+            result = json.loads(recognizer.Result() if complete else recognizer.PartialResult())
+        if complete:
             text = result.get('text', '')
             return jsonify({'text': text, 'status': 'complete'})
         else:
-            result = json.loads(recognizer.PartialResult())
             text = result.get('partial', '')
             return jsonify({'text': text, 'status': 'partial'})
             
@@ -145,7 +180,7 @@ def text_to_speech():
     """文本转语音接口 - 生成音频并返回给前端"""
     global tts_engine
     
-    if not tts_engine:
+    if not tts_engine or not tts_engine.ready:
         return jsonify({'error': 'TTS模块未初始化'}), 500
     
     try:
@@ -192,6 +227,7 @@ def clear_history():
 
 # 初始化所有模块
 def init_all():
+    init_thread_budget()
     init_vosk()
     init_api_infer()
     init_tts()
@@ -9,4 +9,16 @@ DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
 #获取基础URL
 BASE_URL = os.getenv('BASE_URL')
 #获取模型名称
-MODEL = os.getenv('MODEL')
\ No newline at end of file
+MODEL = os.getenv('MODEL')
+#Matcha ONNX 兜底引擎路径（matcha/onnx/export.py 导出），不存在则不启用兜底
+MATCHA_ONNX_PATH = os.getenv('MATCHA_ONNX_PATH', r"Model\matcha.onnx")
+#未内嵌声码器时的 vocoder onnx 路径
+MATCHA_VOCODER_PATH = os.getenv('MATCHA_VOCODER_PATH')
+#CosyVoice 预计排队时间超过该秒数时切到兜底引擎
+TTS_SLO = float(os.getenv('TTS_SLO', '2.0'))
+#CosyVoice2 副本进程数，>1 时启用多进程（CPU 上权重 mmap 共享）
+TTS_WORKERS = int(os.getenv('TTS_WORKERS', '1'))
+#线程预算，如 llm=4,flow=3,onnx=1,asr=1，为空时沿用各库默认线程数
+THREAD_BUDGET = os.getenv('THREAD_BUDGET', '')
+#为 1 时按线程预算把 LLM / flow / ASR 绑到互不重叠的核上（仅 Linux）
+THREAD_PIN = os.getenv('THREAD_PIN', '0') == '1'
@@ -16,6 +16,7 @@
 import os
 import argparse
 import glob
+from contextlib import ExitStack
 
 import yaml
 import torch
@@ -40,6 +41,38 @@ def get_args():
     return args
 
 
+def checkpoint_path(src_path, name):
+    """ save_model writes .pt or, with --save_format safetensors, .safetensors """
+    path = '{}/{}.pt'.format(src_path, name)
+    return path if os.path.exists(path) else '{}/{}.safetensors'.format(src_path, name)
+
+
+class MappedCheckpoint:
+    """ Tensor by tensor access to a checkpoint without reading it all into memory """
+
+    def __init__(self, path):
+        self.path = path
+        self.safe = None
+        self.states = None
+
+    def __enter__(self):
+        if self.path.endswith('.safetensors'):
+            from safetensors import safe_open
+            self.safe = safe_open(self.path, framework='pt', device='cpu')
+        else:
+            self.states = torch.load(self.path, map_location='cpu', mmap=True)
+        return self
+
+    def __exit__(self, *args):
+        self.safe, self.states = None, None
+
+    def keys(self):
+        return list(self.safe.keys()) if self.safe is not None else list(self.states.keys())
+
+    def get_tensor(self, k):
+        return self.safe.get_tensor(k) if self.safe is not None else self.states[k]
+
+
 def main():
     args = get_args()
     val_scores = []
@@ -64,29 +97,30 @@ def main():
         print("best val (epoch, step, loss, tag) = " +
               str(sorted_val_scores[:args.num]))
         path_list = [
-            args.src_path + '/epoch_{}_whole.pt'.format(score[0])
+            checkpoint_path(args.src_path, 'epoch_{}_whole'.format(score[0]))
             for score in sorted_val_scores[:args.num]
         ]
     print(path_list)
-    avg = {}
     num = args.num
     assert num == len(path_list)
-    for path in path_list:
-        print('Processing {}'.format(path))
-        states = torch.load(path, map_location=torch.device('cpu'))
-        for k in states.keys():
-            if k not in ['step', 'epoch']:
-                if k not in avg.keys():
-                    avg[k] = states[k].clone()
-                else:
-                    avg[k] += states[k]
-    # average
-    for k in avg.keys():
-        if avg[k] is not None:
+    avg = {}
+    with ExitStack() as stack:
+        # NOTE checkpoints are memory mapped, only the averaged state dict is held in memory
+        states = [stack.enter_context(MappedCheckpoint(path)) for path in path_list]
+        keys = [k for k in states[0].keys() if k not in ['step', 'epoch']]
+        for k in keys:
+            total = None
+            for state in states:
+                tensor = state.get_tensor(k)
+                total = tensor.clone() if total is None else total.add_(tensor)
             # pytorch 1.6 use true_divide instead of /=
-            avg[k] = torch.true_divide(avg[k], num)
+            avg[k] = torch.true_divide(total, num)
     print('Saving to {}'.format(args.dst_model))
-    torch.save(avg, args.dst_model)
+    if args.dst_model.endswith('.safetensors'):
+        from safetensors.torch import save_file
+        save_file({k: v.contiguous() for k, v in avg.items()}, args.dst_model)
+    else:
+        torch.save(avg, args.dst_model)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,1068 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+from cosyvoice.cli.model import QualityController
+from cosyvoice.transformer.attention import MultiHeadedAttention, RelPositionMultiHeadedAttention, set_sdpa
+from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding
+from cosyvoice.transformer.encoder import TransformerEncoder
+from cosyvoice.utils.common import fade_in_out, to_host, DeviceTokenBuffer, mask_to_bias
+from cosyvoice.utils.frontend_utils import split_paragraph
+from cosyvoice.utils.mask import add_optional_chunk_mask, make_pad_mask
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='micro benchmarks of inference hot paths')
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    stream_overhead = subparsers.add_parser('stream_overhead', help='per hop overhead of streaming token2wav outside model compute')
+    stream_overhead.add_argument('--num_hops', type=int, default=40, help='number of streaming hops per session')
+    stream_overhead.add_argument('--token_hop_len', type=int, default=25, help='tokens per hop')
+    stream_overhead.add_argument('--num_sessions', type=int, default=20, help='number of sessions to average over')
+    attention = subparsers.add_parser('attention', help='parity and timing of manual attention against sdpa')
+    attention.add_argument('--batch_size', type=int, default=4, help='batch size')
+    attention.add_argument('--max_len', type=int, default=500, help='max sequence length, sequences are padded to it')
+    attention.add_argument('--n_head', type=int, default=8, help='number of heads')
+    attention.add_argument('--n_feat', type=int, default=512, help='attention dim')
+    attention.add_argument('--chunk_size', type=int, default=25, help='static chunk size of the chunk mask')
+    attention.add_argument('--num_runs', type=int, default=20, help='number of timed runs')
+    attention.add_argument('--tolerance', type=float, default=1e-4, help='max allowed abs diff')
+    llm_decode = subparsers.add_parser('llm_decode', help='tokens/s of conformer llm decoding, concat cache against inplace cache')
+    llm_decode.add_argument('--prompt_len', type=int, default=200, help='prompt length fed in the first step')
+    llm_decode.add_argument('--num_tokens', type=int, default=500, help='number of decoded tokens')
+    llm_decode.add_argument('--output_size', type=int, default=1024, help='llm hidden size')
+    llm_decode.add_argument('--attention_heads', type=int, default=16, help='number of heads')
+    llm_decode.add_argument('--linear_units', type=int, default=4096, help='feed forward size')
+    llm_decode.add_argument('--num_blocks', type=int, default=14, help='number of layers')
+    quality = subparsers.add_parser('quality', help='drive the quality controller with a synthetic load generator')
+    quality.add_argument('--phases', type=str, default='0.5:60,4:60,0.5:60', help='comma separated rate:duration phases, requests per second and seconds')
+    quality.add_argument('--audio_len', type=float, default=6.0, help='seconds of speech per request')
+    quality.add_argument('--base_rtf', type=float, default=0.3, help='rtf of a single request at full quality on an idle server')
+    quality.add_argument('--hop_overhead', type=float, default=0.02, help='fixed seconds per hop, amortized by larger hops')
+    quality.add_argument('--disable', action='store_true', help='keep full quality for comparison')
+    quality.add_argument('--seed', type=int, default=0, help='random seed of arrivals')
+    text_frontend = subparsers.add_parser('text_frontend', help='text normalization, paragraph split and tokenization of long llm replies')
+    text_frontend.add_argument('--model_dir', type=str, required=True, help='local CosyVoice2 model dir')
+    text_frontend.add_argument('--num_sentences', type=int, default=200, help='sentences per reply')
+    text_frontend.add_argument('--num_runs', type=int, default=5, help='number of timed runs')
+    thread_budget = subparsers.add_parser('thread_budget', help='sweep the llm/flow thread split for a given core count')
+    thread_budget.add_argument('--model_dir', type=str, required=True, help='local CosyVoice2 model dir')
+    thread_budget.add_argument('--prompt_wav', type=str, required=True, help='zero shot prompt wav')
+    thread_budget.add_argument('--prompt_text', type=str, required=True, help='transcript of prompt wav')
+    thread_budget.add_argument('--text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐。')
+    thread_budget.add_argument('--num_cores', type=int, default=os.cpu_count(), help='cores shared by llm, flow and onnx')
+    thread_budget.add_argument('--onnx', type=int, default=1, help='threads of frontend onnx sessions')
+    thread_budget.add_argument('--concurrency', type=int, default=2, help='concurrent requests')
+    thread_budget.add_argument('--num_requests', type=int, default=8, help='requests per split')
+    thread_budget.add_argument('--pin', action='store_true', help='pin every role to its own cores')
+    import_cost = subparsers.add_parser('import_cost', help='import time and rss of the inference entry, eager legacy imports against lazy')
+    import_cost.add_argument('--model_dir', type=str, default='', help='optional local CosyVoice2 model dir, also measure frontend construction')
+    import_cost.add_argument('--num_runs', type=int, default=3, help='fresh interpreters per case')
+    parquet = subparsers.add_parser('parquet', help='samples/s of parquet_opener on synthetic shards, pandas rows against arrow columns')
+    parquet.add_argument('--num_shards', type=int, default=4, help='number of shards')
+    parquet.add_argument('--shard_size', type=int, default=1000, help='utterances per shard')
+    parquet.add_argument('--audio_seconds', type=float, default=5.0, help='seconds of 16bit 24k audio bytes per utterance')
+    dataloader = subparsers.add_parser('dataloader', help='batches/s of the llm training pipeline, decode first filter against metadata first and audio free')
+    dataloader.add_argument('--num_shards', type=int, default=2, help='number of shards')
+    dataloader.add_argument('--shard_size', type=int, default=200, help='utterances per shard')
+    dataloader.add_argument('--drop_ratio', type=float, default=0.3, help='ratio of utterances longer than the filter max_length')
+    features = subparsers.add_parser('features', help='samples/s of on the fly fbank and f0 against precomputed memory mapped feature shards')
+    features.add_argument('--num_shards', type=int, default=2, help='number of shards')
+    features.add_argument('--shard_size', type=int, default=50, help='utterances per shard')
+    features.add_argument('--num_workers', type=int, default=2, help='extraction processes')
+    enroll = subparsers.add_parser('enroll', help='speakers/s of serial frontend_zero_shot against batched enroll_batch')
+    enroll.add_argument('--model_dir', type=str, required=True, help='local CosyVoice2 model dir')
+    enroll.add_argument('--num_refs', type=int, default=64, help='number of synthetic references')
+    enroll.add_argument('--batch_sizes', type=str, default='1,4,16', help='speech tokenizer batch sizes')
+    enroll.add_argument('--num_workers', type=str, default='1,4', help='thread pool sizes')
+    spk_store = subparsers.add_parser('spk_store', help='startup, lookup and append cost of the speaker store against a monolithic spk2info.pt')
+    spk_store.add_argument('--num_spks', type=int, default=1000, help='number of synthetic speakers')
+    spk_store.add_argument('--cache_size', type=int, default=64, help='device resident profiles')
+    bucket = subparsers.add_parser('bucket', help='padding ratio of sort buffer + dynamic batch against length bucketed batch')
+    bucket.add_argument('--num_shards', type=int, default=20, help='number of synthetic shards')
+    bucket.add_argument('--shard_size', type=int, default=1000, help='utterances per shard')
+    bucket.add_argument('--max_frames_in_batch', type=int, default=2000, help='batch budget')
+    bucket.add_argument('--num_buckets', type=str, default='10,50,100', help='bucket counts to try')
+    packed_lm = subparsers.add_parser('packed_lm', help='tokens/s and peak memory of Qwen2LM training, loop padded against vectorized and packed')
+    packed_lm.add_argument('--batch_size', type=int, default=32, help='utterances per batch')
+    packed_lm.add_argument('--pack_len', type=int, default=1024, help='row length of packed batches')
+    packed_lm.add_argument('--hidden_size', type=int, default=256, help='hidden size of the tiny qwen2')
+    packed_lm.add_argument('--num_layers', type=int, default=4, help='layers of the tiny qwen2')
+    packed_lm.add_argument('--num_steps', type=int, default=10, help='timed training steps per setting')
+    hift_stream = subparsers.add_parser('hift_stream', help='parity, chunk boundary jumps and per chunk time of the hift stream session against mel cache + crossfade')
+    hift_stream.add_argument('--hift_ckpt', type=str, default='', help='optional CosyVoice2 hift.pt, random weights otherwise')
+    hift_stream.add_argument('--num_frames', type=int, default=500, help='mel frames of the synthetic utterance')
+    hift_stream.add_argument('--chunk_frames', type=int, default=50, help='mel frames per streaming chunk, token_hop_len * token_mel_ratio')
+    hift_stream.add_argument('--num_runs', type=int, default=3, help='number of timed runs')
+    distill = subparsers.add_parser('distill', help='cpu smoke test of few-step flow distillation on a tiny CausalMaskedDiffWithXvec')
+    distill.add_argument('--batch_size', type=int, default=2, help='utterances per batch')
+    distill.add_argument('--token_len', type=int, default=40, help='speech tokens per utterance')
+    distill.add_argument('--num_steps', type=int, default=3, help='distillation steps')
+    distill.add_argument('--teacher_timesteps', type=int, default=4, help='euler steps of the teacher trajectory')
+    distill.add_argument('--n_timesteps', type=int, default=2, help='student inference timesteps')
+    token2wav_batch = subparsers.add_parser('token2wav_batch', help='sessions/s of serial token2wav against batched token2wav at several concurrent streams')
+    token2wav_batch.add_argument('--model_dir', type=str, required=True, help='local CosyVoice2 model dir')
+    token2wav_batch.add_argument('--prompt_wav', type=str, required=True, help='zero shot prompt wav')
+    token2wav_batch.add_argument('--prompt_text', type=str, required=True, help='transcript of prompt wav')
+    token2wav_batch.add_argument('--num_tokens', type=int, default=200, help='speech tokens per session')
+    token2wav_batch.add_argument('--num_streams', type=str, default='1,4,8', help='concurrent streaming sessions to try')
+    token2wav_batch.add_argument('--batch_size', type=int, default=8, help='token2wav_batch_size of the batched worker')
+    token2wav_batch.add_argument('--num_rounds', type=int, default=2, help='rounds of concurrent sessions per setting')
+    token2wav_batch.add_argument('--tolerance', type=float, default=1e-2, help='max allowed abs diff of batched speech against serial')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def legacy_fade_in_out(fade_in_mel, fade_out_mel, window):
+    device = fade_in_mel.device
+    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+    mel_overlap_len = int(window.shape[0] / 2)
+    if fade_in_mel.device == torch.device('cpu'):
+        fade_in_mel = fade_in_mel.clone()
+    fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
+        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
+    return fade_in_mel.to(device)
+
+
+def legacy_split_paragraph(text, tokenize, lang, token_max_n=80, token_min_n=60, merge_len=20):
+    def calc_utt_length(_text):
+        return len(_text) if lang == 'zh' else len(tokenize(_text))
+    pounc = ['。', '？', '！', '；', '：', '、', '.', '?', '!', ';'] if lang == 'zh' else ['.', '?', '!', ';', ':']
+    utts, st = [], 0
+    for i, c in enumerate(text):
+        if c in pounc:
+            if len(text[st: i]) > 0:
+                utts.append(text[st: i] + c)
+            st = i + 1
+    final_utts, cur_utt = [], ''
+    for utt in utts:
+        if calc_utt_length(cur_utt + utt) > token_max_n and calc_utt_length(cur_utt) > token_min_n:
+            final_utts.append(cur_utt)
+            cur_utt = ''
+        cur_utt = cur_utt + utt
+    if len(cur_utt) > 0:
+        if calc_utt_length(cur_utt) < merge_len and len(final_utts) != 0:
+            final_utts[-1] = final_utts[-1] + cur_utt
+        else:
+            final_utts.append(cur_utt)
+    return final_utts
+
+
+def stream_overhead(args, device):
+    source_cache_len = 8 * 480
+    hop_speech_len = args.token_hop_len * 2 * 480
+    np_window = np.hamming(2 * source_cache_len)
+    device_window = torch.from_numpy(np_window).float().to(device)
+    tokens = np.random.randint(0, 6561, args.num_hops * args.token_hop_len + 3).tolist()
+    speech = torch.randn(1, hop_speech_len + source_cache_len, device=device)
+    cache_speech = torch.randn(1, source_cache_len, device=device)
+
+    def legacy_hop(token_buffer, n):
+        token = torch.tensor(tokens[:n]).unsqueeze(dim=0).to(device)
+        token_len = torch.tensor([token.shape[1]], dtype=torch.int32).to(device)
+        tts_speech = legacy_fade_in_out(speech, cache_speech, np_window)
+        return token, token_len, tts_speech[:, :-source_cache_len].cpu()
+
+    def device_hop(token_buffer, n):
+        token = token_buffer(tokens, n)
+        token_len = torch.full([1], token.shape[1], dtype=torch.int32, device=device)
+        tts_speech = fade_in_out(speech, cache_speech, device_window)
+        return token, token_len, to_host(tts_speech[:, :-source_cache_len])
+
+    for name, hop in [('legacy', legacy_hop), ('device', device_hop)]:
+        # warmup
+        hop(DeviceTokenBuffer(device), args.token_hop_len)
+        cost = []
+        for _ in range(args.num_sessions):
+            token_buffer = DeviceTokenBuffer(device)
+            for i in range(1, args.num_hops + 1):
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                hop(token_buffer, i * args.token_hop_len + 3)
+                cost.append(time.perf_counter() - start)
+        cost = np.array(cost) * 1000
+        logging.info('{} per hop overhead mean {:.3f}ms p50 {:.3f}ms p99 {:.3f}ms'.format(
+            name, cost.mean(), np.percentile(cost, 50), np.percentile(cost, 99)))
+
+
+def attention(args, device):
+    # NOTE run with CUDA_VISIBLE_DEVICES= for cpu timings
+    torch.manual_seed(0)
+    x = torch.randn(args.batch_size, args.max_len, args.n_feat, device=device)
+    x_len = torch.randint(args.max_len // 2, args.max_len + 1, (args.batch_size,), device=device)
+    x_len[0] = args.max_len
+    pad_mask = ~make_pad_mask(x_len, args.max_len).unsqueeze(1)  # (B, 1, T)
+    chunk_mask = add_optional_chunk_mask(x, pad_mask, False, False, 0, args.chunk_size, -1)  # (B, T, T)
+    pos_emb = EspnetRelPositionalEncoding(args.n_feat, 0.0).to(device)(x)[1]
+    cases = [('mha', MultiHeadedAttention(args.n_head, args.n_feat, 0.0), pad_mask),
+             ('mha_chunk', MultiHeadedAttention(args.n_head, args.n_feat, 0.0), chunk_mask),
+             ('rel_mha', RelPositionMultiHeadedAttention(args.n_head, args.n_feat, 0.0), pad_mask),
+             ('rel_mha_chunk', RelPositionMultiHeadedAttention(args.n_head, args.n_feat, 0.0), chunk_mask)]
+    try:
+        from diffusers.models.attention_processor import Attention
+        cases.append(('decoder_attn', Attention(args.n_feat, heads=args.n_head, dim_head=args.n_feat // args.n_head), chunk_mask))
+    except ImportError:
+        logging.warning('diffusers not installed, skip flow decoder attention')
+
+    def run(name, module, mask):
+        if name == 'decoder_attn':
+            return module(x, attention_mask=mask_to_bias(mask.bool(), x.dtype))
+        return module(x, x, x, mask, pos_emb)[0]
+
+    failed = False
+    for name, module, mask in cases:
+        module = module.to(device).eval()
+        if name != 'decoder_attn':
+            # NOTE export_jit scripts llm.llm and flow.encoder, both branches of forward must compile even with sdpa off
+            try:
+                torch.jit.script(module)
+            except Exception as ex:
+                failed = True
+                logging.error('{} torch.jit.script failed, ex info {}'.format(name, ex))
+        outputs = []
+        for enable in [False, True]:
+            set_sdpa(module, enable)
+            with torch.inference_mode():
+                run(name, module, mask)
+                cost = []
+                for _ in range(args.num_runs):
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize(device)
+                    start = time.perf_counter()
+                    output = run(name, module, mask)
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize(device)
+                    cost.append(time.perf_counter() - start)
+            outputs.append(output)
+            cost = np.array(cost) * 1000
+            logging.info('{} {} mean {:.3f}ms p50 {:.3f}ms'.format(name, 'sdpa' if enable else 'manual', cost.mean(), np.percentile(cost, 50)))
+        # padded query rows of decoder attention are garbage in both backends, only compare valid rows
+        valid = pad_mask.squeeze(1).unsqueeze(-1)
+        diff = ((outputs[0] - outputs[1]) * valid).abs().max().item()
+        failed |= diff > args.tolerance
+        logging.info('{} max abs diff {:.3e} {}'.format(name, diff, 'ok' if diff <= args.tolerance else 'MISMATCH'))
+    if failed:
+        sys.exit(1)
+
+
+def llm_decode(args, device):
+    # NOTE same structure as the CosyVoice-300M llm, weights are random
+    torch.manual_seed(0)
+    llm = TransformerEncoder(args.output_size, args.output_size, args.attention_heads, args.linear_units, args.num_blocks,
+                             dropout_rate=0.0, positional_dropout_rate=0.0, input_layer='linear_legacy',
+                             pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn',
+                             static_chunk_size=1).to(device).eval()
+    prompt = torch.randn(1, args.prompt_len, args.output_size, device=device)
+    steps = torch.randn(args.num_tokens, 1, 1, args.output_size, device=device)
+
+    def concat_decode():
+        outputs, offset = [], 0
+        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=device), torch.zeros((0, 0, 0, 0), device=device)
+        for i in range(args.num_tokens):
+            lm_input = prompt if i == 0 else steps[i]
+            y_pred, att_cache, cnn_cache = llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                             att_cache=att_cache, cnn_cache=cnn_cache,
+                                                             att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                            device=device)).to(torch.bool))
+            outputs.append(y_pred[:, -1])
+            offset += lm_input.size(1)
+        return torch.concat(outputs, dim=0)
+
+    def inplace_decode():
+        outputs, offset = [], 0
+        att_cache, cnn_cache = llm.init_inplace_cache(args.prompt_len + args.num_tokens, device)
+        for i in range(args.num_tokens):
+            lm_input = prompt if i == 0 else steps[i]
+            att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=device, dtype=torch.bool)) \
+                if i == 0 else torch.ones((0, 0, 0), device=device, dtype=torch.bool)
+            y_pred = llm.forward_chunk_inplace(lm_input, offset, att_cache, cnn_cache, att_mask)
+            outputs.append(y_pred[:, -1])
+            offset += lm_input.size(1)
+        return torch.concat(outputs, dim=0)
+
+    outputs = []
+    for name, decode in [('concat', concat_decode), ('inplace', inplace_decode)]:
+        with torch.inference_mode():
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            outputs.append(decode())
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            cost = time.perf_counter() - start
+        logging.info('{} decode {} tokens in {:.3f}s, {:.1f} tokens/s'.format(name, args.num_tokens, cost, args.num_tokens / cost))
+    logging.info('max abs diff {:.3e}'.format((outputs[0] - outputs[1]).abs().max().item()))
+
+
+def text_frontend(args, device):
+    from functools import partial
+    from cosyvoice.cli.frontend import CosyVoiceFrontEnd
+    from cosyvoice.tokenizer.tokenizer import get_qwen_tokenizer
+    frontend = CosyVoiceFrontEnd(partial(get_qwen_tokenizer, token_path='{}/CosyVoice-BlankEN'.format(args.model_dir), skip_special_tokens=True),
+                                 None,
+                                 '{}/campplus.onnx'.format(args.model_dir),
+                                 '{}/speech_tokenizer_v2.onnx'.format(args.model_dir))
+    replies = {'zh': '魔镜魔镜告诉我，今天的天气怎么样？今天是晴天，最高气温二十六度，适合出门散步。' * (args.num_sentences // 2),
+               'en': 'Mirror, mirror on the wall, what is the weather like today? It is sunny with a high of 26 degrees, perfect for a walk. ' *
+                     (args.num_sentences // 2)}
+
+    def timeit(fn):
+        start = time.perf_counter()
+        for _ in range(args.num_runs):
+            fn()
+        return (time.perf_counter() - start) / args.num_runs * 1000
+
+    tokenize = partial(frontend.tokenizer.encode, allowed_special=frontend.allowed_special)
+    for lang, reply in replies.items():
+        legacy = legacy_split_paragraph(reply, tokenize, lang)
+        incremental = split_paragraph(reply, tokenize, lang, batch_tokenize=frontend.encode_batch)
+        logging.info('{} split legacy {:.3f}ms incremental {:.3f}ms, {} vs {} segments'.format(
+            lang, timeit(lambda: legacy_split_paragraph(reply, tokenize, lang)),
+            timeit(lambda: split_paragraph(reply, tokenize, lang, batch_tokenize=frontend.encode_batch)), len(legacy), len(incremental)))
+        start = time.perf_counter()
+        texts = frontend.text_normalize(reply, split=True)
+        cold = (time.perf_counter() - start) * 1000
+        logging.info('{} text_normalize cold {:.3f}ms memoized {:.3f}ms'.format(lang, cold, timeit(lambda: frontend.text_normalize(reply, split=True))))
+        logging.info('{} encode {} segments one by one {:.3f}ms batched {:.3f}ms'.format(
+            lang, len(texts), timeit(lambda: [tokenize(i) for i in texts]), timeit(lambda: frontend.encode_batch(texts))))
+
+
+def thread_budget(args, device):
+    from concurrent.futures import ThreadPoolExecutor
+    from cosyvoice.cli.cosyvoice import CosyVoice2
+    from cosyvoice.utils.file_utils import load_wav
+    from cosyvoice.utils.thread_budget import ThreadBudget
+    cosyvoice = CosyVoice2(args.model_dir, thread_budget=ThreadBudget(onnx=args.onnx, asr=0, pin=args.pin))
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+
+    def request(_):
+        speech_len = 0
+        for i in cosyvoice.inference_zero_shot(args.text, args.prompt_text, prompt_speech_16k, stream=False):
+            speech_len += i['tts_speech'].shape[1] / cosyvoice.sample_rate
+        return speech_len
+
+    request(0)
+    results = []
+    for llm in range(1, args.num_cores - args.onnx):
+        cosyvoice.model.thread_budget = ThreadBudget(llm=llm, flow=args.num_cores - args.onnx - llm, onnx=args.onnx, asr=0, pin=args.pin)
+        cosyvoice.model.thread_budget.apply()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            speech_len = sum(executor.map(request, range(args.num_requests)))
+        cost = time.perf_counter() - start
+        results.append((speech_len / cost, llm))
+        logging.info('{}, {:.2f}s speech per second, rtf {:.3f}'.format(cosyvoice.model.thread_budget, speech_len / cost, cost / speech_len))
+    best = max(results)
+    logging.info('best split for {} cores: llm {} flow {} onnx {}, {:.2f}s speech per second'.format(
+        args.num_cores, best[1], args.num_cores - args.onnx - best[1], args.onnx, best[0]))
+
+
+IMPORT_COST_SCRIPT = '''
+import resource, sys, time
+sys.path.extend([{root!r}, {root!r} + '/third_party/Matcha-TTS'])
+start = time.perf_counter()
+{code}
+cost = time.perf_counter() - start
+# NOTE ru_maxrss is kB on linux
+print(cost, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+'''
+
+
+def import_cost(args, device):
+    import subprocess
+    root = '{}/../..'.format(ROOT_DIR)
+    frontend_code = '''
+from functools import partial
+from cosyvoice.cli.frontend import CosyVoiceFrontEnd
+from cosyvoice.tokenizer.tokenizer import get_qwen_tokenizer
+frontend = CosyVoiceFrontEnd(partial(get_qwen_tokenizer, token_path='{0}/CosyVoice-BlankEN', skip_special_tokens=True), None,
+                             '{0}/campplus.onnx', '{0}/speech_tokenizer_v2.onnx', '{0}/spk2info.pt')
+'''.format(args.model_dir)
+    cases = [('legacy eager imports', 'import whisper, inflect, onnxruntime, torchaudio, modelscope\nimport cosyvoice.cli.cosyvoice'),
+             ('cosyvoice.cli.cosyvoice', 'import cosyvoice.cli.cosyvoice')]
+    if args.model_dir != '':
+        cases.append(('frontend with cached spk2info', frontend_code))
+        cases.append(('frontend with onnx sessions', frontend_code + 'frontend.campplus_session, frontend.speech_tokenizer_session\n'))
+    for name, code in cases:
+        results = []
+        for _ in range(args.num_runs):
+            output = subprocess.run([sys.executable, '-c', IMPORT_COST_SCRIPT.format(root=root, code=code)],
+                                    capture_output=True, text=True, check=True).stdout
+            results.append([float(i) for i in output.strip().split('\n')[-1].split()])
+        results = np.array(results)
+        logging.info('{}: {:.3f}s, max rss {:.0f}MB'.format(name, results[:, 0].mean(), results[:, 1].mean()))
+
+
+def legacy_parquet_opener(data, mode='train'):
+    import pyarrow.parquet as pq
+    for sample in data:
+        for df in pq.ParquetFile(sample['src']).iter_batches(batch_size=64):
+            df = df.to_pandas()
+            for i in range(len(df)):
+                sample.update(dict(df.loc[i]))
+                yield {**sample}
+
+
+def parquet(args, device):
+    import tempfile
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from cosyvoice.dataset.processor import parquet_opener
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shards = []
+        for i in range(args.num_shards):
+            n, speech_token_len = args.shard_size, int(args.audio_seconds * 25)
+            table = pa.table({
+                'utt': ['utt_{}_{}'.format(i, j) for j in range(n)],
+                'wav': ['/data/wav/utt_{}_{}.wav'.format(i, j) for j in range(n)],
+                'audio_data': [rng.bytes(int(args.audio_seconds * 24000 * 2)) for _ in range(n)],
+                'text': ['synthetic text of utterance {}'.format(j) for j in range(n)],
+                'spk': ['spk_{}'.format(j % 10) for j in range(n)],
+                'utt_embedding': [rng.randn(192).astype(np.float32).tolist() for _ in range(n)],
+                'spk_embedding': [rng.randn(192).astype(np.float32).tolist() for _ in range(n)],
+                'speech_token': [rng.randint(0, 6561, speech_token_len).tolist() for _ in range(n)],
+            })
+            shards.append('{}/shard_{}.parquet'.format(tmp_dir, i))
+            pq.write_table(table, shards[-1])
+        cases = [('pandas rows', lambda: legacy_parquet_opener([{'src': i} for i in shards])),
+                 ('arrow columns', lambda: parquet_opener([{'src': i} for i in shards])),
+                 ('arrow columns llm projection', lambda: parquet_opener([{'src': i} for i in shards], columns='llm'))]
+        for name, opener in cases:
+            start = time.perf_counter()
+            num_samples = 0
+            for sample in opener():
+                # touch what the next processors read
+                len(sample['audio_data']), len(sample['speech_token']), sample['utt_embedding'][0]
+                num_samples += 1
+            cost = time.perf_counter() - start
+            logging.info('{}: {} samples in {:.3f}s, {:.0f} samples/s'.format(name, num_samples, cost, num_samples / cost))
+
+
+def legacy_filter(data, max_length=10240, min_length=10, token_max_length=200, token_min_length=1, mode='train'):
+    import io
+    import torchaudio
+    for sample in data:
+        sample['speech'], sample['sample_rate'] = torchaudio.load(io.BytesIO(sample['audio_data']))
+        sample['speech'] = sample['speech'].mean(dim=0, keepdim=True)
+        del sample['audio_data']
+        num_frames = sample['speech'].size(1) / sample['sample_rate'] * 100
+        if num_frames < min_length or num_frames > max_length:
+            continue
+        if len(sample['text_token']) < token_min_length or len(sample['text_token']) > token_max_length:
+            continue
+        yield sample
+
+
+def dataloader(args, device):
+    import io
+    import tempfile
+    from functools import partial
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import torchaudio
+    from cosyvoice.dataset import processor
+    from cosyvoice.dataset.dataset import Dataset
+
+    class CharTokenizer:
+        def encode(self, text, allowed_special='all'):
+            return [ord(i) for i in text]
+
+    rng = np.random.RandomState(0)
+    sample_rate, max_length = 24000, 1000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shards = []
+        for i in range(args.num_shards):
+            utts = []
+            for j in range(args.shard_size):
+                # NOTE long utterances exceed max_length and are dropped by filter
+                seconds = rng.uniform(12, 20) if rng.rand() < args.drop_ratio else rng.uniform(2, 8)
+                buffer = io.BytesIO()
+                torchaudio.save(buffer, torch.from_numpy(rng.randn(1, int(seconds * sample_rate)).astype(np.float32) * 0.1), sample_rate, format='wav')
+                utts.append({'utt': 'utt_{}_{}'.format(i, j), 'text': 'synthetic text of utterance {}'.format(j), 'duration': seconds,
+                             'audio_data': buffer.getvalue(), 'speech_token': rng.randint(0, 6561, int(seconds * 25)).tolist(),
+                             'utt_embedding': rng.randn(192).astype(np.float32).tolist(), 'spk_embedding': rng.randn(192).astype(np.float32).tolist()})
+            shards.append('{}/shard_{}.parquet'.format(tmp_dir, i))
+            pq.write_table(pa.Table.from_pylist(utts), shards[-1])
+        with open('{}/data.list'.format(tmp_dir), 'w') as f:
+            f.write('\n'.join(shards) + '\n')
+
+        feat_extractor = torchaudio.transforms.MelSpectrogram(sample_rate=sample_rate, n_fft=1920, hop_length=480, n_mels=80)
+
+        def pipeline(filter_func):
+            return [processor.parquet_opener,
+                    partial(processor.tokenize, get_tokenizer=CharTokenizer, allowed_special='all'),
+                    partial(filter_func, max_length=max_length),
+                    partial(processor.resample, resample_rate=sample_rate),
+                    partial(processor.compute_fbank, feat_extractor=lambda x: feat_extractor(x).clamp(min=1e-5).log(), token_mel_ratio=2),
+                    partial(processor.parse_embedding, normalize=True),
+                    partial(processor.shuffle, shuffle_size=1000),
+                    partial(processor.sort, sort_size=500),
+                    partial(processor.batch, batch_type='dynamic', max_frames_in_batch=2000),
+                    partial(processor.padding, use_spk_embedding=False)]
+
+        columns = [i for i in processor.PARQUET_COLUMNS['llm'] if i not in ['audio_data', 'duration']]
+        cases = [('decode first filter', pipeline(legacy_filter), 'llm', False),
+                 ('metadata first filter', pipeline(processor.filter), 'llm', False),
+                 ('audio free', pipeline(processor.filter), processor.PARQUET_COLUMNS['llm_audio_free'], True),
+                 ('audio free without duration', pipeline(processor.filter), columns, True)]
+        for name, data_pipeline, columns, audio_free in cases:
+            dataset = Dataset('{}/data.list'.format(tmp_dir), data_pipeline=data_pipeline, shuffle=False, partition=False,
+                              columns=columns, audio_free=audio_free)
+            start = time.perf_counter()
+            num_batches, num_samples = 0, 0
+            for batch in dataset:
+                num_batches += 1
+                num_samples += len(batch['utts'])
+            cost = time.perf_counter() - start
+            logging.info('{}: {} samples in {} batches, {:.3f}s, {:.0f} samples/s {:.1f} batches/s'.format(
+                name, num_samples, num_batches, cost, num_samples / cost, num_batches / cost))
+
+
+def features(args, device):
+    import io
+    import multiprocessing
+    import tempfile
+    from functools import partial
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import torchaudio
+    from cosyvoice.bin.extract_features import Extractor, _init_worker, _extract_shard
+    from cosyvoice.dataset import processor
+
+    class CharTokenizer:
+        def encode(self, text, allowed_special='all'):
+            return [ord(i) for i in text]
+
+    rng = np.random.RandomState(0)
+    sample_rate = 24000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shards = []
+        for i in range(args.num_shards):
+            utts = []
+            for j in range(args.shard_size):
+                seconds = rng.uniform(2, 8)
+                buffer = io.BytesIO()
+                torchaudio.save(buffer, torch.from_numpy(rng.randn(1, int(seconds * sample_rate)).astype(np.float32) * 0.1), sample_rate, format='wav')
+                utts.append({'utt': 'utt_{}_{}'.format(i, j), 'text': 'synthetic text of utterance {}'.format(j), 'audio_data': buffer.getvalue(),
+                             'speech_token': rng.randint(0, 6561, int(seconds * 25)).tolist(),
+                             'utt_embedding': rng.randn(192).astype(np.float32).tolist(), 'spk_embedding': rng.randn(192).astype(np.float32).tolist()})
+            shards.append('{}/shard_{}.parquet'.format(tmp_dir, i))
+            pq.write_table(pa.Table.from_pylist(utts), shards[-1])
+
+        resample_stage = partial(processor.resample, resample_rate=sample_rate)
+        fbank_stage = partial(processor.compute_fbank, feat_extractor=torchaudio.transforms.MelSpectrogram(
+            sample_rate=sample_rate, n_fft=1920, hop_length=480, n_mels=80), token_mel_ratio=2)
+        f0_stage = partial(processor.compute_f0, sample_rate=sample_rate, hop_size=480)
+        extractor = Extractor(resample_stage, fbank_stage, f0_stage, '')
+        feature_dir = '{}/features'.format(tmp_dir)
+        for name in ['extract', 'resume']:
+            start = time.perf_counter()
+            with multiprocessing.get_context('spawn').Pool(args.num_workers, initializer=_init_worker, initargs=(extractor,)) as pool:
+                status = [i[1] for i in pool.imap_unordered(_extract_shard, [(src, feature_dir, False) for src in shards])]
+            logging.info('{} {} shards with {} workers: {}, {:.3f}s'.format(name, len(shards), args.num_workers, status, time.perf_counter() - start))
+
+        def pipeline(feature_dir):
+            data = processor.parquet_opener([{'src': src} for src in shards])
+            if feature_dir is not None:
+                data = processor.load_features(data, feature_dir)
+            data = processor.tokenize(data, get_tokenizer=CharTokenizer, allowed_special='all')
+            data = processor.filter(data)
+            data = resample_stage(data)
+            data = fbank_stage(data)
+            return f0_stage(data)
+
+        for name, this_feature_dir in [('on the fly fbank and f0', None), ('precomputed feature shards', feature_dir)]:
+            start = time.perf_counter()
+            num_samples = 0
+            for sample in pipeline(this_feature_dir):
+                sample['speech_feat'].sum(), sample['pitch_feat'].sum()
+                num_samples += 1
+            cost = time.perf_counter() - start
+            logging.info('{}: {} samples in {:.3f}s, {:.1f} samples/s'.format(name, num_samples, cost, num_samples / cost))
+
+
+def enroll(args, device):
+    from cosyvoice.bin.enroll import load_frontend
+    frontend, sample_rate = load_frontend(args.model_dir)
+    rng = np.random.RandomState(0)
+    speeches = [torch.from_numpy(rng.randn(1, int(rng.uniform(3, 10) * 16000)).astype(np.float32) * 0.1) for _ in range(args.num_refs)]
+    texts = ['synthetic prompt text {}'.format(i) for i in range(args.num_refs)]
+    # NOTE warm up lazy onnx sessions
+    frontend.frontend_zero_shot('', texts[0], speeches[0], sample_rate, '')
+    start = time.perf_counter()
+    serial = [frontend.frontend_zero_shot('', text, speech, sample_rate, '') for text, speech in zip(texts, speeches)]
+    cost = time.perf_counter() - start
+    logging.info('serial frontend_zero_shot: {} refs in {:.3f}s, {:.1f} refs/s'.format(args.num_refs, cost, args.num_refs / cost))
+    for num_workers in [int(i) for i in args.num_workers.split(',')]:
+        for batch_size in [int(i) for i in args.batch_sizes.split(',')]:
+            start = time.perf_counter()
+            batch = frontend.enroll_batch(texts, speeches, sample_rate, batch_size=batch_size, num_workers=num_workers)
+            cost = time.perf_counter() - start
+            same = np.mean([torch.equal(i['flow_prompt_speech_token'], j['flow_prompt_speech_token']) for i, j in zip(serial, batch)])
+            diff = max((i['flow_embedding'] - j['flow_embedding']).abs().max().item() for i, j in zip(serial, batch))
+            logging.info('enroll_batch batch {} workers {}: {:.3f}s, {:.1f} refs/s, identical tokens {:.2f}, max embedding diff {:.2e}'.format(
+                batch_size, num_workers, cost, args.num_refs / cost, same, diff))
+
+
+def spk_store(args, device):
+    import tempfile
+    from cosyvoice.utils.spk_store import SpeakerStore
+
+    def profile():
+        # NOTE shapes of a 10s cosyvoice2 zero shot prompt
+        return {'prompt_text': torch.randint(0, 6000, (1, 30)), 'prompt_text_len': torch.tensor([30]),
+                'llm_prompt_speech_token': torch.randint(0, 6561, (1, 250)), 'llm_prompt_speech_token_len': torch.tensor([250]),
+                'flow_prompt_speech_token': torch.randint(0, 6561, (1, 250)), 'flow_prompt_speech_token_len': torch.tensor([250]),
+                'prompt_speech_feat': torch.randn(1, 500, 80), 'prompt_speech_feat_len': torch.tensor([500]),
+                'llm_embedding': torch.randn(1, 192), 'flow_embedding': torch.randn(1, 192)}
+
+    spk2info = {'spk_{}'.format(i): profile() for i in range(args.num_spks)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        torch.save(spk2info, '{}/spk2info.pt'.format(tmp_dir))
+        logging.info('legacy save of {} speakers: {:.3f}s'.format(args.num_spks, time.perf_counter() - start))
+        start = time.perf_counter()
+        torch.load('{}/spk2info.pt'.format(tmp_dir), map_location=device)
+        logging.info('legacy startup load: {:.3f}s'.format(time.perf_counter() - start))
+        start = time.perf_counter()
+        SpeakerStore('{}/spk_store'.format(tmp_dir), legacy_spk2info='{}/spk2info.pt'.format(tmp_dir))
+        logging.info('one time import into store: {:.3f}s'.format(time.perf_counter() - start))
+        start = time.perf_counter()
+        store = SpeakerStore('{}/spk_store'.format(tmp_dir), device=device, cache_size=args.cache_size)
+        logging.info('store startup: {:.3f}s'.format(time.perf_counter() - start))
+        for name, spk_ids in [('cold', list(spk2info.keys())[:args.cache_size]), ('warm', list(spk2info.keys())[:args.cache_size])]:
+            start = time.perf_counter()
+            for spk_id in spk_ids:
+                store[spk_id]
+            logging.info('{} lookup: {:.3f}ms per speaker'.format(name, (time.perf_counter() - start) * 1000 / len(spk_ids)))
+        start = time.perf_counter()
+        store['new_spk'] = profile()
+        store.save()
+        logging.info('append one speaker: {:.3f}s'.format(time.perf_counter() - start))
+
+
+def bucket(args, device):
+    from cosyvoice.dataset import processor
+    rng = np.random.RandomState(0)
+    # NOTE log normal utterance lengths, speech token of 25hz and a few text tokens per second, shards differ in mean length
+    shards = {}
+    for i in range(args.num_shards):
+        speech_len = np.clip(rng.lognormal(np.log(125) + rng.uniform(-0.3, 0.3), 0.6, args.shard_size), 10, 750).astype(int)
+        shards['shard_{}'.format(i)] = [{'utt': 'utt_{}_{}'.format(i, j), 'speech_token': [0] * int(j_len), 'text_token': [0] * int(j_len // 6 + 1)}
+                                        for j, j_len in enumerate(speech_len)]
+    index = {k: [len(x['speech_token']) for x in v] for k, v in shards.items()}
+
+    def stream():
+        return processor.shuffle((x for v in shards.values() for x in v), shuffle_size=1000)
+
+    def report(name, batches):
+        start = time.perf_counter()
+        num_batches, num_frames, padded_frames = 0, 0, 0
+        for batch in batches:
+            lengths = [processor.feat_length(x) for x in batch]
+            num_batches, num_frames, padded_frames = num_batches + 1, num_frames + sum(lengths), padded_frames + max(lengths) * len(batch)
+        logging.info('{}: {} batches, padding ratio {:.3f}, {:.3f}s'.format(name, num_batches, 1 - num_frames / padded_frames, time.perf_counter() - start))
+
+    report('sort 500 + dynamic', processor.dynamic_batch(processor.sort(stream(), sort_size=500), args.max_frames_in_batch))
+    for num_buckets in [int(i) for i in args.num_buckets.split(',')]:
+        boundaries = processor.compute_bucket_boundaries(index, num_buckets)
+        report('bucket {}'.format(num_buckets), processor.bucket_batch(stream(), boundaries, args.max_frames_in_batch))
+
+
+def legacy_prepare_lm_input_target(lm, text_token, text_token_emb, text_token_len, speech_token, speech_token_emb, speech_token_len):
+    import random
+    from torch.nn.utils.rnn import pad_sequence, unpad_sequence
+    from cosyvoice.utils.common import IGNORE_ID
+    lm_target, lm_input = [], []
+    text_token = unpad_sequence(text_token, text_token_len.cpu(), batch_first=True)
+    speech_token = unpad_sequence(speech_token, speech_token_len.cpu(), batch_first=True)
+    text_token_emb = unpad_sequence(text_token_emb, text_token_len.cpu(), batch_first=True)
+    speech_token_emb = unpad_sequence(speech_token_emb, speech_token_len.cpu(), batch_first=True)
+    for i in range(len(text_token)):
+        if random.random() < 0.5 and speech_token_len[i] / text_token_len[i] > lm.mix_ratio[1] / lm.mix_ratio[0]:
+            this_lm_target, this_lm_input = [IGNORE_ID], [lm.llm_embedding.weight[lm.sos_eos].reshape(1, -1)]
+            for j in range(((text_token_len[i] + 1) / lm.mix_ratio[0]).ceil().int().item()):
+                this_text_token = text_token[i][j * lm.mix_ratio[0]: (j + 1) * lm.mix_ratio[0]].tolist()
+                this_speech_token = speech_token[i][j * lm.mix_ratio[1]: (j + 1) * lm.mix_ratio[1]].tolist()
+                if len(this_text_token) == lm.mix_ratio[0]:
+                    this_lm_target += [IGNORE_ID] * (lm.mix_ratio[0] - 1) + this_speech_token + [lm.speech_token_size + 2]
+                    this_lm_input.append(text_token_emb[i][j * lm.mix_ratio[0]: (j + 1) * lm.mix_ratio[0]])
+                    this_lm_input.append(speech_token_emb[i][j * lm.mix_ratio[1]: (j + 1) * lm.mix_ratio[1]])
+                else:
+                    this_lm_target += [IGNORE_ID] * len(this_text_token) + speech_token[i][j * lm.mix_ratio[1]:].tolist() + [lm.speech_token_size]
+                    this_lm_input.append(text_token_emb[i][j * lm.mix_ratio[0]:])
+                    this_lm_input.append(lm.llm_embedding.weight[lm.task_id].reshape(1, -1))
+                    this_lm_input.append(speech_token_emb[i][j * lm.mix_ratio[1]:])
+            this_lm_target, this_lm_input = torch.tensor(this_lm_target), torch.concat(this_lm_input, dim=0)
+        else:
+            this_lm_target = torch.tensor([IGNORE_ID] * (1 + text_token_len[i]) + speech_token[i].tolist() + [lm.speech_token_size])
+            this_lm_input = torch.concat([lm.llm_embedding.weight[lm.sos_eos].reshape(1, -1), text_token_emb[i],
+                                          lm.llm_embedding.weight[lm.task_id].reshape(1, -1), speech_token_emb[i]], dim=0)
+        lm_target.append(this_lm_target)
+        lm_input.append(this_lm_input)
+    lm_input_len = torch.tensor([i.size(0) for i in lm_input], dtype=torch.int32)
+    lm_input = pad_sequence(lm_input, batch_first=True, padding_value=IGNORE_ID)
+    lm_target = pad_sequence(lm_target, batch_first=True, padding_value=IGNORE_ID)
+    return lm_target, lm_input, lm_input_len
+
+
+def packed_lm(args, device):
+    import tempfile
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    from cosyvoice.llm.llm import Qwen2Encoder, Qwen2LM
+    # NOTE tiny random qwen2, the layout and attention cost scale like the real 0.5b model
+    torch.manual_seed(0)
+    config = Qwen2Config(vocab_size=1000, hidden_size=args.hidden_size, intermediate_size=args.hidden_size * 4, num_hidden_layers=args.num_layers,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        Qwen2ForCausalLM(config).save_pretrained(tmp_dir)
+        lm = Qwen2LM(args.hidden_size, args.hidden_size, 6561, Qwen2Encoder(tmp_dir), sampling=None).to(device)
+    rng = np.random.RandomState(0)
+    speech_len = np.clip(rng.lognormal(np.log(125), 0.6, args.batch_size), 10, 750).astype(int)
+    text_len = np.maximum(speech_len // rng.randint(4, 8, args.batch_size), 1)
+    batch = {'text_token': torch.randint(0, 1000, (args.batch_size, int(text_len.max()))), 'text_token_len': torch.tensor(text_len),
+             'speech_token': torch.randint(0, 6561, (args.batch_size, int(speech_len.max()))), 'speech_token_len': torch.tensor(speech_len)}
+    num_tokens = int((text_len + speech_len + 2).sum())
+
+    # unistream parity, S/T below mix_ratio never goes bistream
+    uni_speech_len = torch.minimum(batch['speech_token_len'], batch['text_token_len'] * 2)
+    with torch.no_grad():
+        inputs = [batch['text_token'].to(device), lm.llm.model.model.embed_tokens(batch['text_token'].to(device)), batch['text_token_len'].to(device),
+                  batch['speech_token'].to(device), lm.speech_embedding(batch['speech_token'].to(device)), uni_speech_len.to(device)]
+        legacy_target, legacy_input, legacy_len = legacy_prepare_lm_input_target(lm, *inputs)
+        lm_target, lm_input, lm_input_len, _, _ = lm.prepare_lm_input_target(*inputs)
+    logging.info('unistream parity: target equal {}, input max abs diff {:.3e}, len equal {}'.format(
+        torch.equal(legacy_target.to(device), lm_target), (legacy_input.to(device) - lm_input).abs().max().item(),
+        torch.equal(legacy_len.to(device), lm_input_len)))
+
+    def legacy_forward(batch, device):
+        text_token, speech_token = batch['text_token'].to(device), batch['speech_token'].to(device)
+        lm_target, lm_input, lm_input_len = legacy_prepare_lm_input_target(lm, text_token, lm.llm.model.model.embed_tokens(text_token), batch['text_token_len'],
+                                                                           speech_token, lm.speech_embedding(speech_token), batch['speech_token_len'])
+        lm_output, _ = lm.llm(lm_input, lm_input_len.to(device))
+        logits = lm.llm_decoder(lm_output)
+        return {'loss': lm.criterion_ce(logits, lm_target.to(device))}
+
+    for name, pack_len, forward in [('loop padded', 0, legacy_forward), ('vectorized padded', 0, lm.forward), ('packed', args.pack_len, lm.forward)]:
+        lm.pack_len = pack_len
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        for i in range(args.num_steps + 1):
+            if i == 1:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+            forward(batch, device)['loss'].backward()
+            lm.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        cost = time.perf_counter() - start
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+        logging.info('{}: {:.1f} tokens/s, peak memory {:.1f}MB'.format(name, num_tokens * args.num_steps / cost, peak))
+    with torch.no_grad():
+        _, lm_input, _, _, _ = lm.prepare_lm_input_target(*inputs, pack_len=args.pack_len)
+    logging.info('{} utts, {} tokens: padded {}x{}, packed {}x{}'.format(
+        args.batch_size, num_tokens, args.batch_size, int((text_len + uni_speech_len.numpy() + 2).max()), lm_input.size(0), lm_input.size(1)))
+
+
+def hift_stream(args, device):
+    from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
+    from cosyvoice.hifigan.generator import HiFTGenerator, HiFTStreamSession
+    torch.manual_seed(0)
+    hift = HiFTGenerator(sampling_rate=24000, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+                         f0_predictor=ConvRNNF0Predictor())
+    if args.hift_ckpt != '':
+        hift.load_state_dict({k.replace('generator.', ''): v for k, v in torch.load(args.hift_ckpt, map_location='cpu').items()})
+    hift.to(device).eval()
+    # NOTE no additive noise and every sample voiced, so all paths are deterministic and comparable
+    hift.m_source.l_sin_gen.noise_std = 0.0
+    hift.m_source.l_sin_gen.voiced_threshold = -1
+    mel_cache_len, source_cache_len = 8, 8 * 480
+    speech_window = torch.from_numpy(np.hamming(2 * source_cache_len)).float().to(device)
+    mel = torch.randn(1, 80, args.num_frames, device=device)
+    chunks = list(torch.split(mel, args.chunk_frames, dim=2))
+    with torch.inference_mode():
+        reference = hift.inference(speech_feat=mel)[0]
+
+    def cache_crossfade():
+        # NOTE same as CosyVoice2Model.token2wav without a stream session
+        cache, outputs = None, []
+        for i, chunk in enumerate(chunks):
+            finalize = i == len(chunks) - 1
+            if cache is not None:
+                chunk = torch.concat([cache['mel'], chunk], dim=2)
+            speech, source = hift.inference(speech_feat=chunk, cache_source=cache['source'] if cache is not None else torch.zeros(1, 1, 0))
+            if cache is not None:
+                speech = fade_in_out(speech, cache['speech'], speech_window)
+            if finalize is False:
+                cache = {'mel': chunk[:, :, -mel_cache_len:], 'source': source[:, :, -source_cache_len:], 'speech': speech[:, -source_cache_len:]}
+                speech = speech[:, :-source_cache_len]
+            outputs.append(speech)
+        return outputs
+
+    def stream_session():
+        session = HiFTStreamSession(hift)
+        return [session(chunk, finalize=i == len(chunks) - 1) for i, chunk in enumerate(chunks)]
+
+    for name, run in [('cache_crossfade', cache_crossfade), ('stream_session', stream_session)]:
+        with torch.inference_mode():
+            run()
+            cost = []
+            for _ in range(args.num_runs):
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                outputs = run()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                cost.append((time.perf_counter() - start) / len(chunks))
+        speech = torch.concat(outputs, dim=1)
+        n = min(speech.shape[1], reference.shape[1])
+        diff = (speech[:, :n] - reference[:, :n]).abs().max().item()
+        # NOTE jump between the last sample of a chunk and the first of the next, minus the jump of the reference there
+        boundaries = np.cumsum([i.shape[1] for i in outputs])[:-1]
+        boundaries = [i for i in boundaries if 0 < i < n]
+        jump = [abs(speech[0, i] - speech[0, i - 1]).item() - abs(reference[0, i] - reference[0, i - 1]).item() for i in boundaries]
+        cost = np.array(cost) * 1000
+        logging.info('{} {} samples (reference {}), max abs diff {:.3e}, boundary jump excess mean {:.3e} max {:.3e}, per chunk {:.3f}ms'.format(
+            name, speech.shape[1], reference.shape[1], diff, np.mean(jump) if len(jump) > 0 else 0.0,
+            np.max(jump) if len(jump) > 0 else 0.0, cost.mean()))
+
+
+def distill(args, device):
+    # NOTE run with CUDA_VISIBLE_DEVICES= to check the cpu path
+    from copy import deepcopy
+    from omegaconf import DictConfig
+    from cosyvoice.flow.decoder import CausalConditionalDecoder
+    from cosyvoice.flow.flow import CausalMaskedDiffWithXvec
+    from cosyvoice.flow.flow_matching import CausalConditionalCFM
+    from cosyvoice.transformer.upsample_encoder import UpsampleConformerEncoder
+    torch.manual_seed(0)
+    encoder = UpsampleConformerEncoder(input_size=64, output_size=64, attention_heads=2, linear_units=128, num_blocks=2,
+                                       input_layer='linear', pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn',
+                                       use_cnn_module=False, macaron_style=False, static_chunk_size=25)
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine', 'training_cfg_rate': 0.2,
+                             'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1', 'distill_teacher_timesteps': args.teacher_timesteps,
+                             'distill_student_timesteps': [i for i in [1, 2, 4] if args.teacher_timesteps % i == 0]})
+    estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[64], dropout=0.0, attention_head_dim=16, n_blocks=1,
+                                         num_mid_blocks=1, num_heads=2, act_fn='gelu', static_chunk_size=50, num_decoding_left_chunks=-1)
+    decoder = CausalConditionalCFM(in_channels=240, cfm_params=cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator)
+    model = CausalMaskedDiffWithXvec(input_size=64, output_size=80, spk_embed_dim=192, vocab_size=128, n_timesteps=args.n_timesteps,
+                                     encoder=encoder, decoder=decoder).to(device)
+    # NOTE same wiring as train.py --distill, teacher is a frozen copy running forward_teacher
+    teacher = deepcopy(model)
+    teacher.forward = teacher.forward_teacher
+    teacher.requires_grad_(False)
+    model.forward = model.forward_distill
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    token_len = torch.full([args.batch_size], args.token_len, dtype=torch.int32)
+    token_len[1:] = torch.randint(args.token_len // 2, args.token_len + 1, [args.batch_size - 1])
+    batch = {'speech_token': torch.randint(0, 128, [args.batch_size, args.token_len]),
+             'speech_token_len': token_len,
+             'speech_feat': torch.randn(args.batch_size, args.token_len * 2, 80),
+             'speech_feat_len': token_len * 2,
+             'embedding': torch.randn(args.batch_size, 192)}
+
+    failed = False
+    for step in range(args.num_steps):
+        start = time.perf_counter()
+        with torch.no_grad():
+            batch['teacher'] = teacher(batch, device)
+        loss = model(batch, device)['loss']
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        failed |= not torch.isfinite(loss).item()
+        logging.info('distill step {} loss {:.4f} streaming {} cost {:.3f}s'.format(step, loss.item(), batch['teacher']['streaming'], time.perf_counter() - start))
+
+    # NOTE a distilled estimator has guidance baked in, inference_cfg_rate=0 skips the unconditional branch
+    model.eval()
+    model.decoder.inference_cfg_rate = 0.0
+    prompt_len = args.token_len // 4
+    start = time.perf_counter()
+    feat, _ = model.inference(token=batch['speech_token'][:1].to(device), token_len=torch.tensor([args.token_len], dtype=torch.int32, device=device),
+                              prompt_token=torch.randint(0, 128, [1, prompt_len], device=device),
+                              prompt_token_len=torch.tensor([prompt_len], dtype=torch.int32, device=device),
+                              prompt_feat=torch.randn(1, prompt_len * 2, 80, device=device),
+                              prompt_feat_len=torch.tensor([prompt_len * 2], dtype=torch.int32, device=device),
+                              embedding=batch['embedding'][:1].to(device), streaming=False, finalize=True)
+    ok = feat.shape == (1, 80, args.token_len * 2) and torch.isfinite(feat).all().item()
+    failed |= not ok
+    logging.info('inference {} timesteps cfg 0 feat {} cost {:.3f}s {}'.format(
+        args.n_timesteps, tuple(feat.shape), time.perf_counter() - start, 'ok' if ok else 'MISMATCH'))
+    if failed:
+        sys.exit(1)
+
+
+def batched_token2wav(args, device):
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+    from cosyvoice.cli.cosyvoice import CosyVoice2
+    from cosyvoice.utils.file_utils import load_wav
+    cosyvoice = CosyVoice2(args.model_dir)
+    model = cosyvoice.model
+    # NOTE no additive source noise and every sample voiced, so serial and batched speech are comparable
+    model.hift.m_source.l_sin_gen.noise_std = 0.0
+    model.hift.m_source.l_sin_gen.voiced_threshold = -1
+    model_input = cosyvoice.frontend.frontend_zero_shot('', args.prompt_text, load_wav(args.prompt_wav, 16000), cosyvoice.sample_rate, '')
+    prompt_token = model_input['flow_prompt_speech_token'].to(device)
+    prompt_feat, embedding = model_input['prompt_speech_feat'].to(device), model_input['flow_embedding'].to(device)
+    num_streams = [int(i) for i in args.num_streams.split(',')]
+    tokens = [torch.randint(0, 6561, [1, args.num_tokens], generator=torch.Generator().manual_seed(i)) for i in range(max(num_streams))]
+    prompt_token_pad = int(np.ceil(prompt_token.shape[1] / model.token_hop_len) * model.token_hop_len - prompt_token.shape[1])
+
+    def session(index, submit):
+        # NOTE same hops as CosyVoice2Model.tts streaming with a fixed token_hop_len
+        token, this_uuid, token_offset, speech = tokens[index], str(uuid.uuid1()), 0, []
+        model.hift_cache_dict[this_uuid] = None
+        try:
+            while True:
+                hop_len = model.token_hop_len + (prompt_token_pad if token_offset == 0 else 0)
+                if token.shape[1] - token_offset < hop_len + model.flow.pre_lookahead_len:
+                    break
+                speech.append(submit(token=token[:, :token_offset + hop_len + model.flow.pre_lookahead_len], prompt_token=prompt_token,
+                                     prompt_feat=prompt_feat, embedding=embedding, token_offset=token_offset, uuid=this_uuid,
+                                     stream=True, finalize=False))
+                token_offset += hop_len
+            speech.append(submit(token=token, prompt_token=prompt_token, prompt_feat=prompt_feat, embedding=embedding,
+                                 token_offset=token_offset, uuid=this_uuid, finalize=True))
+        finally:
+            model.hift_cache_dict.pop(this_uuid)
+        return torch.concat(speech, dim=1).cpu()
+
+    def run(name, submit):
+        outputs = {}
+        with torch.inference_mode():
+            session(0, submit)
+            for n in num_streams:
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=n) as executor:
+                    for _ in range(args.num_rounds):
+                        outputs.update(zip(range(n), executor.map(lambda i: session(i, submit), range(n))))
+                cost = time.perf_counter() - start
+                logging.info('{} {} streams, {:.2f} sessions/s'.format(name, n, n * args.num_rounds / cost))
+        return outputs
+
+    # NOTE the batched worker can not be stopped, run serial first
+    serial = run('serial', model.token2wav)
+    model.start_token2wav_worker(args.batch_size)
+    batched = run('token2wav_batch_size={}'.format(args.batch_size), model.submit_token2wav)
+    diff = max((serial[i] - batched[i]).abs().max().item() for i in serial)
+    logging.info('batched against serial max abs diff {:.3e} {}'.format(diff, 'ok' if diff <= args.tolerance else 'MISMATCH'))
+    if diff > args.tolerance:
+        sys.exit(1)
+
+
+def quality(args, device):
+    # NOTE discrete time simulation, active requests share one server in a processor sharing manner
+    rng = np.random.RandomState(args.seed)
+    controller = QualityController()
+    if args.disable:
+        controller.levels = controller.levels[:1]
+        controller.level_count = [0]
+    phases = [tuple(float(j) for j in i.split(':')) for i in args.phases.split(',')]
+    dt, now, active, latency = 0.01, 0.0, [], []
+
+    def hop_work(knobs):
+        # llm part is constant per token, flow part scales with steps and halves without cfg
+        flow_factor = (knobs['n_timesteps'] or 10) / 10 * (0.5 if knobs['cfg_rate'] == 0 else 1.0)
+        hop_duration = knobs['token_hop_len'] / 25
+        return hop_duration * args.base_rtf * (0.4 + 0.6 * flow_factor) + args.hop_overhead, hop_duration
+
+    for phase_id, (rate, duration) in enumerate(phases):
+        end = now + duration
+        while now < end:
+            for _ in range(rng.poisson(rate * dt)):
+                knobs = controller.acquire()
+                work, hop_duration = hop_work(knobs)
+                active.append({'phase': phase_id, 'start': now, 'hop_start': now, 'left': work, 'work': work, 'hop_duration': hop_duration,
+                               'remaining': int(np.ceil(args.audio_len / hop_duration)), 'first': None})
+            for i in active:
+                i['left'] -= dt / len(active)
+                if i['left'] <= 0:
+                    controller.observe((now - i['hop_start']) / i['hop_duration'])
+                    if i['first'] is None:
+                        i['first'] = now - i['start']
+                    i['remaining'] -= 1
+                    i['hop_start'], i['left'] = now, i['work']
+            for i in [i for i in active if i['remaining'] <= 0]:
+                active.remove(i)
+                controller.release()
+                latency.append((i['phase'], i['first'], now - i['start']))
+            now += dt
+    for phase_id, (rate, duration) in enumerate(phases):
+        first = np.array([i[1] for i in latency if i[0] == phase_id])
+        total = np.array([i[2] for i in latency if i[0] == phase_id])
+        if len(first) == 0:
+            continue
+        logging.info('phase {} rate {}/s, {} requests, first package p50 {:.3f}s p95 {:.3f}s, total p50 {:.3f}s p95 {:.3f}s'.format(
+            phase_id, rate, len(first), np.percentile(first, 50), np.percentile(first, 95), np.percentile(total, 50), np.percentile(total, 95)))
+    controller.summary()
+
+
+def main():
+    args = get_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.mode == 'stream_overhead':
+        stream_overhead(args, device)
+    elif args.mode == 'attention':
+        attention(args, device)
+    elif args.mode == 'llm_decode':
+        llm_decode(args, device)
+    elif args.mode == 'text_frontend':
+        text_frontend(args, device)
+    elif args.mode == 'thread_budget':
+        thread_budget(args, device)
+    elif args.mode == 'import_cost':
+        import_cost(args, device)
+    elif args.mode == 'parquet':
+        parquet(args, device)
+    elif args.mode == 'packed_lm':
+        packed_lm(args, device)
+    elif args.mode == 'bucket':
+        bucket(args, device)
+    elif args.mode == 'spk_store':
+        spk_store(args, device)
+    elif args.mode == 'enroll':
+        enroll(args, device)
+    elif args.mode == 'features':
+        features(args, device)
+    elif args.mode == 'dataloader':
+        dataloader(args, device)
+    elif args.mode == 'hift_stream':
+        hift_stream(args, device)
+    elif args.mode == 'distill':
+        distill(args, device)
+    elif args.mode == 'token2wav_batch':
+        batched_token2wav(args, device)
+    elif args.mode == 'quality':
+        quality(args, device)
+
+
+if __name__ == '__main__':
+    main()
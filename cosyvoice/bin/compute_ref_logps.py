@@ -0,0 +1,116 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from hyperpyyaml import load_hyperpyyaml
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.dataset.feature_shard import content_hash
+from cosyvoice.dataset.processor import PARQUET_COLUMNS, AUDIO_STAGES, parquet_opener, load_features, static_batch, padding
+from cosyvoice.dataset.ref_logps import LAYOUTS, ref_logp_path, token_hash, read_ref_logps, write_ref_logps
+from cosyvoice.utils.file_utils import logging, read_lists
+from cosyvoice.utils.train_utils import load_checkpoint
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='precompute dpo reference log-probs of chosen and rejected speech tokens')
+    parser.add_argument('--config', required=True, help='training config')
+    parser.add_argument('--data_list', required=True, help='list of dpo parquet files')
+    parser.add_argument('--ref_model', required=True, help='reference llm checkpoint, .pt or .safetensors')
+    parser.add_argument('--qwen_pretrain_path', required=False, help='qwen pretrain path')
+    parser.add_argument('--ref_logp_dir', default=None, help='output dir, default next to the parquet files')
+    parser.add_argument('--audio_free', action='store_true', help='mirror audio free training, stages which decode audio are dropped')
+    parser.add_argument('--feature_dir', default=None, help='mirror training with features precomputed by extract_features.py')
+    parser.add_argument('--batch_size', default=32, type=int, help='utts per ref_model forward')
+    parser.add_argument('--force', action='store_true', help='compute again even if the file is from the same ref_model')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def sample_stages(data_pipeline, audio_free):
+    """ Per sample stages of the training pipeline, they may drop utts or trim speech_token """
+    skip = {'parquet_opener', 'shuffle', 'sort', 'batch', 'padding'} | (AUDIO_STAGES if audio_free is True else set())
+    return [func for func in data_pipeline if getattr(func, 'func', func).__name__ not in skip]
+
+
+@torch.inference_mode()
+def main():
+    args = get_args()
+    override_dict = {k: None for k in ['flow', 'hift', 'hifigan']}
+    try:
+        with open(args.config, 'r') as f:
+            configs = load_hyperpyyaml(f, overrides={**override_dict, 'qwen_pretrain_path': args.qwen_pretrain_path})
+    except Exception:
+        with open(args.config, 'r') as f:
+            configs = load_hyperpyyaml(f, overrides=override_dict)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = configs['llm']
+    model.load_state_dict(load_checkpoint(args.ref_model), strict=False)
+    model.to(device).eval()
+    ref_model = '{}:{}'.format(os.path.basename(args.ref_model), content_hash(args.ref_model))
+    stages = sample_stages(configs['data_pipeline'], args.audio_free)
+    columns = PARQUET_COLUMNS['llm_audio_free'] + ['reject_speech_token'] if args.audio_free is True else PARQUET_COLUMNS['dpo']
+    if args.ref_logp_dir is not None:
+        os.makedirs(args.ref_logp_dir, exist_ok=True)
+
+    srcs = read_lists(args.data_list)
+    start, num_utts = time.time(), 0
+    for i, src in enumerate(srcs):
+        path = ref_logp_path(src, args.ref_logp_dir)
+        index = read_ref_logps(path)
+        if args.force is False and index is not None and index['ref_model'] == ref_model and index.get('layouts') == LAYOUTS:
+            logging.info('[{}/{}] {} skip, {} utts'.format(i + 1, len(srcs), src, len(index['utts'])))
+            continue
+        utts, hashes = {}, {}
+
+        def record_hash(data):
+            # NOTE hash the sample as it reaches padding, the same view padding checks at train time
+            for sample in data:
+                hashes[sample['utt']] = token_hash(sample)
+                yield sample
+
+        data = parquet_opener([{'src': src}], columns=columns)
+        if args.feature_dir is not None:
+            data = load_features(data, feature_dir=args.feature_dir)
+        # NOTE same token changing stages as training, e.g. compute_fbank trims speech_token to the feat length
+        for stage in stages:
+            data = stage(data)
+        data = record_hash(data)
+        for batch in padding(static_batch(data, args.batch_size), use_spk_embedding=False, dpo=True):
+            # NOTE one forward per layout, training draws the layout per row and picks the matching value
+            chosen, rejected = [], []
+            for layout in LAYOUTS:
+                batch['dpo_bistream'] = torch.full((2 * len(batch['utts']),), layout == 'bistream', dtype=torch.bool)
+                loss_dict = model.forward_dpo(batch, device)
+                chosen.append(loss_dict['chosen_logps'].tolist())
+                rejected.append(loss_dict['rejected_logps'].tolist())
+            for j, utt in enumerate(batch['utts']):
+                utts[utt] = [hashes[utt], [logps[j] for logps in chosen], [logps[j] for logps in rejected]]
+        write_ref_logps(path, ref_model, utts)
+        num_utts += len(utts)
+        logging.info('[{}/{}] {} done, {} utts, {:.1f} utts/s'.format(i + 1, len(srcs), src, len(utts), num_utts / (time.time() - start)))
+    logging.info('reference log-probs of {} utts in {:.1f}s'.format(num_utts, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
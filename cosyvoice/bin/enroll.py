@@ -0,0 +1,87 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hyperpyyaml import load_hyperpyyaml
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.frontend import CosyVoiceFrontEnd
+from cosyvoice.utils.file_utils import logging, load_wav
+from cosyvoice.utils.spk_store import SpeakerStore, spk_store_dir
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='enroll zero shot speakers in batch')
+    parser.add_argument('--model_dir', required=True, help='local model dir')
+    parser.add_argument('--prompt_list', required=True, help='one "spk_id<TAB>prompt_text<TAB>prompt_wav" per line')
+    parser.add_argument('--spk_store', default='', help='speaker store dir to append to, default model_dir/spk_store')
+    parser.add_argument('--batch_size', default=16, type=int, help='references per speech tokenizer call')
+    parser.add_argument('--num_workers', default=4, type=int, help='threads for wav loading, fbank/mel extraction and campplus')
+    parser.add_argument('--chunk_size', default=256, type=int, help='references held in memory at a time')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def load_frontend(model_dir):
+    """ Frontend and sample rate of a model dir, without loading llm/flow/hift """
+    override_dict = {k: None for k in ['llm', 'flow', 'hift']}
+    if os.path.exists('{}/cosyvoice2.yaml'.format(model_dir)):
+        hyper_yaml_path, speech_tokenizer = '{}/cosyvoice2.yaml'.format(model_dir), 'speech_tokenizer_v2.onnx'
+        override_dict['qwen_pretrain_path'] = os.path.join(model_dir, 'CosyVoice-BlankEN')
+    else:
+        hyper_yaml_path, speech_tokenizer = '{}/cosyvoice.yaml'.format(model_dir), 'speech_tokenizer_v1.onnx'
+    with open(hyper_yaml_path, 'r') as f:
+        configs = load_hyperpyyaml(f, overrides=override_dict)
+    frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
+                                 configs['feat_extractor'],
+                                 '{}/campplus.onnx'.format(model_dir),
+                                 '{}/{}'.format(model_dir, speech_tokenizer),
+                                 '',
+                                 configs['allowed_special'])
+    return frontend, configs['sample_rate']
+
+
+def main():
+    args = get_args()
+    store_dir = args.spk_store if args.spk_store != '' else spk_store_dir('{}/spk2info.pt'.format(args.model_dir))
+    frontend, sample_rate = load_frontend(args.model_dir)
+    store = SpeakerStore(store_dir, legacy_spk2info='{}/spk2info.pt'.format(args.model_dir))
+    with open(args.prompt_list, 'r', encoding='utf8') as f:
+        prompts = [line.rstrip('\n').split('\t') for line in f if line.strip() != '']
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        for i in range(0, len(prompts), args.chunk_size):
+            chunk = prompts[i: i + args.chunk_size]
+            prompt_speeches_16k = list(executor.map(lambda x: load_wav(x[2], 16000), chunk))
+            model_inputs = frontend.enroll_batch([x[1] for x in chunk], prompt_speeches_16k, sample_rate,
+                                                 batch_size=args.batch_size, num_workers=args.num_workers)
+            for (spk_id, _, _), model_input in zip(chunk, model_inputs):
+                store[spk_id] = model_input
+            # NOTE every chunk is appended to the store, nothing already enrolled is rewritten
+            store.save()
+            logging.info('enroll {}/{} speakers, {:.1f} speakers/s'.format(i + len(chunk), len(prompts), (i + len(chunk)) / (time.time() - start)))
+    logging.info('{} speakers in {}'.format(len(store), store_dir))
+
+
+if __name__ == '__main__':
+    main()
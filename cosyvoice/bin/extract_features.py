@@ -0,0 +1,181 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from hyperpyyaml import load_hyperpyyaml
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.dataset.feature_shard import RAGGED_KEYS, FIXED_KEYS, shard_dir, content_hash, read_index, write_shard
+from cosyvoice.dataset.processor import parquet_opener, resample, extract_f0
+from cosyvoice.utils.file_utils import logging, read_lists
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='precompute training features into memory mapped shards')
+    parser.add_argument('--config', required=True, help='training config, feature settings are read from its data pipeline')
+    parser.add_argument('--data_list', required=True, help='list of parquet files')
+    parser.add_argument('--feature_dir', required=True, help='output dir of feature shards')
+    parser.add_argument('--pipeline', default='data_pipeline_gan', choices=['data_pipeline', 'data_pipeline_gan'],
+                        help='data pipeline to mirror, pitch_feat is only extracted when it has compute_f0')
+    parser.add_argument('--model_dir', default='', help='optional model dir, extract speech_token and utt_embedding with its onnx models')
+    parser.add_argument('--num_workers', default=4, type=int, help='num of extraction processes')
+    parser.add_argument('--force', action='store_true', help='extract again even if the shard is up to date')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def describe(func):
+    """ Stable description of a config partial, used in the config hash """
+    if func is None:
+        return None
+    base = getattr(func, 'func', func)
+    name = '{}.{}'.format(base.__module__, getattr(base, '__name__', type(base).__name__))
+    keywords = {k: describe(v) if callable(v) else v for k, v in sorted(getattr(func, 'keywords', {}).items())}
+    return '{}({})'.format(name, keywords)
+
+
+def find_stage(data_pipeline, name):
+    for func in data_pipeline:
+        if getattr(func, 'func', func).__name__ == name:
+            return func
+    return None
+
+
+class Extractor:
+
+    def __init__(self, resample_stage, fbank_stage, f0_stage, model_dir):
+        self.resample_kwargs = dict(resample_stage.keywords)
+        self.feat_extractor = fbank_stage.keywords['feat_extractor']
+        self.f0_kwargs = dict(f0_stage.keywords) if f0_stage is not None else None
+        self.model_dir = model_dir
+        self.frontend = None
+        self.config_hash = hashlib.sha1('|'.join(str(i) for i in [describe(resample_stage), describe(fbank_stage),
+                                                                   describe(f0_stage), model_dir]).encode()).hexdigest()
+
+    def init_worker(self):
+        # NOTE one thread per process, parallelism comes from the pool
+        torch.set_num_threads(1)
+        if self.model_dir != '':
+            from cosyvoice.cli.frontend import CosyVoiceFrontEnd
+            speech_tokenizer = 'speech_tokenizer_v2.onnx' if os.path.exists('{}/speech_tokenizer_v2.onnx'.format(self.model_dir)) \
+                else 'speech_tokenizer_v1.onnx'
+            self.frontend = CosyVoiceFrontEnd(lambda: None, self.feat_extractor, '{}/campplus.onnx'.format(self.model_dir),
+                                              '{}/{}'.format(self.model_dir, speech_tokenizer))
+
+    def extract(self, sample):
+        speech, sample_rate = sample['speech'], sample['sample_rate']
+        feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1)
+        features = {'speech_feat': feat.float().numpy(), 'duration': speech.shape[1] / sample_rate}
+        if self.f0_kwargs is not None:
+            features['pitch_feat'] = extract_f0(speech, self.f0_kwargs['sample_rate'], self.f0_kwargs['hop_size'], feat.shape[0]).float().numpy()
+        if self.frontend is not None:
+            import torchaudio
+            speech_16k = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)(speech)
+            features['utt_embedding'] = self.frontend._extract_spk_embedding(speech_16k)[0].cpu().numpy()
+            if speech_16k.shape[1] / 16000 <= 30:
+                features['speech_token'] = self.frontend._extract_speech_token(speech_16k)[0][0].cpu().numpy()
+        # NOTE keep what the frontend can not extract from the parquet, spk_embedding is an average over all utts of a speaker
+        for key in ['speech_token', 'utt_embedding', 'spk_embedding']:
+            if key not in features and key in sample:
+                features[key] = np.asarray(sample[key])
+        return features
+
+    def __call__(self, src, feature_dir, force=False):
+        start = time.time()
+        path = shard_dir(feature_dir, src)
+        source_hash = content_hash(src)
+        index = read_index(path)
+        if force is False and index is not None and index['source_hash'] == source_hash and index['config_hash'] == self.config_hash:
+            return src, 'skip', len(index['utts']), time.time() - start
+        utts, durations, features = [], [], {}
+        data = parquet_opener([{'src': src}], columns=['utt', 'audio_data', 'speech_token', 'utt_embedding', 'spk_embedding'])
+        for sample in resample(data, **self.resample_kwargs):
+            utts.append(sample['utt'])
+            for key, value in self.extract(sample).items():
+                if key == 'duration':
+                    durations.append(value)
+                else:
+                    features.setdefault(key, []).append(value)
+        if len(utts) == 0:
+            # NOTE no index for an empty or unreadable shard, so it is not skipped as done on the next run
+            return src, 'failed no utts extracted', 0, time.time() - start
+        # NOTE a key missing for some utts, e.g. speech_token of audio longer than 30s, is dropped for the whole shard
+        keys = [key for key in RAGGED_KEYS + FIXED_KEYS if len(features.get(key, [])) == len(utts)]
+        arrays, offsets = {}, {}
+        for key in keys:
+            if key in RAGGED_KEYS:
+                offsets[key] = np.cumsum([0] + [len(i) for i in features[key]]).tolist()
+                arrays[key] = np.concatenate(features[key], axis=0)
+            else:
+                arrays[key] = np.stack(features[key], axis=0)
+        index = {'source': os.path.abspath(src), 'source_hash': source_hash, 'source_size': os.path.getsize(src), 'config_hash': self.config_hash,
+                 'hop_size': self.f0_kwargs['hop_size'] if self.f0_kwargs is not None else None,
+                 'keys': keys, 'utts': utts, 'duration': durations, 'offsets': offsets}
+        write_shard(path, index, arrays)
+        return src, 'done', len(utts), time.time() - start
+
+
+_extractor = None
+
+
+def _init_worker(extractor):
+    global _extractor
+    _extractor = extractor
+    _extractor.init_worker()
+
+
+def _extract_shard(job):
+    try:
+        return _extractor(*job)
+    except Exception as ex:
+        return job[0], 'failed {}'.format(ex), 0, 0.0
+
+
+def main():
+    args = get_args()
+    override_dict = {k: None for k in ['llm', 'flow', 'hift', 'hifigan']}
+    with open(args.config, 'r') as f:
+        configs = load_hyperpyyaml(f, overrides=override_dict)
+    data_pipeline = configs[args.pipeline] if args.pipeline in configs else configs['data_pipeline']
+    extractor = Extractor(find_stage(data_pipeline, 'resample'), find_stage(data_pipeline, 'compute_fbank'),
+                          find_stage(data_pipeline, 'compute_f0'), args.model_dir)
+    os.makedirs(args.feature_dir, exist_ok=True)
+    srcs = read_lists(args.data_list)
+    start, num_utts, failed = time.time(), 0, []
+    # NOTE spawn workers, onnxruntime and torch thread pools are not fork safe
+    with multiprocessing.get_context('spawn').Pool(args.num_workers, initializer=_init_worker, initargs=(extractor,)) as pool:
+        for i, (src, status, n, cost) in enumerate(pool.imap_unordered(_extract_shard, [(src, args.feature_dir, args.force) for src in srcs])):
+            logging.info('[{}/{}] {} {}, {} utts in {:.1f}s'.format(i + 1, len(srcs), src, status, n, cost))
+            num_utts += n
+            if status.startswith('failed'):
+                failed.append(src)
+    logging.info('extract {} utts of {} shards in {:.1f}s, {} failed'.format(num_utts, len(srcs), time.time() - start, len(failed)))
+    if len(failed) > 0:
+        logging.warning('failed shards are extracted again on the next run: {}'.format(failed))
+
+
+if __name__ == '__main__':
+    main()
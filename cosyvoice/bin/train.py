@@ -33,7 +33,7 @@ from cosyvoice.utils.train_utils import (
     init_distributed,
     init_dataset_and_dataloader,
     init_optimizer_and_scheduler,
-    init_summarywriter, save_model,
+    init_summarywriter, save_model, wait_checkpoint, load_checkpoint,
     wrap_cuda_model, check_modify_and_save_config)
 
 
@@ -45,9 +45,12 @@ def get_args():
                         help='Engine for paralleled training')
     parser.add_argument('--model', required=True, help='model which will be trained')
     parser.add_argument('--ref_model', required=False, help='ref model used in dpo')
+    parser.add_argument('--ref_logp_dir', required=False, help='dir of reference log-probs precomputed by compute_ref_logps.py, default next to the parquet files')
+    parser.add_argument('--teacher_model', required=False, help='teacher flow model used in few-step distillation')
     parser.add_argument('--config', required=True, help='config file')
     parser.add_argument('--train_data', required=True, help='train data file')
     parser.add_argument('--cv_data', required=True, help='cv data file')
+    parser.add_argument('--feature_dir', required=False, help='features precomputed by extract_features.py')
     parser.add_argument('--qwen_pretrain_path', required=False, help='qwen pretrain path')
     parser.add_argument('--checkpoint', help='checkpoint model')
     parser.add_argument('--model_dir', required=True, help='save model dir')
@@ -79,11 +82,42 @@ def get_args():
                         action='store_true',
                         default=False,
                         help='Use Direct Preference Optimization')
+    parser.add_argument('--ref_logps',
+                        action='store_true',
+                        default=False,
+                        help='Use precomputed dpo reference log-probs of both unistream and bistream layouts, '
+                             'ref_model only runs on batches missing them')
+    parser.add_argument('--audio_free',
+                        action='store_true',
+                        default=False,
+                        help='Train llm without reading or decoding audio')
+    parser.add_argument('--pack_len',
+                        default=0,
+                        type=int,
+                        help='Pack llm training samples into rows of pack_len tokens, 0 pads every sample to the batch max')
+    parser.add_argument('--distill',
+                        action='store_true',
+                        default=False,
+                        help='Distill a few-step flow decoder from teacher_model')
     parser.add_argument('--deepspeed.save_states',
                         dest='save_states',
                         default='model_only',
                         choices=['model_only', 'model+optimizer'],
                         help='save model/optimizer states')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        default=False,
+                        help='Time dataloader wait, processor stages, h2d, forward, backward and optimizer of every step, syncs cuda')
+    parser.add_argument('--profile_trace_dir',
+                        default=None,
+                        help='Write a torch.profiler trace of a window of steps of every epoch on rank 0 to this dir')
+    parser.add_argument('--profile_trace_steps',
+                        default='10,2,5',
+                        help='wait,warmup,active steps of the torch.profiler trace window')
+    parser.add_argument('--save_format',
+                        default='pt',
+                        choices=['pt', 'safetensors'],
+                        help='torch_ddp checkpoint format, checkpoints are written in background either way')
     parser.add_argument('--timeout',
                         default=60,
                         type=int,
@@ -130,11 +164,19 @@ def main():
     # load checkpoint
     if args.dpo is True:
         configs[args.model].forward = configs[args.model].forward_dpo
+    if args.distill is True:
+        assert args.model == 'flow', 'distill is only implemented for flow!'
+        # NOTE copy teacher before switching forward, student keeps the same architecture
+        teacher_model = deepcopy(configs[args.model])
+        configs[args.model].forward = configs[args.model].forward_distill
     model = configs[args.model]
+    if args.pack_len > 0:
+        assert args.model == 'llm' and args.dpo is False and hasattr(model, 'pack_len'), 'pack_len is only implemented for Qwen2LM training without dpo!'
+        model.pack_len = args.pack_len
     start_step, start_epoch = 0, -1
     if args.checkpoint is not None:
         if os.path.exists(args.checkpoint):
-            state_dict = torch.load(args.checkpoint, map_location='cpu')
+            state_dict = load_checkpoint(args.checkpoint)
             model.load_state_dict(state_dict, strict=False)
             if 'step' in state_dict:
                 start_step = state_dict['step']
@@ -159,9 +201,12 @@ def main():
     save_model(model, 'init', info_dict)
 
     # DPO related
-    if args.dpo is True:
+    if args.dpo is True and args.ref_logps is True and args.ref_model is None:
+        # NOTE every batch must carry cached reference log-probs, batch_forward asserts otherwise
+        ref_model, dpo_loss = None, DPOLoss(beta=0.01, label_smoothing=0.0, ipo=False)
+    elif args.dpo is True:
         ref_model = deepcopy(configs[args.model])
-        state_dict = torch.load(args.ref_model, map_location='cpu')
+        state_dict = load_checkpoint(args.ref_model)
         ref_model.load_state_dict(state_dict, strict=False)
         dpo_loss = DPOLoss(beta=0.01, label_smoothing=0.0, ipo=False)
         # NOTE maybe it is not needed to wrap ref_model as ddp because its parameter is not updated
@@ -169,8 +214,19 @@ def main():
     else:
         ref_model, dpo_loss = None, None
 
+    # Distill related
+    if args.distill is True:
+        state_dict = load_checkpoint(args.teacher_model)
+        teacher_model.load_state_dict(state_dict, strict=False)
+        teacher_model.forward = teacher_model.forward_teacher
+        # NOTE teacher is frozen, do not wrap it as ddp
+        teacher_model.requires_grad_(False)
+        teacher_model.cuda()
+    else:
+        teacher_model = None
+
     # Get executor
-    executor = Executor(gan=gan, ref_model=ref_model, dpo_loss=dpo_loss)
+    executor = Executor(gan=gan, ref_model=ref_model, dpo_loss=dpo_loss, teacher_model=teacher_model)
     executor.step = start_step
 
     # Init scaler, used for pytorch amp mixed precision training
@@ -189,6 +245,7 @@ def main():
         else:
             executor.train_one_epoc(model, optimizer, scheduler, train_data_loader, cv_data_loader, writer, info_dict, scaler, group_join, ref_model=ref_model)
         dist.destroy_process_group(group_join)
+    wait_checkpoint()
 
 
 if __name__ == '__main__':
@@ -16,21 +16,25 @@ import time
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
-from modelscope import snapshot_download
 import torch
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
-from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model
+from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, QualityController
+from cosyvoice.transformer.attention import set_sdpa
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.class_utils import get_model_type
 
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, adaptive_hop=False, use_sdpa=False,
+                 thread_budget=None):
+        if thread_budget is not None:
+            thread_budget.apply()
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
+            from modelscope import snapshot_download
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
@@ -43,7 +47,8 @@ class CosyVoice:
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          thread_budget=thread_budget)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
@@ -61,6 +66,10 @@ class CosyVoice:
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if use_sdpa:
+            logging.info('switch {} attention modules to sdpa'.format(set_sdpa(self.model.llm) + set_sdpa(self.model.flow)))
+        self.model.adaptive_hop = adaptive_hop
+        self.model.thread_budget = thread_budget
         del configs
 
     def list_available_spks(self):
@@ -75,8 +84,16 @@ class CosyVoice:
         self.frontend.spk2info[zero_shot_spk_id] = model_input
         return True
 
+    def add_zero_shot_spks(self, zero_shot_spk_ids, prompt_texts, prompt_speeches_16k, batch_size=16, num_workers=4):
+        assert '' not in zero_shot_spk_ids, 'do not use empty zero_shot_spk_id'
+        model_inputs = self.frontend.enroll_batch(prompt_texts, prompt_speeches_16k, self.sample_rate, batch_size=batch_size, num_workers=num_workers)
+        for zero_shot_spk_id, model_input in zip(zero_shot_spk_ids, model_inputs):
+            self.frontend.spk2info[zero_shot_spk_id] = model_input
+        return True
+
     def save_spkinfo(self):
-        torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
+        # NOTE only speakers added since the last save are appended to the store
+        self.frontend.spk2info.save()
 
     def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
@@ -141,11 +158,15 @@ class CosyVoice:
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, token2wav_batch_size=1, pipeline_queue_size=0,
+                 adaptive_hop=False, stateful_hift=False, use_sdpa=False, quality_controller=False, mmap_weights=False, thread_budget=None):
+        if thread_budget is not None:
+            thread_budget.apply()
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
+            from modelscope import snapshot_download
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice2.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
@@ -158,7 +179,8 @@ class CosyVoice2(CosyVoice):
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v2.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          thread_budget=thread_budget)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
@@ -166,7 +188,8 @@ class CosyVoice2(CosyVoice):
         self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+                        '{}/hift.pt'.format(model_dir),
+                        mmap=mmap_weights)
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
         if load_jit:
@@ -176,6 +199,24 @@ class CosyVoice2(CosyVoice):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if token2wav_batch_size > 1:
+            if load_trt is True:
+                logging.warning('batched token2wav does not support trt estimator, set token2wav_batch_size to 1')
+            else:
+                self.model.start_token2wav_worker(token2wav_batch_size)
+        if pipeline_queue_size > 0:
+            if self.model.token2wav_queue is not None:
+                logging.warning('pipeline parallel streaming does not support batched token2wav, set pipeline_queue_size to 0')
+            else:
+                self.model.start_pipeline(pipeline_queue_size)
+        if use_sdpa:
+            logging.info('switch {} attention modules to sdpa'.format(set_sdpa(self.model.flow)))
+        self.model.adaptive_hop = adaptive_hop
+        self.model.thread_budget = thread_budget
+        self.model.stateful_hift = stateful_hift
+        if quality_controller:
+            # NOTE adaptive hop scheduler takes precedence over the hop size of the quality level
+            self.model.quality_controller = QualityController()
         del configs
 
     def inference_instruct(self, *args, **kwargs):
@@ -11,29 +11,21 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from functools import partial
+from functools import partial, lru_cache
 from typing import Generator
 import json
-import onnxruntime
+import threading
+import time
 import torch
 import numpy as np
-import whisper
 from typing import Callable
-import torchaudio.compliance.kaldi as kaldi
-import torchaudio
 import os
 import re
-import inflect
-try:
-    import ttsfrd
-    use_ttsfrd = True
-except ImportError:
-    print("failed to import ttsfrd, use wetext instead")
-    from wetext import Normalizer as ZhNormalizer
-    from wetext import Normalizer as EnNormalizer
-    use_ttsfrd = False
+from cosyvoice.utils.audio_utils import log_mel_spectrogram
 from cosyvoice.utils.file_utils import logging
-from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
+from cosyvoice.utils.spk_store import SpeakerStore, spk_store_dir
+from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation, \
+    find_stream_boundary
 
 
 class CosyVoiceFrontEnd:
@@ -44,33 +36,96 @@ class CosyVoiceFrontEnd:
                  campplus_model: str,
                  speech_tokenizer_model: str,
                  spk2info: str = '',
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 cache_size: int = 1024,
+                 thread_budget=None,
+                 spk_cache_size: int = 64):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # NOTE onnx sessions and text normalizers are loaded on first use, speakers cached in spk2info never need them
+        self.campplus_model = campplus_model
+        self.speech_tokenizer_model = speech_tokenizer_model
+        self.thread_budget = thread_budget
+        self._campplus_session = None
+        self._speech_tokenizer_session = None
+        self.lazy_lock = threading.Lock()
+        # NOTE speakers are read from an indexed store on first use, legacy spk2info.pt is imported into it once
+        self.spk2info = SpeakerStore(spk_store_dir(spk2info), device=self.device, cache_size=spk_cache_size, legacy_spk2info=spk2info)
+        self.allowed_special = allowed_special
+        self.use_ttsfrd = None
+        # NOTE bounded memo of normalization and tokenization, the same replies are synthesized over and over
+        self._text_normalize_cached = lru_cache(maxsize=cache_size)(self._text_normalize)
+        self._encode_cached = lru_cache(maxsize=cache_size)(self._encode)
+        self._text_normalize_span_cached = lru_cache(maxsize=cache_size)(self._text_normalize_span)
+
+    def _session_options(self):
+        if self.thread_budget is not None:
+            return self.thread_budget.session_options('onnx')
+        import onnxruntime
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         option.intra_op_num_threads = 1
-        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
-        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
-                                                                     providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
-                                                                                "CPUExecutionProvider"])
-        if os.path.exists(spk2info):
-            self.spk2info = torch.load(spk2info, map_location=self.device)
-        else:
-            self.spk2info = {}
-        self.allowed_special = allowed_special
-        self.use_ttsfrd = use_ttsfrd
-        if self.use_ttsfrd:
-            self.frd = ttsfrd.TtsFrontendEngine()
-            ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
-            assert self.frd.initialize('{}/../../pretrained_models/CosyVoice-ttsfrd/resource'.format(ROOT_DIR)) is True, \
-                'failed to initialize ttsfrd resource'
-            self.frd.set_lang_type('pinyinvg')
-        else:
-            self.zh_tn_model = ZhNormalizer(remove_erhua=False)
-            self.en_tn_model = EnNormalizer()
-            self.inflect_parser = inflect.engine()
+        return option
+
+    @property
+    def campplus_session(self):
+        with self.lazy_lock:
+            if self._campplus_session is None:
+                import onnxruntime
+                start = time.time()
+                self._campplus_session = onnxruntime.InferenceSession(self.campplus_model, sess_options=self._session_options(),
+                                                                      providers=["CPUExecutionProvider"])
+                logging.info('load {} in {:.3f}s'.format(self.campplus_model, time.time() - start))
+            return self._campplus_session
+
+    @property
+    def speech_tokenizer_session(self):
+        with self.lazy_lock:
+            if self._speech_tokenizer_session is None:
+                import onnxruntime
+                start = time.time()
+                self._speech_tokenizer_session = onnxruntime.InferenceSession(self.speech_tokenizer_model, sess_options=self._session_options(),
+                                                                              providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
+                                                                                         "CPUExecutionProvider"])
+                logging.info('load {} in {:.3f}s'.format(self.speech_tokenizer_model, time.time() - start))
+            return self._speech_tokenizer_session
+
+    def unload_sessions(self):
+        """Release campplus and speech tokenizer sessions, they are loaded again on next use."""
+        with self.lazy_lock:
+            self._campplus_session, self._speech_tokenizer_session = None, None
+
+    def _init_text_frontend(self):
+        with self.lazy_lock:
+            if self.use_ttsfrd is not None:
+                return
+            try:
+                import ttsfrd
+                self.frd = ttsfrd.TtsFrontendEngine()
+                ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+                assert self.frd.initialize('{}/../../pretrained_models/CosyVoice-ttsfrd/resource'.format(ROOT_DIR)) is True, \
+                    'failed to initialize ttsfrd resource'
+                self.frd.set_lang_type('pinyinvg')
+                self.use_ttsfrd = True
+            except ImportError:
+                print("failed to import ttsfrd, use wetext instead")
+                import inflect
+                from wetext import Normalizer as ZhNormalizer
+                from wetext import Normalizer as EnNormalizer
+                self.zh_tn_model = ZhNormalizer(remove_erhua=False)
+                self.en_tn_model = EnNormalizer()
+                self.inflect_parser = inflect.engine()
+                self.use_ttsfrd = False
+
+    def _encode(self, text):
+        return tuple(self.tokenizer.encode(text, allowed_special=self.allowed_special))
+
+    def encode_batch(self, texts):
+        """Tokenize a list of texts, returns a list of token id lists."""
+        if hasattr(self.tokenizer, 'batch_encode'):
+            return self.tokenizer.batch_encode(texts)
+        return [self.tokenizer.encode(i, allowed_special=self.allowed_special) for i in texts]
 
     def _extract_text_token(self, text):
         if isinstance(text, Generator):
@@ -78,20 +133,22 @@ class CosyVoiceFrontEnd:
             # NOTE add a dummy text_token_len for compatibility
             return self._extract_text_token_generator(text), torch.tensor([0], dtype=torch.int32).to(self.device)
         else:
-            text_token = self.tokenizer.encode(text, allowed_special=self.allowed_special)
+            text_token = self._encode_cached(text)
             text_token = torch.tensor([text_token], dtype=torch.int32).to(self.device)
             text_token_len = torch.tensor([text_token.shape[1]], dtype=torch.int32).to(self.device)
             return text_token, text_token_len
 
     def _extract_text_token_generator(self, text_generator):
+        # NOTE every span is tokenized once and moved to device as one batch, llm consumes text tokens in mix_ratio chunks
         for text in text_generator:
+            if text == '':
+                continue
             text_token, _ = self._extract_text_token(text)
-            for i in range(text_token.shape[1]):
-                yield text_token[:, i: i + 1]
+            yield text_token
 
     def _extract_speech_token(self, speech):
         assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
-        feat = whisper.log_mel_spectrogram(speech, n_mels=128)
+        feat = log_mel_spectrogram(speech, n_mels=128)
         speech_token = self.speech_tokenizer_session.run(None,
                                                          {self.speech_tokenizer_session.get_inputs()[0].name:
                                                           feat.detach().cpu().numpy(),
@@ -102,6 +159,7 @@ class CosyVoiceFrontEnd:
         return speech_token, speech_token_len
 
     def _extract_spk_embedding(self, speech):
+        import torchaudio.compliance.kaldi as kaldi
         feat = kaldi.fbank(speech,
                            num_mel_bins=80,
                            dither=0,
@@ -118,35 +176,133 @@ class CosyVoiceFrontEnd:
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    def _extract_speech_token_batch(self, speeches, batch_size=16, executor=None):
+        """Tokenize a list of (1, T) 16k speech, references of similar length are padded into one onnx call."""
+        if any(i.shape[1] / 16000 > 30 for i in speeches):
+            logging.warning('speech longer than 30s, only the first 30s is tokenized')
+            speeches = [i[:, :30 * 16000] for i in speeches]
+        feats = list((executor.map if executor is not None else map)(lambda x: log_mel_spectrogram(x, n_mels=128), speeches))
+        order = sorted(range(len(feats)), key=lambda i: feats[i].shape[2])
+        session, speech_tokens = self.speech_tokenizer_session, [None] * len(feats)
+        for start in range(0, len(order), batch_size):
+            index = order[start: start + batch_size]
+            feat_len = np.array([feats[i].shape[2] for i in index], dtype=np.int32)
+            feat = torch.zeros(len(index), 128, int(feat_len.max()))
+            for j, i in enumerate(index):
+                feat[j, :, :feat_len[j]] = feats[i][0]
+            speech_token = session.run(None, {session.get_inputs()[0].name: feat.numpy(), session.get_inputs()[1].name: feat_len})[0]
+            # NOTE output is padded to the longest reference, cut every row with the downsample ratio of the tokenizer
+            ratio = max(round(feat_len.max() / speech_token.shape[1]), 1)
+            for j, i in enumerate(index):
+                token_len = min((int(feat_len[j]) + ratio - 1) // ratio, speech_token.shape[1])
+                speech_tokens[i] = torch.tensor(speech_token[j: j + 1, :token_len], dtype=torch.int32).to(self.device)
+        return [(i, torch.tensor([i.shape[1]], dtype=torch.int32).to(self.device)) for i in speech_tokens]
+
+    def _build_prompt_input(self, prompt_text, speech_feat, speech_feat_len, speech_token, speech_token_len, embedding, resample_rate):
+        prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+        if resample_rate == 24000:
+            # cosyvoice2, force speech_feat % speech_token = 2
+            token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
+            speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
+            speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
+        return {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
+                'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
+                'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
+                'llm_embedding': embedding, 'flow_embedding': embedding}
+
+    def enroll_batch(self, prompt_texts, prompt_speeches_16k, resample_rate, batch_size=16, num_workers=4):
+        """Zero shot prompt inputs of many references, same as frontend_zero_shot without text.
+
+        fbank/mel extraction and campplus run on a pool of num_workers threads, the speech tokenizer
+        runs on padded batches of batch_size references sorted by length.
+        """
+        import torchaudio
+        from concurrent.futures import ThreadPoolExecutor
+        assert len(prompt_texts) == len(prompt_speeches_16k)
+        prompt_speeches_16k = list(prompt_speeches_16k)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # NOTE campplus pools statistics over every frame and has no length input, padding would shift the embedding
+            embeddings = executor.map(self._extract_spk_embedding, prompt_speeches_16k)
+            speech_feats = executor.map(lambda x: self._extract_speech_feat(torchaudio.functional.resample(x, 16000, resample_rate)),
+                                        prompt_speeches_16k)
+            speech_tokens = self._extract_speech_token_batch(prompt_speeches_16k, batch_size, executor)
+            return [self._build_prompt_input(prompt_text, speech_feat, speech_feat_len, speech_token, speech_token_len, embedding, resample_rate)
+                    for prompt_text, (speech_feat, speech_feat_len), (speech_token, speech_token_len), embedding in
+                    zip(prompt_texts, speech_feats, speech_tokens, embeddings)]
+
     def text_normalize(self, text, split=True, text_frontend=True):
         if isinstance(text, Generator):
-            logging.info('get tts_text generator, will skip text_normalize!')
-            return [text]
+            if text_frontend is False:
+                logging.info('get tts_text generator, will skip text_normalize!')
+                return [text]
+            return [self._text_normalize_generator(text)]
         if text_frontend is False or text == '':
             return [text] if split is True else text
+        texts, text = self._text_normalize_cached(text)
+        return list(texts) if split is True else text
+
+    def _text_normalize(self, text):
+        self._init_text_frontend()
         text = text.strip()
         if self.use_ttsfrd:
             texts = [i["text"] for i in json.loads(self.frd.do_voicegen_frd(text))["sentences"]]
             text = ''.join(texts)
         else:
             if contains_chinese(text):
-                text = self.zh_tn_model.normalize(text)
-                text = text.replace("\n", "")
-                text = replace_blank(text)
-                text = replace_corner_mark(text)
-                text = text.replace(".", "。")
-                text = text.replace(" - ", "，")
-                text = remove_bracket(text)
+                text = self._zh_normalize(text)
                 text = re.sub(r'[，,、]+$', '。', text)
                 texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "zh", token_max_n=80,
-                                             token_min_n=60, merge_len=20, comma_split=False))
+                                             token_min_n=60, merge_len=20, comma_split=False, batch_tokenize=self.encode_batch))
             else:
-                text = self.en_tn_model.normalize(text)
-                text = spell_out_number(text, self.inflect_parser)
+                text = self._en_normalize(text)
                 texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
-                                             token_min_n=60, merge_len=20, comma_split=False))
-        texts = [i for i in texts if not is_only_punctuation(i)]
-        return texts if split is True else text
+                                             token_min_n=60, merge_len=20, comma_split=False, batch_tokenize=self.encode_batch))
+        texts = tuple(i for i in texts if not is_only_punctuation(i))
+        return texts, text
+
+    def _zh_normalize(self, text):
+        text = self.zh_tn_model.normalize(text)
+        text = text.replace("\n", "")
+        text = replace_blank(text)
+        text = replace_corner_mark(text)
+        text = text.replace(".", "。")
+        text = text.replace(" - ", "，")
+        text = remove_bracket(text)
+        return text
+
+    def _en_normalize(self, text):
+        text = self.en_tn_model.normalize(text)
+        text = spell_out_number(text, self.inflect_parser)
+        return text
+
+    def _text_normalize_span(self, text):
+        """Normalize a span of streaming text, no paragraph split and trailing punctuation kept as is."""
+        self._init_text_frontend()
+        blank = text[-1:].isspace()
+        text = text.strip()
+        if text == '':
+            return ''
+        if self.use_ttsfrd:
+            text = ''.join([i["text"] for i in json.loads(self.frd.do_voicegen_frd(text))["sentences"]])
+        elif contains_chinese(text):
+            text = self._zh_normalize(text)
+        else:
+            text = self._en_normalize(text)
+        # NOTE normalizer strips the blank between two english spans
+        return text + ' ' if blank and not contains_chinese(text) else text
+
+    def _text_normalize_generator(self, text_generator, max_len=50):
+        """Buffer llm deltas up to a safe boundary, then normalize every buffered span once."""
+        buffer = ''
+        for text in text_generator:
+            buffer += text
+            boundary = find_stream_boundary(buffer, max_len)
+            if boundary > 0:
+                yield self._text_normalize_span_cached(buffer[:boundary])
+                buffer = buffer[boundary:]
+        if buffer.strip() != '':
+            yield self._text_normalize_span_cached(buffer)
 
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
@@ -157,21 +313,12 @@ class CosyVoiceFrontEnd:
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, resample_rate, zero_shot_spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
-            prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+            import torchaudio
             prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
             speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
             speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
-            if resample_rate == 24000:
-                # cosyvoice2, force speech_feat % speech_token = 2
-                token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
             embedding = self._extract_spk_embedding(prompt_speech_16k)
-            model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                           'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                           'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                           'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                           'llm_embedding': embedding, 'flow_embedding': embedding}
+            model_input = self._build_prompt_input(prompt_text, speech_feat, speech_feat_len, speech_token, speech_token_len, embedding, resample_rate)
         else:
             model_input = self.spk2info[zero_shot_spk_id]
         model_input['text'] = tts_text_token
@@ -203,6 +350,7 @@ class CosyVoiceFrontEnd:
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_speech_16k, resample_rate):
+        import torchaudio
         prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
         prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
         prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
@@ -13,17 +13,161 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import logging
 from typing import Generator
 import torch
 import numpy as np
 import threading
+import queue
 import time
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from contextlib import nullcontext
 import uuid
 from cosyvoice.utils.common import fade_in_out
 from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
-from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.common import TrtContextWrapper, DeviceTokenBuffer, to_host
+from cosyvoice.hifigan.generator import HiFTStreamSession
+
+
+class AdaptiveHopScheduler:
+    """Choose streaming hop sizes from live llm token rate and token2wav cost.
+
+    The first hop uses min_hop_len for a fast first package. Later hops take the largest
+    multiple of granularity within [min_hop_len, max_hop_len] whose tokens can be generated
+    and vocoded before the audio already emitted has been played out.
+    """
+
+    def __init__(self, min_hop_len, max_hop_len, granularity, lookahead_len, token_frame_rate, safety_factor=1.5, uuid=''):
+        assert (max_hop_len - min_hop_len) % granularity == 0, 'max_hop_len - min_hop_len should be multiple of granularity'
+        self.min_hop_len = min_hop_len
+        self.max_hop_len = max_hop_len
+        self.granularity = granularity
+        self.lookahead_len = lookahead_len
+        self.token_frame_rate = token_frame_rate
+        self.safety_factor = safety_factor
+        self.uuid = uuid
+        self.start_time = time.time()
+        self.first_package_time = None
+        self.emitted_duration = 0.0
+        self.consumed_token = 0
+        self.token2wav_cost = None
+        self.hop_lens = []
+        self.underrun = 0
+
+    def buffered_duration(self):
+        """Seconds of emitted audio not played yet, assuming playback starts at first package."""
+        return self.emitted_duration - (time.time() - self.first_package_time)
+
+    def next_hop_len(self, pending_token, llm_end):
+        if self.token2wav_cost is None:
+            return self.min_hop_len
+        buffered_duration = self.buffered_duration()
+        llm_rate = (self.consumed_token + pending_token) / max(time.time() - self.start_time, 1e-3)
+        hop_len = self.max_hop_len
+        while hop_len > self.min_hop_len:
+            missing_token = max(hop_len + self.lookahead_len - pending_token, 0)
+            if not (llm_end is True and missing_token > 0) and \
+                    missing_token / llm_rate + self.safety_factor * self.token2wav_cost * hop_len <= buffered_duration:
+                break
+            hop_len -= self.granularity
+        return hop_len
+
+    def observe(self, hop_len, cost):
+        """Record a hop of hop_len tokens which took cost seconds in token2wav."""
+        if self.first_package_time is None:
+            self.first_package_time = time.time()
+            logging.debug('uuid {} first package hop {} after {:.3f}s'.format(self.uuid, hop_len, self.first_package_time - self.start_time))
+        elif self.buffered_duration() < 0:
+            self.underrun += 1
+        token2wav_cost = cost / hop_len
+        self.token2wav_cost = token2wav_cost if self.token2wav_cost is None else 0.5 * self.token2wav_cost + 0.5 * token2wav_cost
+        self.emitted_duration += hop_len / self.token_frame_rate
+        self.consumed_token += hop_len
+        self.hop_lens.append(hop_len)
+        logging.debug('uuid {} hop {} token2wav rtf {:.3f} buffered {:.3f}s'.format(
+            self.uuid, hop_len, self.token2wav_cost * self.token_frame_rate, self.buffered_duration()))
+
+    def summary(self):
+        logging.info('uuid {} adaptive hop {}, token2wav rtf {:.3f}, underrun {}'.format(
+            self.uuid, self.hop_lens, (self.token2wav_cost or 0) * self.token_frame_rate, self.underrun))
+
+
+class QualityController:
+    """Trade flow steps, cfg, hop size and llm top_k for latency when the server is overloaded.
+
+    Every request takes the knobs of the current level when it starts. The level steps down after
+    patience consecutive observations with queue depth or smoothed rtf above the high watermark, and
+    steps back up after patience consecutive observations with both below the low watermark.
+    """
+
+    # NOTE None keeps the model default, token_hop_len must be multiple of static_chunk_size
+    default_levels = [{'n_timesteps': None, 'cfg_rate': None, 'token_hop_len': 25, 'top_k': None},
+                      {'n_timesteps': 6, 'cfg_rate': None, 'token_hop_len': 50, 'top_k': 15},
+                      {'n_timesteps': 4, 'cfg_rate': 0.0, 'token_hop_len': 50, 'top_k': 10},
+                      {'n_timesteps': 2, 'cfg_rate': 0.0, 'token_hop_len': 75, 'top_k': 5}]
+
+    def __init__(self, rtf_high=0.8, rtf_low=0.4, queue_high=4, queue_low=1, patience=3, ema=0.3, levels=None):
+        assert rtf_low < rtf_high and queue_low < queue_high, 'low watermark should be lower than high watermark'
+        self.rtf_high = rtf_high
+        self.rtf_low = rtf_low
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.patience = patience
+        self.ema = ema
+        self.levels = levels if levels is not None else self.default_levels
+        self.lock = threading.Lock()
+        self.level = 0
+        self.inflight = 0
+        self.rtf = None
+        self.overload_count = 0
+        self.idle_count = 0
+        # metrics
+        self.downgrade = 0
+        self.upgrade = 0
+        self.level_count = [0] * len(self.levels)
+        self.events = []
+
+    def acquire(self):
+        """Register a new request and return the knobs it should run with."""
+        with self.lock:
+            self.inflight += 1
+            self.level_count[self.level] += 1
+            return dict(self.levels[self.level], level=self.level)
+
+    def release(self):
+        with self.lock:
+            self.inflight -= 1
+
+    def observe(self, rtf):
+        """Record the rtf of a finished hop or request and update the level."""
+        with self.lock:
+            self.rtf = rtf if self.rtf is None else (1 - self.ema) * self.rtf + self.ema * rtf
+            self._evaluate()
+
+    def _evaluate(self):
+        if self.inflight > self.queue_high or self.rtf > self.rtf_high:
+            self.overload_count, self.idle_count = self.overload_count + 1, 0
+        elif self.inflight <= self.queue_low and self.rtf < self.rtf_low:
+            self.overload_count, self.idle_count = 0, self.idle_count + 1
+        else:
+            self.overload_count, self.idle_count = 0, 0
+        if self.overload_count >= self.patience and self.level < len(self.levels) - 1:
+            self.downgrade += 1
+            self._set_level(self.level + 1)
+        elif self.idle_count >= self.patience and self.level > 0:
+            self.upgrade += 1
+            self._set_level(self.level - 1)
+
+    def _set_level(self, level):
+        logging.info('quality level {} -> {}, inflight {}, rtf {:.3f}, knobs {}'.format(self.level, level, self.inflight, self.rtf, self.levels[level]))
+        self.events.append({'time': time.time(), 'from': self.level, 'to': level, 'inflight': self.inflight, 'rtf': self.rtf})
+        self.level = level
+        self.overload_count, self.idle_count = 0, 0
+
+    def summary(self):
+        logging.info('quality level {}, downgrade {}, upgrade {}, requests per level {}'.format(
+            self.level, self.downgrade, self.upgrade, self.level_count))
 
 
 class CosyVoiceModel:
@@ -55,6 +199,8 @@ class CosyVoiceModel:
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
+        # choose hop len from measured rtf instead of stream_scale_factor
+        self.adaptive_hop = False
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
@@ -63,15 +209,29 @@ class CosyVoiceModel:
         self.mel_overlap_dict = {}
         self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.pipeline_dict = {}
+        # set when a session is dropped or fails, its llm and pipeline workers stop
+        self.cancel_dict = {}
+        self.quality_dict = {}
+        # cores and threads of llm and flow work, None keeps torch defaults
+        self.thread_budget = None
 
-    def load(self, llm_model, flow_model, hift_model):
-        self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
+    def load(self, llm_model, flow_model, hift_model, mmap=False):
+        # NOTE with mmap, cpu parameters alias the read only file mapping, so several worker processes share one copy in page cache
+        if mmap is True and self.device.type != 'cpu':
+            logging.warning('mmap weights only take effect on cpu, weights are copied to {}'.format(self.device))
+            mmap = False
+        if mmap is True:
+            load_kwargs, assign = {'map_location': 'cpu', 'mmap': True, 'weights_only': True}, True
+        else:
+            load_kwargs, assign = {'map_location': self.device}, False
+        self.llm.load_state_dict(torch.load(llm_model, **load_kwargs), strict=True, assign=assign)
         self.llm.to(self.device).eval()
-        self.flow.load_state_dict(torch.load(flow_model, map_location=self.device), strict=True)
+        self.flow.load_state_dict(torch.load(flow_model, **load_kwargs), strict=True, assign=assign)
         self.flow.to(self.device).eval()
         # in case hift_model is a hifigan model
-        hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device).items()}
-        self.hift.load_state_dict(hift_state_dict, strict=True)
+        hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, **load_kwargs).items()}
+        self.hift.load_state_dict(hift_state_dict, strict=True, assign=assign)
         self.hift.to(self.device).eval()
 
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
@@ -93,6 +253,10 @@ class CosyVoiceModel:
         assert estimator_engine is not None, 'failed to load trt {}'.format(flow_decoder_estimator_model)
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
+    def role_context(self, role):
+        """Run the with block on the cores of role, the calling thread gets its previous cores back afterwards."""
+        return self.thread_budget.enter(role) if self.thread_budget is not None else nullcontext()
+
     def get_trt_kwargs(self):
         min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
         opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
@@ -101,7 +265,10 @@ class CosyVoiceModel:
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
     def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+        # NOTE top_k is only overridden by the quality controller
+        top_k = self.quality_dict.get(uuid, {}).get('top_k')
+        llm_kwargs = {} if top_k is None else {'top_k': top_k}
+        with self.role_context('llm'), self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
             if isinstance(text, Generator):
                 assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
                 for i in self.llm.inference_bistream(text=text,
@@ -109,8 +276,10 @@ class CosyVoiceModel:
                                                      prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
                                                      prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
+                                                     embedding=llm_embedding.to(self.device),
+                                                     **llm_kwargs):
+                    if self.append_speech_token(i, uuid) is False:
+                        break
             else:
                 for i in self.llm.inference(text=text.to(self.device),
                                             text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
@@ -119,10 +288,29 @@ class CosyVoiceModel:
                                             prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                             prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
                                             embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
+                                            uuid=uuid,
+                                            **llm_kwargs):
+                    if self.append_speech_token(i, uuid) is False:
+                        break
+        if uuid in self.pipeline_dict:
+            self.pipeline_dict[uuid]['llm'] = time.time() - self.pipeline_dict[uuid]['start'] - self.pipeline_dict[uuid]['llm_blocked']
         self.llm_end_dict[uuid] = True
 
+    def append_speech_token(self, token, uuid):
+        """Append a llm token, return False when the session is cancelled and llm should stop."""
+        cancel = self.cancel_dict.get(uuid)
+        # NOTE in pipeline mode llm blocks when flow stage falls behind
+        if uuid in self.pipeline_dict:
+            start = time.time()
+            while self.pipeline_dict[uuid]['backpressure'].acquire(timeout=0.1) is False:
+                if cancel is not None and cancel.is_set():
+                    return False
+            self.pipeline_dict[uuid]['llm_blocked'] += time.time() - start
+        if cancel is not None and cancel.is_set():
+            return False
+        self.tts_speech_token_dict[uuid].append(token)
+        return True
+
     def vc_job(self, source_speech_token, uuid):
         self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
         self.llm_end_dict[uuid] = True
@@ -167,6 +355,10 @@ class CosyVoiceModel:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
 
+    def submit_token2wav(self, **kwargs):
+        with self.role_context('flow'):
+            return self.token2wav(**kwargs)
+
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
@@ -186,45 +378,56 @@ class CosyVoiceModel:
         p.start()
         if stream is True:
             token_hop_len = self.token_min_hop_len
+            scheduler = AdaptiveHopScheduler(self.token_min_hop_len, self.token_max_hop_len, 1, self.token_overlap_len,
+                                             self.flow.input_frame_rate, uuid=this_uuid) if self.adaptive_hop is True else None
             while True:
                 time.sleep(0.1)
+                if scheduler is not None:
+                    token_hop_len = scheduler.next_hop_len(len(self.tts_speech_token_dict[this_uuid]), self.llm_end_dict[this_uuid])
                 if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
                     this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
                         .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
+                    start = time.time()
+                    this_tts_speech = self.submit_token2wav(token=this_tts_speech_token,
+                                                            prompt_token=flow_prompt_speech_token,
+                                                            prompt_feat=prompt_speech_feat,
+                                                            embedding=flow_embedding,
+                                                            uuid=this_uuid,
+                                                            finalize=False)
+                    # NOTE observe before yield, the consumer's time between chunks is not synthesis time
+                    if scheduler is not None:
+                        scheduler.observe(token_hop_len, time.time() - start)
                     yield {'tts_speech': this_tts_speech.cpu()}
                     with self.lock:
                         self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    if scheduler is None:
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
                 if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
                     break
             p.join()
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
             this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
+            this_tts_speech = self.submit_token2wav(token=this_tts_speech_token,
+                                                    prompt_token=flow_prompt_speech_token,
+                                                    prompt_feat=prompt_speech_feat,
+                                                    embedding=flow_embedding,
+                                                    uuid=this_uuid,
+                                                    finalize=True)
             yield {'tts_speech': this_tts_speech.cpu()}
+            if scheduler is not None:
+                scheduler.summary()
         else:
             # deal with all tokens
             p.join()
             this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
+            this_tts_speech = self.submit_token2wav(token=this_tts_speech_token,
+                                                    prompt_token=flow_prompt_speech_token,
+                                                    prompt_feat=prompt_speech_feat,
+                                                    embedding=flow_embedding,
+                                                    uuid=this_uuid,
+                                                    finalize=True,
+                                                    speed=speed)
             yield {'tts_speech': this_tts_speech.cpu()}
         with self.lock:
             self.tts_speech_token_dict.pop(this_uuid)
@@ -254,11 +457,16 @@ class CosyVoice2Model(CosyVoiceModel):
             self.flow.half()
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
+        # adaptive hop grows in multiples of token_hop_len up to token_max_hop_len
+        self.token_max_hop_len = 4 * self.token_hop_len
+        self.adaptive_hop = False
         # hift cache
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
-        # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        # speech fade in out, keep window on device to avoid host round trip
+        self.speech_window = torch.from_numpy(np.hamming(2 * self.source_cache_len)).float().to(self.device)
+        # stateful hift session replaces hift cache and fade in out in streaming mode, disabled by default
+        self.stateful_hift = False
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
@@ -266,6 +474,19 @@ class CosyVoice2Model(CosyVoiceModel):
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.hift_cache_dict = {}
+        self.hift_session_dict = {}
+        self.pipeline_dict = {}
+        # set when a session is dropped or fails, its llm and pipeline workers stop
+        self.cancel_dict = {}
+        self.quality_dict = {}
+        # batched token2wav related, disabled by default
+        self.token2wav_queue = None
+        # pipeline parallel streaming related, 0 means flow and hift run on the consumer thread
+        self.pipeline_queue_size = 0
+        # slo driven quality controller, disabled by default
+        self.quality_controller = None
+        # cores and threads of llm and flow work, None keeps torch defaults
+        self.thread_budget = None
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
@@ -283,17 +504,31 @@ class CosyVoice2Model(CosyVoiceModel):
         del self.llm.llm.model.model.layers
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+        quality = self.quality_dict.get(uuid, {})
+        tts_mel = self.token2mel(token, prompt_token, prompt_feat, embedding, token_offset, stream=stream, finalize=finalize,
+                                 n_timesteps=quality.get('n_timesteps'), cfg_rate=quality.get('cfg_rate'))
+        return self.mel2wav(tts_mel, uuid, finalize=finalize, speed=speed)
+
+    def token2mel(self, token, prompt_token, prompt_feat, embedding, token_offset, stream=False, finalize=False, n_timesteps=None, cfg_rate=None):
         with torch.cuda.amp.autocast(self.fp16):
+            # NOTE torch.full only launches a fill kernel, torch.tensor(...).to(device) waits for a host to device copy
             tts_mel, _ = self.flow.inference(token=token.to(self.device),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                             token_len=torch.full([1], token.shape[1], dtype=torch.int32, device=self.device),
                                              prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                             prompt_token_len=torch.full([1], prompt_token.shape[1], dtype=torch.int32, device=self.device),
                                              prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                             prompt_feat_len=torch.full([1], prompt_feat.shape[1], dtype=torch.int32, device=self.device),
                                              embedding=embedding.to(self.device),
                                              streaming=stream,
-                                             finalize=finalize)
-        tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+                                             finalize=finalize,
+                                             n_timesteps=n_timesteps,
+                                             cfg_rate=cfg_rate)
+        return tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+
+    def mel2wav(self, tts_mel, uuid, finalize=False, speed=1.0):
+        # NOTE stateful session only computes new mel frames, no mel cache and no fade in out
+        if uuid in self.hift_session_dict:
+            return self.hift_session_dict[uuid](tts_mel, finalize=finalize)
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
@@ -318,6 +553,285 @@ class CosyVoice2Model(CosyVoiceModel):
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
 
+    def token2wav_batch(self, requests):
+        """Run token2wav for chunks of several sessions as one padded batch.
+
+        Every request is a dict holding the keyword arguments of token2wav, flow runs as one
+        masked batch, hift runs batched over chunks with the same mel and cache length.
+        Session state is only updated in the last loop, one request at a time, a request
+        failing there gets its exception in place of its speech, the others are kept.
+        """
+        # flow sessions must share streaming mode and quality knobs, mixed requests are split into several batches
+        for i in requests:
+            i.setdefault('stream', False)
+            i.setdefault('finalize', False)
+            i.setdefault('speed', 1.0)
+        flow_groups = {}
+        for i in requests:
+            quality = self.quality_dict.get(i['uuid'], {})
+            flow_groups.setdefault((i['stream'], quality.get('n_timesteps'), quality.get('cfg_rate')), []).append(i)
+        for (stream, n_timesteps, cfg_rate), this_requests in flow_groups.items():
+            token = [i['token'].squeeze(dim=0) for i in this_requests]
+            prompt_token = [i['prompt_token'].squeeze(dim=0) for i in this_requests]
+            prompt_feat = [i['prompt_feat'].squeeze(dim=0) for i in this_requests]
+            with torch.cuda.amp.autocast(self.fp16):
+                tts_mels = self.flow.inference_batch(
+                    token=pad_sequence(token, batch_first=True, padding_value=0).to(self.device),
+                    token_len=torch.tensor([len(i) for i in token], dtype=torch.int32),
+                    prompt_token=pad_sequence(prompt_token, batch_first=True, padding_value=0).to(self.device),
+                    prompt_token_len=torch.tensor([len(i) for i in prompt_token], dtype=torch.int32),
+                    prompt_feat=pad_sequence(prompt_feat, batch_first=True, padding_value=0).to(self.device),
+                    prompt_feat_len=torch.tensor([len(i) for i in prompt_feat], dtype=torch.int32),
+                    embedding=torch.concat([i['embedding'] for i in this_requests], dim=0).to(self.device),
+                    streaming=stream,
+                    finalize=[i['finalize'] for i in this_requests],
+                    n_timesteps=n_timesteps,
+                    cfg_rate=cfg_rate)
+            for i, tts_mel in zip(this_requests, tts_mels):
+                i['tts_mel'] = tts_mel
+        for i in requests:
+            tts_mel, this_uuid = i.pop('tts_mel')[:, :, i['token_offset'] * self.flow.token_mel_ratio:], i['uuid']
+            # stateful hift sessions carry their own state, they run one by one in the last loop
+            if this_uuid in self.hift_session_dict:
+                i['tts_mel'] = tts_mel
+                continue
+            # append hift cache
+            if self.hift_cache_dict[this_uuid] is not None:
+                hift_cache_mel, hift_cache_source = self.hift_cache_dict[this_uuid]['mel'], self.hift_cache_dict[this_uuid]['source']
+                tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
+            else:
+                hift_cache_source = torch.zeros(1, 1, 0)
+            if i['finalize'] is True and i['speed'] != 1.0:
+                assert self.hift_cache_dict[this_uuid] is None, 'speed change only support non-stream inference mode'
+                tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / i['speed']), mode='linear')
+            i['tts_mel'], i['hift_cache_source'] = tts_mel, hift_cache_source
+        # NOTE hift is not causal, only chunks with the same length are batched to keep the output unchanged
+        groups = {}
+        for i in requests:
+            if i['uuid'] in self.hift_session_dict:
+                continue
+            groups.setdefault((i['tts_mel'].shape[2], i['hift_cache_source'].shape[2]), []).append(i)
+        for this_requests in groups.values():
+            tts_speech, tts_source = self.hift.inference(speech_feat=torch.concat([i['tts_mel'] for i in this_requests], dim=0),
+                                                         cache_source=torch.concat([i['hift_cache_source'] for i in this_requests], dim=0))
+            for j, i in enumerate(this_requests):
+                i['tts_speech'], i['tts_source'] = tts_speech[j:j + 1], tts_source[j:j + 1]
+        tts_speechs = []
+        for i in requests:
+            this_uuid = i['uuid']
+            try:
+                if this_uuid in self.hift_session_dict:
+                    tts_speechs.append(self.hift_session_dict[this_uuid](i.pop('tts_mel'), finalize=i['finalize']))
+                    continue
+                tts_mel, tts_speech, tts_source = i.pop('tts_mel'), i.pop('tts_speech'), i.pop('tts_source')
+                i.pop('hift_cache_source')
+                if self.hift_cache_dict[this_uuid] is not None:
+                    tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[this_uuid]['speech'], self.speech_window)
+                # keep overlap mel and hift cache
+                if i['finalize'] is False:
+                    self.hift_cache_dict[this_uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                                       'source': tts_source[:, :, -self.source_cache_len:],
+                                                       'speech': tts_speech[:, -self.source_cache_len:]}
+                    tts_speech = tts_speech[:, :-self.source_cache_len]
+                tts_speechs.append(tts_speech)
+            except Exception as e:
+                tts_speechs.append(e)
+        return tts_speechs
+
+    def start_token2wav_worker(self, max_batch_size=8, max_wait=0.01):
+        """Gather ready chunks of all sessions and run them with token2wav_batch."""
+        assert isinstance(self.flow.decoder.estimator, torch.nn.Module), 'batched token2wav does not support trt estimator!'
+        assert self.token2wav_queue is None, 'token2wav worker is already started!'
+        self.token2wav_queue = queue.Queue()
+        threading.Thread(target=self.token2wav_job, args=(max_batch_size, max_wait), daemon=True).start()
+
+    def token2wav_job(self, max_batch_size, max_wait):
+        # NOTE dedicated worker thread, it stays on the flow cores
+        with self.role_context('flow'):
+            self.token2wav_loop(max_batch_size, max_wait)
+
+    def token2wav_loop(self, max_batch_size, max_wait):
+        while True:
+            requests = [self.token2wav_queue.get()]
+            deadline = time.time() + max_wait
+            while len(requests) < max_batch_size:
+                try:
+                    requests.append(self.token2wav_queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                # NOTE token2wav_batch adds temporary keys, keep the original kwargs for the retry below
+                tts_speechs = self.token2wav_batch([dict(i['kwargs']) for i in requests])
+            except Exception as e:
+                # NOTE nothing is committed before the last loop of token2wav_batch, so one bad
+                #   session can not fail the other streams, retry every request on its own
+                logging.error('batched token2wav failed, retry {} requests one by one, {}'.format(len(requests), e))
+                tts_speechs = []
+                for i in requests:
+                    try:
+                        tts_speechs.append(self.token2wav(**i['kwargs']))
+                    except Exception as ex:
+                        tts_speechs.append(ex)
+            for i, tts_speech in zip(requests, tts_speechs):
+                if isinstance(tts_speech, Exception):
+                    logging.error('token2wav of {} failed, {}'.format(i['kwargs']['uuid'], tts_speech))
+                    i['error'] = tts_speech
+                else:
+                    i['tts_speech'] = tts_speech
+                i['event'].set()
+
+    def get_hop_scheduler(self, uuid):
+        if self.adaptive_hop is False:
+            return None
+        # NOTE hop len must be multiple of static_chunk_size, which equals token_hop_len
+        return AdaptiveHopScheduler(self.token_hop_len, self.token_max_hop_len, self.token_hop_len, self.flow.pre_lookahead_len,
+                                    self.flow.input_frame_rate, uuid=uuid)
+
+    def get_token_hop_len(self, scheduler, token_offset, prompt_token_pad, uuid):
+        if token_offset == 0:
+            return self.token_hop_len + prompt_token_pad
+        if scheduler is not None:
+            return scheduler.next_hop_len(len(self.tts_speech_token_dict[uuid]) - token_offset, self.llm_end_dict[uuid])
+        # NOTE first hop keeps token_hop_len for first package latency, quality controller only enlarges later hops
+        return self.quality_dict.get(uuid, {}).get('token_hop_len', self.token_hop_len)
+
+    def observe_quality(self, uuid, token_len, cost):
+        """Report the rtf of token_len tokens vocoded in cost seconds to the quality controller."""
+        if self.quality_controller is not None and uuid in self.quality_dict and token_len > 0:
+            self.quality_controller.observe(cost / (token_len / self.flow.input_frame_rate))
+
+    def start_pipeline(self, queue_size=2):
+        """Run flow and hift of streaming sessions on separate workers connected by bounded queues."""
+        assert self.token2wav_queue is None, 'pipeline parallel streaming does not support batched token2wav!'
+        self.pipeline_queue_size = queue_size
+
+    @staticmethod
+    def stage_put(stage_queue, item, cancel):
+        """Put on a bounded stage queue, give up when the session is cancelled."""
+        while cancel.is_set() is False:
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def stage_get(stage_queue, cancel):
+        """Get from a bounded stage queue, None when the session is cancelled."""
+        while cancel.is_set() is False:
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def flow_stage(self, prompt_token, prompt_feat, embedding, uuid, mel_queue):
+        pipeline, cancel = self.pipeline_dict[uuid], self.cancel_dict[uuid]
+        try:
+            token_offset, token_buffer, scheduler = 0, DeviceTokenBuffer(self.device), self.get_hop_scheduler(uuid)
+            quality = self.quality_dict.get(uuid, {})
+            prompt_token_pad = int(np.ceil(prompt_token.shape[1] / self.token_hop_len) * self.token_hop_len - prompt_token.shape[1])
+            while True:
+                if cancel.is_set():
+                    return
+                this_token_hop_len = self.get_token_hop_len(scheduler, token_offset, prompt_token_pad, uuid)
+                if len(self.tts_speech_token_dict[uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                    this_tts_speech_token = token_buffer(self.tts_speech_token_dict[uuid], token_offset + this_token_hop_len + self.flow.pre_lookahead_len)
+                    start = time.time()
+                    with self.role_context('flow'):
+                        tts_mel = self.token2mel(this_tts_speech_token, prompt_token, prompt_feat, embedding, token_offset, stream=True, finalize=False,
+                                                 n_timesteps=quality.get('n_timesteps'), cfg_rate=quality.get('cfg_rate'))
+                    pipeline['flow'] += time.time() - start
+                    self.observe_quality(uuid, this_token_hop_len, time.time() - start)
+                    # NOTE flow is the heavier stage, its cost drives the scheduler in pipeline mode
+                    if scheduler is not None:
+                        scheduler.observe(this_token_hop_len, time.time() - start)
+                    token_offset += this_token_hop_len
+                    for _ in range(this_token_hop_len):
+                        pipeline['backpressure'].release()
+                    start = time.time()
+                    if self.stage_put(mel_queue, (tts_mel, False), cancel) is False:
+                        return
+                    pipeline['flow_blocked'] += time.time() - start
+                elif self.llm_end_dict[uuid] is True:
+                    break
+                else:
+                    time.sleep(0.01)
+            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+            this_tts_speech_token = token_buffer(self.tts_speech_token_dict[uuid], len(self.tts_speech_token_dict[uuid]))
+            start = time.time()
+            with self.role_context('flow'):
+                tts_mel = self.token2mel(this_tts_speech_token, prompt_token, prompt_feat, embedding, token_offset, finalize=True,
+                                         n_timesteps=quality.get('n_timesteps'), cfg_rate=quality.get('cfg_rate'))
+            pipeline['flow'] += time.time() - start
+            if self.stage_put(mel_queue, (tts_mel, True), cancel) is False:
+                return
+            if scheduler is not None:
+                scheduler.summary()
+        except Exception as e:
+            self.stage_put(mel_queue, (e, True), cancel)
+
+    def hift_stage(self, uuid, mel_queue, speech_queue):
+        pipeline, cancel = self.pipeline_dict[uuid], self.cancel_dict[uuid]
+        finalize = False
+        while finalize is False:
+            item = self.stage_get(mel_queue, cancel)
+            if item is None:
+                break
+            tts_mel, finalize = item
+            if isinstance(tts_mel, Exception):
+                self.stage_put(speech_queue, (tts_mel, True), cancel)
+                break
+            try:
+                start = time.time()
+                with self.role_context('flow'):
+                    tts_speech = to_host(self.mel2wav(tts_mel, uuid, finalize=finalize))
+                pipeline['hift'] += time.time() - start
+            except Exception as e:
+                self.stage_put(speech_queue, (e, True), cancel)
+                break
+            if self.stage_put(speech_queue, (tts_speech, finalize), cancel) is False:
+                break
+
+    def pipeline_job(self, prompt_token, prompt_feat, embedding, uuid):
+        mel_queue, speech_queue = queue.Queue(self.pipeline_queue_size), queue.Queue(self.pipeline_queue_size)
+        flow_thread = threading.Thread(target=self.flow_stage, args=(prompt_token, prompt_feat, embedding, uuid, mel_queue))
+        hift_thread = threading.Thread(target=self.hift_stage, args=(uuid, mel_queue, speech_queue))
+        flow_thread.start()
+        hift_thread.start()
+        pipeline, done = self.pipeline_dict[uuid], False
+        try:
+            finalize = False
+            while finalize is False:
+                tts_speech, finalize = speech_queue.get()
+                if isinstance(tts_speech, Exception):
+                    raise tts_speech
+                yield {'tts_speech': tts_speech}
+            done = True
+        finally:
+            # NOTE a stage error or a dropped consumer must not leave llm or the stages parked on the semaphore or queues
+            if done is False:
+                self.cancel_dict[uuid].set()
+                pipeline['backpressure'].release()
+            flow_thread.join()
+            hift_thread.join()
+        total = time.time() - pipeline['start']
+        logging.info('pipeline occupancy llm {:.2f} flow {:.2f} hift {:.2f}, llm blocked {:.2f} flow blocked {:.2f}, total {:.3f}s'.format(
+            pipeline['llm'] / total, pipeline['flow'] / total, pipeline['hift'] / total,
+            pipeline['llm_blocked'] / total, pipeline['flow_blocked'] / total, total))
+
+    def submit_token2wav(self, **kwargs):
+        if self.token2wav_queue is None:
+            with self.role_context('flow'):
+                return self.token2wav(**kwargs)
+        request = {'kwargs': kwargs, 'event': threading.Event()}
+        self.token2wav_queue.put(request)
+        request['event'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['tts_speech']
+
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
@@ -328,59 +842,94 @@ class CosyVoice2Model(CosyVoiceModel):
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
             self.hift_cache_dict[this_uuid] = None
+            self.cancel_dict[this_uuid] = threading.Event()
+            if stream is True and self.stateful_hift is True:
+                self.hift_session_dict[this_uuid] = HiFTStreamSession(self.hift)
+            if self.quality_controller is not None:
+                self.quality_dict[this_uuid] = self.quality_controller.acquire()
+            if stream is True and self.pipeline_queue_size > 0:
+                # NOTE flow consumes token_hop_len tokens per chunk, llm may run at most a few chunks ahead
+                max_hop_len = self.token_max_hop_len if self.adaptive_hop is True or self.quality_controller is not None else self.token_hop_len
+                self.pipeline_dict[this_uuid] = {'backpressure': threading.Semaphore((self.pipeline_queue_size + 2) * max_hop_len + self.flow.pre_lookahead_len),
+                                                 'start': time.time(), 'llm': 0.0, 'llm_blocked': 0.0, 'flow': 0.0, 'flow_blocked': 0.0, 'hift': 0.0}
         if source_speech_token.shape[1] == 0:
             p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
+        try:
+            # NOTE move prompt to device once, instead of every hop
+            flow_prompt_speech_token, prompt_speech_feat, flow_embedding = \
+                flow_prompt_speech_token.to(self.device), prompt_speech_feat.to(self.device), flow_embedding.to(self.device)
+            if this_uuid in self.pipeline_dict:
+                for i in self.pipeline_job(flow_prompt_speech_token, prompt_speech_feat, flow_embedding, this_uuid):
+                    yield i
+                p.join()
+            elif stream is True:
+                token_offset, token_buffer, scheduler = 0, DeviceTokenBuffer(self.device), self.get_hop_scheduler(this_uuid)
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                while True:
+                    time.sleep(0.1)
+                    this_token_hop_len = self.get_token_hop_len(scheduler, token_offset, prompt_token_pad, this_uuid)
+                    if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        this_tts_speech_token = token_buffer(self.tts_speech_token_dict[this_uuid], token_offset + this_token_hop_len + self.flow.pre_lookahead_len)
+                        start = time.time()
+                        this_tts_speech = self.submit_token2wav(token=this_tts_speech_token,
+                                                                prompt_token=flow_prompt_speech_token,
+                                                                prompt_feat=prompt_speech_feat,
+                                                                embedding=flow_embedding,
+                                                                token_offset=token_offset,
+                                                                uuid=this_uuid,
+                                                                stream=stream,
+                                                                finalize=False)
+                        if scheduler is not None:
+                            scheduler.observe(this_token_hop_len, time.time() - start)
+                        self.observe_quality(this_uuid, this_token_hop_len, time.time() - start)
+                        token_offset += this_token_hop_len
+                        yield {'tts_speech': to_host(this_tts_speech)}
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = token_buffer(self.tts_speech_token_dict[this_uuid], len(self.tts_speech_token_dict[this_uuid]))
+                this_tts_speech = self.submit_token2wav(token=this_tts_speech_token,
+                                                        prompt_token=flow_prompt_speech_token,
+                                                        prompt_feat=prompt_speech_feat,
+                                                        embedding=flow_embedding,
+                                                        token_offset=token_offset,
+                                                        uuid=this_uuid,
+                                                        finalize=True)
+                yield {'tts_speech': to_host(this_tts_speech)}
+                if scheduler is not None:
+                    scheduler.summary()
+            else:
+                # deal with all tokens
+                p.join()
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                start = time.time()
+                this_tts_speech = self.submit_token2wav(token=this_tts_speech_token,
+                                                        prompt_token=flow_prompt_speech_token,
+                                                        prompt_feat=prompt_speech_feat,
+                                                        embedding=flow_embedding,
+                                                        token_offset=0,
+                                                        uuid=this_uuid,
+                                                        finalize=True,
+                                                        speed=speed)
+                self.observe_quality(this_uuid, this_tts_speech_token.shape[1], time.time() - start)
+                yield {'tts_speech': to_host(this_tts_speech)}
+        finally:
+            # NOTE errors and dropped consumers end up here too, leaked sessions would keep the quality controller overloaded
+            self.cancel_dict[this_uuid].set()
             p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+            with self.lock:
+                self.tts_speech_token_dict.pop(this_uuid)
+                self.llm_end_dict.pop(this_uuid)
+                self.hift_cache_dict.pop(this_uuid)
+                self.hift_session_dict.pop(this_uuid, None)
+                self.pipeline_dict.pop(this_uuid, None)
+                self.cancel_dict.pop(this_uuid)
+                if self.quality_dict.pop(this_uuid, None) is not None:
+                    self.quality_controller.release()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
 import random
 import math
 from functools import partial
@@ -21,6 +22,7 @@ import torch
 import torch.distributed as dist
 from torch.utils.data import IterableDataset
 from cosyvoice.utils.file_utils import read_lists
+from cosyvoice.dataset.processor import AUDIO_STAGES, load_features, load_ref_logps, length_index, compute_bucket_boundaries, timed_stage, stage_time
 
 
 class Processor(IterableDataset):
@@ -128,7 +130,13 @@ def Dataset(data_list_file,
             gan=False,
             dpo=False,
             shuffle=True,
-            partition=True):
+            partition=True,
+            columns=None,
+            audio_free=False,
+            feature_dir=None,
+            ref_logps=False,
+            ref_logp_dir=None,
+            profile=False):
     """ Construct dataset from arguments
 
         We have two shuffle stage in the Dataset. The first is global
@@ -139,13 +147,45 @@ def Dataset(data_list_file,
             data_type(str): raw/shard
             tokenizer (BaseTokenizer): tokenizer to tokenize
             partition(bool): whether to do data partition in terms of rank
+            columns(List[str] or str): parquet columns to read, None reads all
+            audio_free(bool): drop the stages which decode audio, for llm training
+            feature_dir(str): read features precomputed by extract_features
+            ref_logps(bool): read dpo reference log-probs precomputed by compute_ref_logps
+            ref_logp_dir(str): dir of the reference log-probs, None reads them next to the parquet files
+            profile(bool): time every stage, batches carry the per stage time in stage_time
     """
     lists = read_lists(data_list_file)
     dataset = DataList(lists,
                        shuffle=shuffle,
                        partition=partition)
+    if audio_free is True:
+        assert gan is False, 'gan training needs audio'
+        data_pipeline = [func for func in data_pipeline if getattr(func, 'func', func).__name__ not in AUDIO_STAGES]
+    names = [getattr(func, 'func', func).__name__ for func in data_pipeline]
+    if 'batch' in names and getattr(data_pipeline[names.index('batch')], 'keywords', {}).get('batch_type') == 'bucket':
+        # NOTE bucket boundaries come from the lengths of the whole data list, the local sort buffer is no longer needed
+        index = length_index(lists, cache_file='{}.lengths.json'.format(data_list_file))
+        boundaries = compute_bucket_boundaries(index, data_pipeline[names.index('batch')].keywords.get('num_buckets', 50))
+        logging.info('bucket boundaries {} over {} utts of {} files'.format(boundaries, sum(len(i) for i in index.values()), len(index)))
+        data_pipeline = [partial(func, bucket_boundaries=boundaries) if name == 'batch' else func
+                         for func, name in zip(data_pipeline, names) if name != 'sort']
+    if feature_dir is not None:
+        data_pipeline = data_pipeline[:1] + [partial(load_features, feature_dir=feature_dir, keep_audio=gan)] + data_pipeline[1:]
+    if ref_logps is True:
+        assert dpo is True, 'reference log-probs are only used in dpo training'
+        # NOTE the record rides along with the sample, padding checks its hash against the final speech tokens
+        stage = 2 if feature_dir is not None else 1
+        data_pipeline = data_pipeline[:stage] + [partial(load_ref_logps, logp_dir=ref_logp_dir)] + data_pipeline[stage:]
     # map partial arg to padding func
     data_pipeline[-1] = partial(data_pipeline[-1], gan=gan, dpo=dpo)
+    # map column projection to parquet_opener
+    if columns is not None and getattr(data_pipeline[0], 'func', data_pipeline[0]).__name__ == 'parquet_opener':
+        data_pipeline[0] = partial(data_pipeline[0], columns=columns)
+    if profile is True:
+        # NOTE stats live in each dataloader worker, batches carry the deltas to the trainer
+        stats, names = {}, [getattr(func, 'func', func).__name__ for func in data_pipeline]
+        data_pipeline = [partial(timed_stage, stage=func, name=name, stats=stats) for func, name in zip(data_pipeline, names)] + \
+            [partial(stage_time, stats=stats, names=names)]
     for func in data_pipeline:
         dataset = Processor(dataset, func, mode=mode)
     return dataset
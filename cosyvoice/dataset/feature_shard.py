@@ -0,0 +1,103 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+# variable length features are concatenated along the first axis, index keeps per utt offsets
+RAGGED_KEYS = ['speech_feat', 'pitch_feat', 'speech_token']
+FIXED_KEYS = ['utt_embedding', 'spk_embedding']
+
+
+def shard_dir(feature_dir, src):
+    """ One feature shard dir per source parquet file """
+    src = os.path.abspath(src)
+    return os.path.join(feature_dir, '{}_{}'.format(os.path.splitext(os.path.basename(src))[0], hashlib.sha1(src.encode()).hexdigest()[:8]))
+
+
+def content_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_index(path):
+    try:
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_shard(path, index, arrays):
+    """ Write arrays as .npy files next to index.json, into a tmp dir renamed at the end,
+        so a killed job never leaves a half written shard behind
+    """
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for key, value in arrays.items():
+        np.save(os.path.join(tmp_path, '{}.npy'.format(key)), value)
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+class FeatureShard:
+    """ Memory mapped view of one feature shard, arrays are paged in on access """
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self.hop_size = index['hop_size']
+        self.rows = {utt: i for i, utt in enumerate(index['utts'])}
+        self.arrays = {key: np.load(os.path.join(path, '{}.npy'.format(key)), mmap_mode='r') for key in index['keys']}
+
+    @classmethod
+    def open(cls, feature_dir, src):
+        """ Return the shard of src, or None when it is missing or stale """
+        path = shard_dir(feature_dir, src)
+        index = read_index(path)
+        if index is None:
+            logging.warning('no feature shard for {}, compute features on the fly'.format(src))
+            return None
+        # NOTE content hash is checked by extract_features, size is a cheap staleness check at train time
+        if os.path.getsize(src) != index['source_size']:
+            logging.warning('feature shard {} is stale for {}, compute features on the fly'.format(path, src))
+            return None
+        return cls(path, index)
+
+    def __contains__(self, utt):
+        return utt in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, utt):
+        i, sample = self.rows[utt], {}
+        for key, array in self.arrays.items():
+            if key in RAGGED_KEYS:
+                offsets = self.index['offsets'][key]
+                sample[key] = np.array(array[offsets[i]: offsets[i + 1]])
+            else:
+                sample[key] = np.array(array[i])
+        sample['duration'] = self.index['duration'][i]
+        return sample
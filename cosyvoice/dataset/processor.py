@@ -11,49 +11,173 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bisect
+import json
 import logging
+import os
 import random
+import time
 
+import pyarrow as pa
 import pyarrow.parquet as pq
 from io import BytesIO
+import numpy as np
 import torch
 import torchaudio
 from torch.nn.utils.rnn import pad_sequence
 import torch.nn.functional as F
 import pyworld as pw
 
+from cosyvoice.dataset.feature_shard import FeatureShard
+from cosyvoice.dataset.ref_logps import RefLogps, token_hash
+
 
 AUDIO_FORMAT_SETS = {'flac', 'mp3', 'm4a', 'ogg', 'opus', 'wav', 'wma'}
 
 
-def parquet_opener(data, mode='train', tts_data={}):
+# columns read by each training stage, shards may hold more, e.g. wav path or spk
+PARQUET_COLUMNS = {
+    # NOTE duration is optional metadata written at shard creation, filter checks it before decoding audio
+    'llm': ['utt', 'text', 'duration', 'audio_data', 'speech_token', 'utt_embedding', 'spk_embedding', 'instruct'],
+    'flow': ['utt', 'text', 'duration', 'audio_data', 'speech_token', 'utt_embedding', 'spk_embedding'],
+    'dpo': ['utt', 'text', 'duration', 'audio_data', 'speech_token', 'reject_speech_token', 'utt_embedding', 'spk_embedding', 'instruct'],
+    # NOTE audio free llm training never reads audio bytes
+    'llm_audio_free': ['utt', 'text', 'duration', 'speech_token', 'utt_embedding', 'spk_embedding', 'instruct'],
+}
+
+# stages which need decoded speech, dropped from the pipeline in audio free mode
+AUDIO_STAGES = {'resample', 'truncate', 'compute_fbank', 'compute_f0'}
+
+# speech token frame rate of all released speech tokenizers
+SPEECH_TOKEN_RATE = 25
+
+
+def _arrow_column_rows(column):
+    """ Split an arrow column into per row python values without copying the payload.
+        binary -> memoryview of the arrow buffer
+        list of numbers -> read only numpy view
+        others -> python objects
+    """
+    if column.null_count == 0 and (pa.types.is_binary(column.type) or pa.types.is_large_binary(column.type)):
+        offsets = column.offsets.to_numpy()
+        data = memoryview(column.buffers()[2])
+        return [data[offsets[i]: offsets[i + 1]] for i in range(len(column))]
+    if column.null_count == 0 and (pa.types.is_list(column.type) or pa.types.is_large_list(column.type)) and \
+            (pa.types.is_integer(column.type.value_type) or pa.types.is_floating(column.type.value_type)) and column.values.null_count == 0:
+        offsets = column.offsets.to_numpy()
+        values = column.values.to_numpy(zero_copy_only=True)
+        return [values[offsets[i]: offsets[i + 1]] for i in range(len(column))]
+    return column.to_pylist()
+
+
+def decode_speech(sample):
+    """ Decode audio_data into speech and sample_rate on first use
+        Inplace operation.
+    """
+    if 'speech' not in sample:
+        sample['speech'], sample['sample_rate'] = torchaudio.load(BytesIO(sample['audio_data']))
+        sample['speech'] = sample['speech'].mean(dim=0, keepdim=True)
+        del sample['audio_data']
+    return sample
+
+
+def feat_length(sample):
+    """ Length used to sort and batch samples, speech_feat frames when
+        present, otherwise the llm sequence length of audio free samples
+    """
+    if 'speech_feat' in sample:
+        return sample['speech_feat'].size(0)
+    return len(sample['text_token']) + len(sample['speech_token'])
+
+
+def parquet_opener(data, mode='train', tts_data={}, columns=None, batch_size=64):
     """ Give url or local file, return file descriptor
         Inplace operation.
 
         Args:
             data(Iterable[str]): url or local file list
+            columns(List[str] or str): columns to read, or a key of PARQUET_COLUMNS, None reads all
 
         Returns:
             Iterable[{src, stream}]
     """
+    if isinstance(columns, str):
+        columns = PARQUET_COLUMNS[columns]
     for sample in data:
         assert 'src' in sample
         url = sample['src']
         try:
-            for df in pq.ParquetFile(url).iter_batches(batch_size=64):
-                df = df.to_pandas()
-                for i in range(len(df)):
-                    sample.update(dict(df.loc[i]))
+            parquet_file = pq.ParquetFile(url)
+            this_columns = None if columns is None else [i for i in columns if i in parquet_file.schema_arrow.names]
+            # NOTE walk arrow record batches column by column, no pandas conversion and no per row copy of audio bytes or tokens
+            for record_batch in parquet_file.iter_batches(batch_size=batch_size, columns=this_columns):
+                names = record_batch.schema.names
+                rows = [_arrow_column_rows(record_batch.column(i)) for i in range(len(names))]
+                for i in range(record_batch.num_rows):
+                    sample.update({name: row[i] for name, row in zip(names, rows)})
                     if mode == 'train':
                         # NOTE do not return sample directly, must initialize a new dict
                         yield {**sample}
                     else:
-                        for index, text in enumerate(tts_data[df.loc[i, 'utt']]):
+                        for index, text in enumerate(tts_data[sample['utt']]):
                             yield {**sample, 'tts_index': index, 'tts_text': text}
         except Exception as ex:
             logging.warning('Failed to open {}, ex info {}'.format(url, ex))
 
 
+def load_features(data, feature_dir, keep_audio=False, mode='train'):
+    """ Read speech_feat, pitch_feat, speech_token and embeddings precomputed
+        by cosyvoice/bin/extract_features.py, must follow parquet_opener.
+        Utterances without a valid feature shard are passed through and
+        computed on the fly.
+        Inplace operation.
+
+        Args:
+            data: Iterable[{src, utt, audio_data, ...}]
+            feature_dir: output dir of extract_features
+            keep_audio: keep audio_data, gan training still needs speech
+
+        Returns:
+            Iterable[{src, utt, speech_feat, duration, ...}]
+    """
+    src, shard = None, None
+    for sample in data:
+        # NOTE samples of one parquet file are contiguous here, keep only its shard open
+        if sample['src'] != src:
+            src, shard = sample['src'], FeatureShard.open(feature_dir, sample['src'])
+        if shard is not None and sample['utt'] in shard:
+            for key, value in shard.get(sample['utt']).items():
+                sample[key] = torch.from_numpy(value) if key in ['speech_feat', 'pitch_feat'] else value
+            sample['feat_hop_size'] = shard.hop_size
+            if keep_audio is False:
+                sample.pop('audio_data', None)
+        yield sample
+
+
+def load_ref_logps(data, logp_dir=None, mode='train'):
+    """ Attach reference log-probs precomputed by cosyvoice/bin/compute_ref_logps.py,
+        must follow parquet_opener. The record is only used by padding when the token
+        hash of the final sample matches, stages like compute_fbank may trim speech_token.
+        Utterances without a valid cached value fall back to ref_model.
+        Inplace operation.
+
+        Args:
+            data: Iterable[{src, utt, text, speech_token, reject_speech_token, ...}]
+            logp_dir: output dir of compute_ref_logps, None reads the files next to the parquet files
+
+        Returns:
+            Iterable[{src, utt, ref_logps, ...}]
+    """
+    src, ref_logps = None, None
+    for sample in data:
+        if sample['src'] != src:
+            src, ref_logps = sample['src'], RefLogps.open(sample['src'], logp_dir)
+        record = ref_logps.get(sample['utt']) if ref_logps is not None else None
+        if record is not None:
+            sample['ref_logps'] = record
+        yield sample
+
+
 def filter(data,
            max_length=10240,
            min_length=10,
@@ -63,7 +187,8 @@ def filter(data,
            max_output_input_ratio=1,
            mode='train'):
     """ Filter sample according to feature and label length
-        Inplace operation.
+        Inplace operation. Token lengths and the duration column are checked
+        before any audio decode, audio is only decoded when duration is missing.
 
         Args::
             data: Iterable[{key, wav, label, sample_rate}]
@@ -83,15 +208,6 @@ def filter(data,
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
-        sample['speech'], sample['sample_rate'] = torchaudio.load(BytesIO(sample['audio_data']))
-        sample['speech'] = sample['speech'].mean(dim=0, keepdim=True)
-        del sample['audio_data']
-        # sample['wav'] is torch.Tensor, we have 100 frames every second
-        num_frames = sample['speech'].size(1) / sample['sample_rate'] * 100
-        if num_frames < min_length:
-            continue
-        if num_frames > max_length:
-            continue
         if len(sample['text_token']) < token_min_length:
             continue
         if len(sample['text_token']) > token_max_length:
@@ -100,6 +216,19 @@ def filter(data,
             continue
         if 'reject_speech_token' in sample and len(sample['reject_speech_token']) == 0:
             continue
+        # we have 100 frames every second
+        if sample.get('duration') is not None:
+            num_frames = sample['duration'] * 100
+        elif 'audio_data' in sample or 'speech' in sample:
+            decode_speech(sample)
+            num_frames = sample['speech'].size(1) / sample['sample_rate'] * 100
+        else:
+            # NOTE audio free sample without duration, estimate it from speech token
+            num_frames = len(sample['speech_token']) / SPEECH_TOKEN_RATE * 100
+        if num_frames < min_length:
+            continue
+        if num_frames > max_length:
+            continue
         if num_frames != 0:
             if len(sample['text_token']) / num_frames < min_output_input_ratio:
                 continue
@@ -120,8 +249,11 @@ def resample(data, resample_rate=22050, min_sample_rate=16000, mode='train'):
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
-        assert 'sample_rate' in sample
-        assert 'speech' in sample
+        if 'speech' not in sample and 'audio_data' not in sample:
+            # NOTE features are precomputed and audio is not read
+            yield sample
+            continue
+        decode_speech(sample)
         sample_rate = sample['sample_rate']
         waveform = sample['speech']
         if sample_rate != resample_rate:
@@ -147,11 +279,22 @@ def truncate(data, truncate_length=24576, mode='train'):
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
-        waveform = sample['speech']
-        if waveform.shape[1] > truncate_length:
+        waveform = decode_speech(sample)['speech']
+        if 'speech_feat' in sample and sample.get('feat_hop_size') is not None and waveform.shape[1] > truncate_length:
+            # NOTE precomputed features, crop waveform and features at the same hop aligned offset
+            hop_size, num_frames = sample['feat_hop_size'], truncate_length // sample['feat_hop_size']
+            start = random.randint(0, max(min(waveform.shape[1] - truncate_length, hop_size * (sample['speech_feat'].shape[0] - num_frames)), 0) // hop_size)
+            waveform = waveform[:, start * hop_size: start * hop_size + truncate_length]
+            for key in ['speech_feat', 'pitch_feat']:
+                if key in sample:
+                    sample[key] = sample[key][start: start + num_frames]
+        elif waveform.shape[1] > truncate_length:
             start = random.randint(0, waveform.shape[1] - truncate_length)
             waveform = waveform[:, start: start + truncate_length]
         else:
+            # NOTE padded waveform does not match precomputed features, recompute them
+            sample.pop('speech_feat', None)
+            sample.pop('pitch_feat', None)
             waveform = torch.concat([waveform, torch.zeros(1, truncate_length - waveform.shape[1])], dim=1)
         sample['speech'] = waveform
         yield sample
@@ -170,12 +313,14 @@ def compute_fbank(data,
             Iterable[{key, feat, label}]
     """
     for sample in data:
-        assert 'sample_rate' in sample
-        assert 'speech' in sample
         assert 'utt' in sample
         assert 'text_token' in sample
-        waveform = sample['speech']
-        feat = feat_extractor(waveform).squeeze(dim=0).transpose(0, 1)
+        if 'speech_feat' in sample:
+            # NOTE precomputed by extract_features, only align it with speech_token
+            feat = sample['speech_feat']
+        else:
+            waveform = decode_speech(sample)['speech']
+            feat = feat_extractor(waveform).squeeze(dim=0).transpose(0, 1)
         if token_mel_ratio != 0:
             # trim to align speech_token and speech_feat
             token_len = int(min(feat.shape[0] / token_mel_ratio, sample["speech_token"].shape[0]))
@@ -185,6 +330,17 @@ def compute_fbank(data,
         yield sample
 
 
+def extract_f0(waveform, sample_rate, hop_size, num_frames):
+    """ Harvest f0 of a (1, T) waveform, interpolated to num_frames """
+    frame_period = hop_size * 1000 / sample_rate
+    waveform = waveform.squeeze(dim=0).numpy().astype('double')
+    _f0, t = pw.harvest(waveform, sample_rate, frame_period=frame_period)
+    if sum(_f0 != 0) < 5:  # this happens when the algorithm fails
+        _f0, t = pw.dio(waveform, sample_rate, frame_period=frame_period)  # if harvest fails, try dio
+    f0 = pw.stonemask(waveform, _f0, t, sample_rate)
+    return F.interpolate(torch.from_numpy(f0).view(1, 1, -1), size=num_frames, mode='linear').view(-1)
+
+
 def compute_f0(data, sample_rate, hop_size, mode='train'):
     """ Extract f0
 
@@ -194,19 +350,16 @@ def compute_f0(data, sample_rate, hop_size, mode='train'):
         Returns:
             Iterable[{key, feat, label}]
     """
-    frame_period = hop_size * 1000 / sample_rate
     for sample in data:
+        if 'pitch_feat' in sample:
+            # NOTE precomputed by extract_features
+            yield sample
+            continue
         assert 'sample_rate' in sample
         assert 'speech' in sample
         assert 'utt' in sample
         assert 'text_token' in sample
-        waveform = sample['speech']
-        _f0, t = pw.harvest(waveform.squeeze(dim=0).numpy().astype('double'), sample_rate, frame_period=frame_period)
-        if sum(_f0 != 0) < 5:  # this happens when the algorithm fails
-            _f0, t = pw.dio(waveform.squeeze(dim=0).numpy().astype('double'), sample_rate, frame_period=frame_period)  # if harvest fails, try dio
-        f0 = pw.stonemask(waveform.squeeze(dim=0).numpy().astype('double'), _f0, t, sample_rate)
-        f0 = F.interpolate(torch.from_numpy(f0).view(1, 1, -1), size=sample['speech_feat'].shape[0], mode='linear').view(-1)
-        sample['pitch_feat'] = f0
+        sample['pitch_feat'] = extract_f0(sample['speech'], sample_rate, hop_size, sample['speech_feat'].shape[0])
         yield sample
 
 
@@ -287,12 +440,12 @@ def sort(data, sort_size=500, mode='train'):
     for sample in data:
         buf.append(sample)
         if len(buf) >= sort_size:
-            buf.sort(key=lambda x: x['speech_feat'].size(0))
+            buf.sort(key=feat_length)
             for x in buf:
                 yield x
             buf = []
     # The sample left over
-    buf.sort(key=lambda x: x['speech_feat'].size(0))
+    buf.sort(key=feat_length)
     for x in buf:
         yield x
 
@@ -331,9 +484,7 @@ def dynamic_batch(data, max_frames_in_batch=12000, mode='train'):
     buf = []
     longest_frames = 0
     for sample in data:
-        assert 'speech_feat' in sample
-        assert isinstance(sample['speech_feat'], torch.Tensor)
-        new_sample_frames = sample['speech_feat'].size(0)
+        new_sample_frames = feat_length(sample)
         longest_frames = max(longest_frames, new_sample_frames)
         frames_after_padding = longest_frames * (len(buf) + 1)
         if frames_after_padding > max_frames_in_batch:
@@ -346,17 +497,133 @@ def dynamic_batch(data, max_frames_in_batch=12000, mode='train'):
         yield buf
 
 
-def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=12000, mode='train'):
-    """ Wrapper for static/dynamic batch
+def bucket_batch(data, bucket_boundaries, max_frames_in_batch=12000, mode='train'):
+    """ Batch the data in length buckets until the padded frames of a
+        bucket reach `max_frames_in_batch`. Bucket boundaries are speech
+        token lengths taken from the length index of the whole data list,
+        so every bucket holds near uniform lengths whatever shard the
+        samples come from.
+
+        Args:
+            data: Iterable[{key, feat, label}]
+            bucket_boundaries: sorted speech token lengths between buckets
+            max_frames_in_batch: max_frames in one batch
+
+        Returns:
+            Iterable[List[{key, feat, label}]]
+    """
+    buckets = [[] for _ in range(len(bucket_boundaries) + 1)]
+    longest_frames = [0] * len(buckets)
+    for sample in data:
+        i = bisect.bisect_right(bucket_boundaries, len(sample['speech_token']))
+        new_sample_frames = feat_length(sample)
+        if len(buckets[i]) > 0 and max(longest_frames[i], new_sample_frames) * (len(buckets[i]) + 1) > max_frames_in_batch:
+            yield buckets[i]
+            buckets[i], longest_frames[i] = [], 0
+        buckets[i].append(sample)
+        longest_frames[i] = max(longest_frames[i], new_sample_frames)
+    # NOTE leftovers of neighbouring buckets are close in length, batch them in length order
+    leftover = sorted([x for bucket in buckets for x in bucket], key=feat_length)
+    for x in dynamic_batch(leftover, max_frames_in_batch):
+        yield x
+
+
+def length_index(lists, cache_file=''):
+    """ Speech token length of every utterance of every parquet file,
+        read from the arrow offsets of the speech_token column without
+        touching audio. Results are cached per file and size in cache_file.
+
+        Returns:
+            Dict[str, List[int]]
+    """
+    cache = {}
+    if cache_file != '' and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as ex:
+            # NOTE a truncated or corrupted cache is a miss, it is rebuilt below
+            logging.warning('failed to read length index {}, rebuild it, ex info {}'.format(cache_file, ex))
+    index, updated = {}, False
+    for src in lists:
+        size = os.path.getsize(src)
+        if src in cache and cache[src]['size'] == size:
+            index[src] = cache[src]['lengths']
+            continue
+        column = pq.read_table(src, columns=['speech_token']).column('speech_token').combine_chunks()
+        index[src] = np.diff(column.offsets.to_numpy()).tolist()
+        cache[src], updated = {'size': size, 'lengths': index[src]}, True
+    if cache_file != '' and updated is True:
+        # NOTE every rank builds the index, a per process tmp file keeps their writes apart,
+        #   the last rename wins and all of them hold the same lengths
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_file, cache_file)
+        except OSError as ex:
+            logging.warning('failed to write length index {}, ex info {}'.format(cache_file, ex))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return index
+
+
+def compute_bucket_boundaries(index, num_buckets=50):
+    """ Equal count bucket boundaries over all lengths of a length index """
+    lengths = np.concatenate([np.array(i, dtype=np.int64) for i in index.values()] + [np.zeros(0, dtype=np.int64)])
+    if len(lengths) == 0:
+        return []
+    return sorted(set(np.quantile(lengths, np.linspace(0, 1, num_buckets + 1)[1:-1]).astype(np.int64).tolist()))
+
+
+def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=12000, num_buckets=50, bucket_boundaries=None, mode='train'):
+    """ Wrapper for static/dynamic/bucket batch
     """
     if batch_type == 'static':
         return static_batch(data, batch_size)
     elif batch_type == 'dynamic':
         return dynamic_batch(data, max_frames_in_batch)
+    elif batch_type == 'bucket':
+        assert bucket_boundaries is not None, 'bucket batch needs boundaries from the length index, see Dataset'
+        return bucket_batch(data, bucket_boundaries, max_frames_in_batch)
     else:
         logging.fatal('Unsupported batch type {}'.format(batch_type))
 
 
+def timed_stage(data, stage, name, stats, mode='train'):
+    """ Run stage and accumulate the wall time of producing its outputs into stats[name].
+        Pulls from upstream happen inside, so the time is inclusive of all earlier stages.
+    """
+    it = iter(stage(data, mode=mode))
+    while True:
+        start = time.perf_counter()
+        try:
+            sample = next(it)
+        except StopIteration:
+            return
+        stats[name] = stats.get(name, 0.0) + time.perf_counter() - start
+        yield sample
+
+
+def stage_time(data, stats, names, mode='train'):
+    """ Attach the exclusive time every timed stage spent on a batch, must be the last stage
+
+        Args:
+            data: Iterable[{utts, ...}]
+            stats: inclusive times filled by timed_stage
+            names: stage names in pipeline order
+
+        Returns:
+            Iterable[{utts, stage_time, ...}]
+    """
+    last = {}
+    for batch in data:
+        inclusive = [stats.get(name, 0.0) - last.get(name, 0.0) for name in names]
+        last = dict(stats)
+        batch['stage_time'] = {name: inclusive[i] - (inclusive[i - 1] if i > 0 else 0.0) for i, name in enumerate(names)}
+        yield batch
+
+
 def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
     """ Padding the data into training data
 
@@ -368,24 +635,16 @@ def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
     """
     for sample in data:
         assert isinstance(sample, list)
-        speech_feat_len = torch.tensor([x['speech_feat'].size(1) for x in sample],
+        speech_feat_len = torch.tensor([feat_length(x) for x in sample],
                                        dtype=torch.int32)
         order = torch.argsort(speech_feat_len, descending=True)
 
         utts = [sample[i]['utt'] for i in order]
-        speech = [sample[i]['speech'].squeeze(dim=0) for i in order]
-        speech_len = torch.tensor([i.size(0) for i in speech], dtype=torch.int32)
-        speech = pad_sequence(speech, batch_first=True, padding_value=0)
         speech_token = [torch.tensor(sample[i]['speech_token']) for i in order]
         speech_token_len = torch.tensor([i.size(0) for i in speech_token], dtype=torch.int32)
         speech_token = pad_sequence(speech_token,
                                     batch_first=True,
                                     padding_value=0)
-        speech_feat = [sample[i]['speech_feat'] for i in order]
-        speech_feat_len = torch.tensor([i.size(0) for i in speech_feat], dtype=torch.int32)
-        speech_feat = pad_sequence(speech_feat,
-                                   batch_first=True,
-                                   padding_value=0)
         text = [sample[i]['text'] for i in order]
         text_token = [torch.tensor(sample[i]['text_token']) for i in order]
         text_token_len = torch.tensor([i.size(0) for i in text_token], dtype=torch.int32)
@@ -394,19 +653,33 @@ def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
         spk_embedding = torch.stack([sample[i]['spk_embedding'] for i in order], dim=0)
         batch = {
             "utts": utts,
-            "speech": speech,
-            "speech_len": speech_len,
+            # NOTE real and padded frames in batching units, padding_ratio = 1 - num_frames / padded_frames
+            "num_frames": int(speech_feat_len.sum()),
+            "padded_frames": int(speech_feat_len.max()) * len(sample),
+            "num_tokens": int(text_token_len.sum() + speech_token_len.sum()),
             "speech_token": speech_token,
             "speech_token_len": speech_token_len,
-            "speech_feat": speech_feat,
-            "speech_feat_len": speech_feat_len,
             "text": text,
             "text_token": text_token,
             "text_token_len": text_token_len,
             "utt_embedding": utt_embedding,
             "spk_embedding": spk_embedding,
         }
+        # NOTE audio free llm samples have no speech_feat
+        if 'speech_feat' in sample[0]:
+            speech_feat = [sample[i]['speech_feat'] for i in order]
+            speech_feat_len = torch.tensor([i.size(0) for i in speech_feat], dtype=torch.int32)
+            speech_feat = pad_sequence(speech_feat,
+                                       batch_first=True,
+                                       padding_value=0)
+            batch["speech_feat"] = speech_feat
+            batch["speech_feat_len"] = speech_feat_len
         if gan is True:
+            # only gan train needs speech
+            speech = [sample[i]['speech'].squeeze(dim=0) for i in order]
+            speech_len = torch.tensor([i.size(0) for i in speech], dtype=torch.int32)
+            batch["speech"] = pad_sequence(speech, batch_first=True, padding_value=0)
+            batch["speech_len"] = speech_len
             # in gan train, we need pitch_feat
             pitch_feat = [sample[i]['pitch_feat'] for i in order]
             pitch_feat_len = torch.tensor([i.size(0) for i in pitch_feat], dtype=torch.int32)
@@ -415,10 +688,6 @@ def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
                                       padding_value=0)
             batch["pitch_feat"] = pitch_feat
             batch["pitch_feat_len"] = pitch_feat_len
-        else:
-            # only gan train needs speech, delete it to save memory
-            del batch["speech"]
-            del batch["speech_len"]
         if dpo is True:
             reject_speech_token = [torch.tensor(sample[i]['reject_speech_token']) for i in order]
             reject_speech_token_len = torch.tensor([i.size(0) for i in reject_speech_token], dtype=torch.int32)
@@ -427,6 +696,12 @@ def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
                                                padding_value=0)
             batch['reject_speech_token'] = reject_speech_token
             batch['reject_speech_token_len'] = reject_speech_token_len
+            # NOTE a batch only skips ref_model when every utt has cached reference log-probs of exactly the tokens trained on,
+            # they are (B, 2) of unistream and bistream values
+            records = [sample[i].get('ref_logps') for i in order]
+            if all(record is not None and record[0] == token_hash(sample[i]) for record, i in zip(records, order)):
+                batch['ref_chosen_logps'] = torch.tensor([record[1] for record in records], dtype=torch.float32)
+                batch['ref_rejected_logps'] = torch.tensor([record[2] for record in records], dtype=torch.float32)
         if use_spk_embedding is True:
             batch["embedding"] = batch["spk_embedding"]
         else:
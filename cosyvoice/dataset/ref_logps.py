@@ -0,0 +1,85 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+# NOTE layouts of the cached values, the policy draws one per row and batch_forward picks it
+LAYOUTS = ['unistream', 'bistream']
+
+
+def ref_logp_path(src, logp_dir=None):
+    """ Reference log-prob file of one parquet file, next to it unless logp_dir is given """
+    src = os.path.abspath(src)
+    if logp_dir is None:
+        return '{}.ref_logps.json'.format(os.path.splitext(src)[0])
+    return os.path.join(logp_dir, '{}_{}.ref_logps.json'.format(os.path.splitext(os.path.basename(src))[0],
+                                                                hashlib.sha1(src.encode()).hexdigest()[:8]))
+
+
+def token_hash(sample):
+    """ Hash of what the reference log-probs depend on, taken on the sample as it reaches padding,
+        so a retokenized, relabeled or trimmed utt misses the cache
+    """
+    sha = hashlib.sha1(sample['text'].encode('utf8'))
+    for key in ['speech_token', 'reject_speech_token']:
+        sha.update(np.asarray(sample[key], dtype=np.int64).tobytes())
+    return sha.hexdigest()[:16]
+
+
+def read_ref_logps(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_ref_logps(path, ref_model, utts):
+    """ utts maps utt to [token_hash, chosen_logps, rejected_logps], logps are one value per LAYOUTS,
+        written to a tmp file renamed at the end
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'ref_model': ref_model, 'layouts': LAYOUTS, 'utts': utts}, f)
+    os.replace(tmp_path, path)
+
+
+class RefLogps:
+    """ Reference log-probs of one parquet file """
+
+    def __init__(self, path, index):
+        self.path = path
+        self.ref_model = index['ref_model']
+        self.utts = index['utts']
+
+    @classmethod
+    def open(cls, src, logp_dir=None):
+        """ Return the reference log-probs of src, or None when they are missing """
+        path = ref_logp_path(src, logp_dir)
+        index = read_ref_logps(path)
+        if index is None:
+            logging.warning('no reference log-probs for {}, run ref_model on the fly'.format(src))
+            return None
+        if index.get('layouts') != LAYOUTS:
+            logging.warning('reference log-probs of {} are not per {}, run compute_ref_logps again'.format(src, LAYOUTS))
+            return None
+        return cls(path, index)
+
+    def get(self, utt):
+        """ [token_hash, chosen_logps, rejected_logps] of utt, logps per LAYOUTS, or None, padding checks the hash """
+        return self.utts.get(utt)
@@ -159,6 +159,7 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                  only_mask_loss: bool = True,
                  token_mel_ratio: int = 2,
                  pre_lookahead_len: int = 3,
+                 n_timesteps: int = 10,
                  encoder: torch.nn.Module = None,
                  decoder: torch.nn.Module = None,
                  decoder_conf: Dict = {'in_channels': 240, 'out_channel': 80, 'spk_emb_dim': 80, 'n_spks': 1,
@@ -185,6 +186,8 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         self.only_mask_loss = only_mask_loss
         self.token_mel_ratio = token_mel_ratio
         self.pre_lookahead_len = pre_lookahead_len
+        # NOTE a distilled decoder runs with 1~4 timesteps, set n_timesteps in config accordingly
+        self.n_timesteps = n_timesteps
 
     def forward(
             self,
@@ -232,6 +235,86 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    @torch.no_grad()
+    def forward_teacher(
+            self,
+            batch: dict,
+            device: torch.device,
+    ) -> Dict[str, Optional[torch.Tensor]]:
+        token = batch['speech_token'].to(device)
+        token_len = batch['speech_token_len'].to(device)
+        feat = batch['speech_feat'].to(device)
+        feat_len = batch['speech_feat_len'].to(device)
+        embedding = batch['embedding'].to(device)
+
+        # NOTE unified training, student uses the same streaming mode as teacher
+        streaming = True if random.random() < 0.5 else False
+
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat text and prompt_text
+        mask = (~make_pad_mask(token_len)).float().unsqueeze(-1).to(device)
+        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+        # text encode
+        h, h_lengths = self.encoder(token, token_len, streaming=streaming)
+        h = self.encoder_proj(h)
+
+        # get conditions
+        conds = torch.zeros(feat.shape, device=token.device)
+        for i, j in enumerate(feat_len):
+            if random.random() < 0.5:
+                continue
+            index = random.randint(0, int(0.3 * j))
+            conds[i, :index] = feat[i, :index]
+        conds = conds.transpose(1, 2)
+
+        mask = (~make_pad_mask(h_lengths.sum(dim=-1).squeeze(dim=1))).to(h)
+        trajectory = self.decoder.sample_trajectory(
+            h.transpose(1, 2).contiguous(),
+            mask.unsqueeze(1),
+            embedding,
+            cond=conds,
+            streaming=streaming,
+        )
+        return {'trajectory': trajectory, 'conds': conds, 'streaming': streaming}
+
+    def forward_distill(
+            self,
+            batch: dict,
+            device: torch.device,
+    ) -> Dict[str, Optional[torch.Tensor]]:
+        token = batch['speech_token'].to(device)
+        token_len = batch['speech_token_len'].to(device)
+        embedding = batch['embedding'].to(device)
+        teacher = batch['teacher']
+        streaming = teacher['streaming']
+
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat text and prompt_text
+        mask = (~make_pad_mask(token_len)).float().unsqueeze(-1).to(device)
+        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+        # text encode
+        h, h_lengths = self.encoder(token, token_len, streaming=streaming)
+        h = self.encoder_proj(h)
+
+        mask = (~make_pad_mask(h_lengths.sum(dim=-1).squeeze(dim=1))).to(h)
+        loss, _ = self.decoder.compute_distill_loss(
+            teacher['trajectory'].to(h.dtype),
+            mask.unsqueeze(1),
+            h.transpose(1, 2).contiguous(),
+            embedding,
+            cond=teacher['conds'].to(h.dtype),
+            streaming=streaming,
+        )
+        return {'loss': loss}
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -242,7 +325,9 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=None,
+                  cfg_rate=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -267,15 +352,77 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         conds[:, :mel_len1] = prompt_feat
         conds = conds.transpose(1, 2)
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        mask = torch.ones([1, mel_len1 + mel_len2], device=h.device, dtype=h.dtype)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=self.n_timesteps if n_timesteps is None else n_timesteps,
+            streaming=streaming,
+            cfg_rate=cfg_rate
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
+
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        streaming,
+                        finalize,
+                        n_timesteps=None,
+                        cfg_rate=None):
+        """Batched version of inference, sessions are right padded and masked.
+
+        finalize is a per session list, a not finalized session carries pre_lookahead_len
+        context tokens at the end of token, which are encoded in the same chunk and dropped
+        afterwards, so the output equals running inference on every session separately.
+        """
+        assert streaming is True or all(finalize), 'non-streaming inference must be finalized'
+        batch_size = token.shape[0]
+        token_len, prompt_token_len, prompt_feat_len = token_len.tolist(), prompt_token_len.tolist(), prompt_feat_len.tolist()
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat text and prompt_text
+        full_token_len = [i + j for i, j in zip(prompt_token_len, token_len)]
+        full_token = torch.zeros([batch_size, max(full_token_len)], dtype=token.dtype, device=token.device)
+        for i in range(batch_size):
+            full_token[i, :prompt_token_len[i]] = prompt_token[i, :prompt_token_len[i]]
+            full_token[i, prompt_token_len[i]:full_token_len[i]] = token[i, :token_len[i]]
+        full_token_len = torch.tensor(full_token_len, dtype=torch.int32, device=token.device)
+        mask = (~make_pad_mask(full_token_len)).unsqueeze(-1).to(embedding)
+        full_token = self.input_embedding(torch.clamp(full_token, min=0)) * mask
+
+        # text encode
+        h, h_lengths = self.encoder(full_token, full_token_len, streaming=streaming)
+        h_lengths = h_lengths.sum(dim=-1).squeeze(dim=1).tolist()
+        h_lengths = [j if finalize[i] is True else j - self.pre_lookahead_len * self.token_mel_ratio for i, j in enumerate(h_lengths)]
+        h = self.encoder_proj(h[:, :max(h_lengths)])
+
+        # get conditions
+        conds = torch.zeros([batch_size, h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        for i in range(batch_size):
+            conds[i, :prompt_feat_len[i]] = prompt_feat[i, :prompt_feat_len[i]]
+        conds = conds.transpose(1, 2)
+
+        mask = (~make_pad_mask(torch.tensor(h_lengths), h.shape[1])).to(h)
+        h = h * mask.unsqueeze(-1)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=self.n_timesteps if n_timesteps is None else n_timesteps,
+            streaming=streaming,
+            cfg_rate=cfg_rate
+        )
+        return [feat[i:i + 1, :, prompt_feat_len[i]:h_lengths[i]].float() for i in range(batch_size)]
@@ -12,6 +12,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import random
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
@@ -29,6 +30,10 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # guided teacher trajectory used in few-step distillation
+        self.distill_cfg_rate = cfm_params.get('distill_cfg_rate', 0.7)
+        self.distill_teacher_timesteps = cfm_params.get('distill_teacher_timesteps', 8)
+        self.distill_student_timesteps = list(cfm_params.get('distill_student_timesteps', [1, 2, 4]))
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
@@ -68,7 +73,7 @@ class ConditionalCFM(BASECFM):
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
         return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_rate=None):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -82,6 +87,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cfg_rate (float, optional): overrides inference_cfg_rate for this call.
         """
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)
@@ -90,21 +96,30 @@ class ConditionalCFM(BASECFM):
         # Or in future might add like a return_all_steps flag
         sol = []
 
+        # NOTE a distilled estimator has guidance baked in, so inference_cfg_rate=0 skips the unconditional branch
+        cfg_rate = self.inference_cfg_rate if cfg_rate is None else cfg_rate
+        use_cfg = cfg_rate > 0 or not isinstance(self.estimator, torch.nn.Module)
+        # NOTE batch_size > 1 is used by batched token2wav, rows are right padded and masked
+        b = mu.size(0)
+        batch_in = 2 * b if use_cfg else b
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        x_in = torch.zeros([batch_in, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([batch_in, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([batch_in, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([batch_in], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([batch_in, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([batch_in, 80, x.size(2)], device=x.device, dtype=x.dtype)
         for step in range(1, len(t_span)):
             # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
+            x_in[:b] = x
+            mask_in[:b] = mask
+            if use_cfg:
+                x_in[b:] = x
+                mask_in[b:] = mask
+            mu_in[:b] = mu
             t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
+            spks_in[:b] = spks
+            cond_in[:b] = cond
             dphi_dt = self.forward_estimator(
                 x_in, mask_in,
                 mu_in, t_in,
@@ -112,8 +127,9 @@ class ConditionalCFM(BASECFM):
                 cond_in,
                 streaming
             )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+            if use_cfg:
+                dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [b, b], dim=0)
+                dphi_dt = ((1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt)
             x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
@@ -192,6 +208,79 @@ class ConditionalCFM(BASECFM):
         loss = F.mse_loss(pred * mask, u * mask, reduction="sum") / (torch.sum(mask) * u.shape[1])
         return loss, y
 
+    def get_t_span(self, n_timesteps, device, dtype):
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+        if self.t_scheduler == 'cosine':
+            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+        return t_span
+
+    @torch.no_grad()
+    def sample_trajectory(self, mu, mask, spks=None, cond=None, streaming=False):
+        """Run the guided euler solver from random noise and keep every state,
+           used as the teacher target in few-step distillation
+
+        Args:
+            mu (torch.Tensor): output of encoder
+                shape: (batch_size, n_feats, mel_timesteps)
+            mask (torch.Tensor): output_mask
+                shape: (batch_size, 1, mel_timesteps)
+            spks (torch.Tensor, optional): speaker embedding. Defaults to None.
+                shape: (batch_size, spk_emb_dim)
+
+        Returns:
+            trajectory: solver states from t=0 to t=1
+                shape: (batch_size, n_feats, mel_timesteps, distill_teacher_timesteps + 1)
+        """
+        x = torch.randn_like(mu) * mask
+        t_span = self.get_t_span(self.distill_teacher_timesteps, mu.device, mu.dtype)
+        mask_in, mu_in = torch.concat([mask, mask], dim=0), torch.concat([mu, torch.zeros_like(mu)], dim=0)
+        spks_in, cond_in = torch.concat([spks, torch.zeros_like(spks)], dim=0), torch.concat([cond, torch.zeros_like(cond)], dim=0)
+        trajectory = [x]
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+            dphi_dt = self.estimator(torch.concat([x, x], dim=0), mask_in, mu_in, t.repeat(2 * x.size(0)), spks_in, cond_in, streaming=streaming)
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+            dphi_dt = ((1.0 + self.distill_cfg_rate) * dphi_dt - self.distill_cfg_rate * cfg_dphi_dt)
+            x = x + dt * dphi_dt
+            trajectory.append(x)
+        return torch.stack(trajectory, dim=-1)
+
+    def compute_distill_loss(self, trajectory, mask, mu, spks=None, cond=None, streaming=False):
+        """Computes few-step distillation loss, the student estimator learns the
+           average guided velocity of the teacher over one of its own solver steps
+
+        Args:
+            trajectory (torch.Tensor): teacher states from sample_trajectory
+                shape: (batch_size, n_feats, mel_timesteps, distill_teacher_timesteps + 1)
+            mask (torch.Tensor): target mask
+                shape: (batch_size, 1, mel_timesteps)
+            mu (torch.Tensor): output of student encoder
+                shape: (batch_size, n_feats, mel_timesteps)
+            spks (torch.Tensor, optional): speaker embedding. Defaults to None.
+                shape: (batch_size, spk_emb_dim)
+
+        Returns:
+            loss: distillation loss
+            y: student input state
+                shape: (batch_size, n_feats, mel_timesteps)
+        """
+        b = mu.size(0)
+        # a random student step count, every student step must cover a whole number of teacher steps
+        n_student = random.choice(self.distill_student_timesteps)
+        assert self.distill_teacher_timesteps % n_student == 0, \
+            'distill_teacher_timesteps {} should be divisible by student timesteps {}'.format(self.distill_teacher_timesteps, n_student)
+        stride = self.distill_teacher_timesteps // n_student
+        start = torch.randint(0, n_student, [b], device=mu.device) * stride
+        t_span = self.get_t_span(self.distill_teacher_timesteps, mu.device, mu.dtype)
+        t0, t1 = t_span[start], t_span[start + stride]
+        trajectory = trajectory.permute(3, 0, 1, 2)
+        y, target = trajectory[start, torch.arange(b, device=mu.device)], trajectory[start + stride, torch.arange(b, device=mu.device)]
+        u = (target - y) / (t1 - t0).view(-1, 1, 1)
+
+        pred = self.estimator(y, mask, mu, t0, spks, cond, streaming=streaming)
+        loss = F.mse_loss(pred * mask, u * mask, reduction="sum") / (torch.sum(mask) * u.shape[1])
+        return loss, y
+
 
 class CausalConditionalCFM(ConditionalCFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
@@ -200,7 +289,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, cfg_rate=None):
         """Forward diffusion
 
         Args:
@@ -219,9 +308,11 @@ class CausalConditionalCFM(ConditionalCFM):
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        # NOTE keep rand_noise on device, so streaming hops do not copy it again
+        self.rand_noise = self.rand_noise.to(mu.device)
+        z = self.rand_noise[:, :, :mu.size(2)].to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, cfg_rate=cfg_rate), None
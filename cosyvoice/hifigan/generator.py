@@ -27,7 +27,6 @@ try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
     from torch.nn.utils import weight_norm
-from torch.distributions.uniform import Uniform
 
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
@@ -144,13 +143,13 @@ class SineGen(torch.nn.Module):
         :return: [B, 1, sample_len]
         """
 
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
+        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1)), device=f0.device)
         for i in range(self.harmonic_num + 1):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+        # NOTE uniform in [-pi, pi), sampled on device to avoid host to device copy
+        phase_vec = torch.rand((f0.size(0), self.harmonic_num + 1, 1), device=F_mat.device) * 2 * np.pi - np.pi
         phase_vec[:, 0, :] = 0
 
         # generate sine waveforms
@@ -319,7 +318,7 @@ class SineGen2(torch.nn.Module):
         output uv: tensor(batchsize=1, length, 1)
         """
         # fundamental component
-        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        fn = torch.multiply(f0, torch.arange(1, self.harmonic_num + 2, dtype=torch.float32, device=f0.device).view(1, 1, -1))
 
         # generate sine waveforms
         sine_waves = self._f02sine(fn) * self.sine_amp
@@ -502,9 +501,11 @@ class HiFTGenerator(nn.Module):
             l.remove_weight_norm()
 
     def _stft(self, x):
+        # NOTE keep window on device, so it is only copied once
+        self.stft_window = self.stft_window.to(x.device)
         spec = torch.stft(
             x,
-            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
+            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window,
             return_complex=True)
         spec = torch.view_as_real(spec)  # [B, F, TT, 2]
         return spec[..., 0], spec[..., 1]
@@ -514,7 +515,7 @@ class HiFTGenerator(nn.Module):
         real = magnitude * torch.cos(phase)
         img = magnitude * torch.sin(phase)
         inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"],
-                                        self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
+                                        self.istft_params["n_fft"], window=self.stft_window)
         return inverse_transform
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
@@ -580,3 +581,273 @@ class HiFTGenerator(nn.Module):
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+
+class _StreamConv1d:
+    """Run a symmetric padded Conv1d chunk by chunk, emitting every output sample once its receptive field is received."""
+    def __init__(self, conv: nn.Conv1d):
+        self.conv = conv
+        self.stride, self.dilation, self.padding = conv.stride[0], conv.dilation[0], conv.padding[0]
+        self.kernel_size = (conv.kernel_size[0] - 1) * self.dilation + 1
+        self.buffer = None
+
+    def __call__(self, x: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        if self.buffer is None:
+            self.buffer = x.new_zeros(x.shape[0], x.shape[1], self.padding)
+        self.buffer = torch.concat([self.buffer, x], dim=2)
+        if finalize is True:
+            self.buffer = F.pad(self.buffer, (0, self.padding))
+        n = (self.buffer.shape[2] - self.kernel_size) // self.stride + 1 if self.buffer.shape[2] >= self.kernel_size else 0
+        if n == 0:
+            return x.new_zeros(x.shape[0], self.conv.out_channels, 0)
+        y = F.conv1d(self.buffer[:, :, :(n - 1) * self.stride + self.kernel_size], self.conv.weight, self.conv.bias,
+                     stride=self.stride, dilation=self.dilation)
+        self.buffer = self.buffer[:, :, n * self.stride:]
+        return y
+
+
+class _StreamConvTranspose1d:
+    """Run a ConvTranspose1d chunk by chunk, carrying the overlap-add tail to the next chunk."""
+    def __init__(self, conv: nn.ConvTranspose1d):
+        self.conv = conv
+        self.stride, self.padding = conv.stride[0], conv.padding[0]
+        self.overlap = conv.kernel_size[0] - self.stride
+        self.carry = None
+        self.cropped = 0
+
+    def __call__(self, x: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        if self.carry is None:
+            self.carry = x.new_zeros(x.shape[0], self.conv.out_channels, self.overlap)
+        if x.shape[2] != 0:
+            y = F.conv_transpose1d(x, self.conv.weight, None, stride=self.stride)
+            y[:, :, :self.overlap] += self.carry
+            y, self.carry = y[:, :, :x.shape[2] * self.stride], y[:, :, x.shape[2] * self.stride:]
+        else:
+            y = x.new_zeros(x.shape[0], self.conv.out_channels, 0)
+        if finalize is True:
+            y = torch.concat([y, self.carry[:, :, :self.overlap - self.padding]], dim=2)
+        # crop the leading padding samples once
+        if self.cropped < self.padding:
+            cropped = min(self.padding - self.cropped, y.shape[2])
+            y, self.cropped = y[:, :, cropped:], self.cropped + cropped
+        return y + self.conv.bias.view(1, -1, 1)
+
+
+class _StreamAdd:
+    """Sum streams which emit the same signal length at different pace."""
+    def __init__(self, n: int):
+        self.pending = [None] * n
+
+    def __call__(self, *xs: torch.Tensor) -> torch.Tensor:
+        self.pending = [x if p is None else torch.concat([p, x], dim=-1) for p, x in zip(self.pending, xs)]
+        n = min(p.shape[-1] for p in self.pending)
+        y = sum(p[..., :n] for p in self.pending)
+        self.pending = [p[..., n:] for p in self.pending]
+        return y
+
+
+class _StreamResBlock:
+    def __init__(self, block: ResBlock):
+        self.block = block
+        self.convs1 = [_StreamConv1d(i) for i in block.convs1]
+        self.convs2 = [_StreamConv1d(i) for i in block.convs2]
+        self.adds = [_StreamAdd(2) for _ in block.convs1]
+
+    def __call__(self, x: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        for idx in range(len(self.convs1)):
+            xt = self.block.activations1[idx](x)
+            xt = self.convs1[idx](xt, finalize)
+            xt = self.block.activations2[idx](xt)
+            xt = self.convs2[idx](xt, finalize)
+            x = self.adds[idx](xt, x)
+        return x
+
+
+class _StreamSource:
+    """SourceModuleHnNSF2 with f0 and sine phase carried across chunks.
+
+    SineGen2 integrates phase at frame rate and linearly upsamples it, so a sample
+    between frame j and j + 1 is known once frame j + 1 arrives, the initial random
+    phase is dropped by its downsampling and does not need to be kept.
+    """
+    def __init__(self, m_source: SourceModuleHnNSF2):
+        self.m_source = m_source
+        self.sine_gen = m_source.l_sin_gen
+        self.upsample_scale = int(self.sine_gen.upsample_scale)
+        assert self.upsample_scale % 2 == 0, 'upsample_scale should be even'
+        self.weight = None
+        # cumulated rad (mod 1), rad and f0 of the last received frame
+        self.last = None
+
+    def _source(self, phase: torch.Tensor, f0: torch.Tensor) -> torch.Tensor:
+        sine_waves = torch.sin(phase * 2 * np.pi) * self.sine_gen.sine_amp
+        uv = (f0 > self.sine_gen.voiced_threshold).type(torch.float32)
+        noise_amp = uv * self.sine_gen.noise_std + (1 - uv) * self.sine_gen.sine_amp / 3
+        sine_waves = sine_waves * uv + noise_amp * torch.randn_like(sine_waves)
+        return self.m_source.l_tanh(self.m_source.l_linear(sine_waves)).transpose(1, 2)
+
+    def __call__(self, f0: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        # f0 (B, T) at frame rate, return source (B, 1, T * upsample_scale) in total
+        harmonics = torch.arange(1, self.sine_gen.harmonic_num + 2, dtype=torch.float32, device=f0.device).view(1, 1, -1)
+        f0 = f0.unsqueeze(dim=2)
+        rad = (f0 * harmonics / self.sine_gen.sampling_rate) % 1
+        cum = torch.cumsum(rad.double(), dim=1)
+        half = self.upsample_scale // 2
+        sources = []
+        if self.last is None:
+            if f0.shape[1] == 0:
+                return f0.new_zeros(f0.shape[0], 1, 0)
+            # samples before the center of frame 0 are clamped to frame 0
+            self.weight = (torch.arange(self.upsample_scale, device=f0.device, dtype=torch.float64) + 0.5) / self.upsample_scale
+            sources.append(self._source((cum[:, :1] * self.upsample_scale).float().repeat(1, half, 1), f0[:, :1].repeat(1, half, 1)))
+        else:
+            cum = cum + self.last[0]
+            cum, rad, f0 = torch.concat([self.last[0], cum], dim=1), torch.concat([self.last[1], rad], dim=1), torch.concat([self.last[2], f0], dim=1)
+        cum = cum % 1
+        n = f0.shape[1] - 1
+        if n > 0:
+            # between frame j and j + 1, first half uses f0 of frame j, second half f0 of frame j + 1
+            phase = cum[:, :-1].unsqueeze(dim=2) + self.weight.view(1, 1, -1, 1) * rad[:, 1:].double().unsqueeze(dim=2)
+            phase = ((phase % 1) * self.upsample_scale).float().reshape(f0.shape[0], n * self.upsample_scale, -1)
+            this_f0 = torch.concat([f0[:, :-1].unsqueeze(dim=2).expand(-1, -1, half, -1), f0[:, 1:].unsqueeze(dim=2).expand(-1, -1, half, -1)], dim=2)
+            sources.append(self._source(phase, this_f0.reshape(f0.shape[0], n * self.upsample_scale, 1)))
+        self.last = (cum[:, -1:], rad[:, -1:], f0[:, -1:])
+        if finalize is True:
+            # samples after the center of the last frame are clamped to it
+            sources.append(self._source((self.last[0] * self.upsample_scale).float().repeat(1, half, 1), self.last[2].repeat(1, half, 1)))
+        return torch.concat(sources, dim=2) if len(sources) != 0 else f0.new_zeros(f0.shape[0], 1, 0)
+
+
+class _StreamSTFT:
+    """Centered stft with reflect padding, run chunk by chunk."""
+    def __init__(self, n_fft: int, hop_len: int, window: torch.Tensor):
+        self.n_fft, self.hop_len, self.window = n_fft, hop_len, window
+        self.buffer = None
+        self.tail = None
+
+    def __call__(self, x: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        if self.buffer is None:
+            assert x.shape[1] > self.n_fft // 2, 'first chunk is too short for reflect padding'
+            self.buffer = x[:, 1:self.n_fft // 2 + 1].flip(1)
+            self.tail = x[:, :0]
+        self.buffer = torch.concat([self.buffer, x], dim=1)
+        self.tail = torch.concat([self.tail, x], dim=1)[:, -(self.n_fft // 2 + 1):]
+        if finalize is True:
+            self.buffer = torch.concat([self.buffer, self.tail[:, :-1].flip(1)], dim=1)
+        n = (self.buffer.shape[1] - self.n_fft) // self.hop_len + 1 if self.buffer.shape[1] >= self.n_fft else 0
+        if n == 0:
+            return x.new_zeros(x.shape[0], self.n_fft + 2, 0)
+        self.window = self.window.to(x.device)
+        spec = torch.stft(self.buffer[:, :(n - 1) * self.hop_len + self.n_fft], self.n_fft, self.hop_len, self.n_fft,
+                          window=self.window, center=False, return_complex=True)
+        self.buffer = self.buffer[:, n * self.hop_len:]
+        spec = torch.view_as_real(spec)
+        return torch.cat([spec[..., 0], spec[..., 1]], dim=1)
+
+
+class _StreamISTFT:
+    """Centered istft, overlap-add and window envelope are carried to the next chunk."""
+    def __init__(self, n_fft: int, hop_len: int, window: torch.Tensor):
+        self.n_fft, self.hop_len, self.window = n_fft, hop_len, window
+        self.carry = None
+        self.envelope = None
+        self.cropped = 0
+
+    def __call__(self, magnitude: torch.Tensor, phase: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        b, n = magnitude.shape[0], magnitude.shape[2]
+        self.window = window = self.window.to(magnitude.device)
+        if self.carry is None:
+            self.carry = magnitude.new_zeros(b, self.n_fft - self.hop_len)
+            self.envelope = magnitude.new_zeros(1, self.n_fft - self.hop_len)
+        if n != 0:
+            magnitude = torch.clip(magnitude, max=1e2)
+            frames = torch.fft.irfft(torch.complex(magnitude * torch.cos(phase), magnitude * torch.sin(phase)), n=self.n_fft, dim=1)
+            length = (n - 1) * self.hop_len + self.n_fft
+            y = F.fold(frames * window.view(1, -1, 1), output_size=(1, length), kernel_size=(1, self.n_fft), stride=(1, self.hop_len)).view(b, length)
+            envelope = F.fold((window ** 2).view(1, -1, 1).expand(1, -1, n), output_size=(1, length),
+                              kernel_size=(1, self.n_fft), stride=(1, self.hop_len)).view(1, length)
+            y[:, :self.carry.shape[1]] += self.carry
+            envelope[:, :self.envelope.shape[1]] += self.envelope
+            y, self.carry = y[:, :n * self.hop_len], y[:, n * self.hop_len:]
+            envelope, self.envelope = envelope[:, :n * self.hop_len], envelope[:, n * self.hop_len:]
+        else:
+            y, envelope = magnitude.new_zeros(b, 0), magnitude.new_zeros(1, 0)
+        if finalize is True:
+            y = torch.concat([y, self.carry[:, :self.n_fft // 2 - self.hop_len]], dim=1)
+            envelope = torch.concat([envelope, self.envelope[:, :self.n_fft // 2 - self.hop_len]], dim=1)
+        # crop the leading n_fft // 2 samples of center padding once
+        if self.cropped < self.n_fft // 2:
+            cropped = min(self.n_fft // 2 - self.cropped, y.shape[1])
+            y, envelope, self.cropped = y[:, cropped:], envelope[:, cropped:], self.cropped + cropped
+        return y / envelope
+
+
+class HiFTStreamSession:
+    """Stateful streaming inference of HiFTGenerator.
+
+    Every conv keeps its receptive field cache, transposed conv and istft carry their
+    overlap-add tail, and the harmonic source carries f0 and sine phase. So each call
+    only computes newly received mel frames, and the concatenated output equals
+    HiFTGenerator.inference on the whole mel up to noise, without crossfade. Output
+    lags input by the receptive field, which is flushed when finalize is True.
+    """
+    def __init__(self, hift: HiFTGenerator):
+        assert isinstance(hift.m_source, SourceModuleHnNSF2), 'stream session only supports SourceModuleHnNSF2'
+        self.hift = hift
+        self.f0_convs = [_StreamConv1d(i) if isinstance(i, nn.Conv1d) else i for i in hift.f0_predictor.condnet]
+        self.source = _StreamSource(hift.m_source)
+        self.stft = _StreamSTFT(hift.istft_params["n_fft"], hift.istft_params["hop_len"], hift.stft_window)
+        self.conv_pre = _StreamConv1d(hift.conv_pre)
+        self.ups = [_StreamConvTranspose1d(i) for i in hift.ups]
+        self.source_downs = [_StreamConv1d(i) for i in hift.source_downs]
+        self.source_resblocks = [_StreamResBlock(i) for i in hift.source_resblocks]
+        self.resblocks = [_StreamResBlock(i) for i in hift.resblocks]
+        self.fusion_adds = [_StreamAdd(2) for _ in hift.ups]
+        self.resblock_adds = [_StreamAdd(hift.num_kernels) for _ in hift.ups]
+        self.reflection_pending = None
+        self.conv_post = _StreamConv1d(hift.conv_post)
+        self.istft = _StreamISTFT(hift.istft_params["n_fft"], hift.istft_params["hop_len"], hift.stft_window)
+
+    def _reflection_pad(self, x: torch.Tensor, finalize: bool) -> torch.Tensor:
+        # ReflectionPad1d((1, 0)) only touches the very first sample
+        if self.reflection_pending is None:
+            return x
+        self.reflection_pending = torch.concat([self.reflection_pending, x], dim=2)
+        if self.reflection_pending.shape[2] < 2 and finalize is False:
+            return x[:, :, :0]
+        x = self.hift.reflection_pad(self.reflection_pending) if self.reflection_pending.shape[2] >= 2 else self.reflection_pending
+        self.reflection_pending = None
+        return x
+
+    @torch.inference_mode()
+    def __call__(self, speech_feat: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        if self.reflection_pending is None and self.conv_pre.buffer is None:
+            self.reflection_pending = speech_feat.new_zeros(speech_feat.shape[0], self.hift.ups[-1].out_channels, 0)
+        hift = self.hift
+        # mel->f0
+        f0 = speech_feat
+        for layer in self.f0_convs:
+            f0 = layer(f0, finalize) if isinstance(layer, _StreamConv1d) else layer(f0)
+        f0 = torch.abs(hift.f0_predictor.classifier(f0.transpose(1, 2)).squeeze(-1))
+        # f0->source
+        s = self.source(f0, finalize)
+        s_stft = self.stft(s.squeeze(1), finalize)
+        # mel+source->speech
+        x = self.conv_pre(speech_feat, finalize)
+        for i in range(hift.num_upsamples):
+            x = F.leaky_relu(x, hift.lrelu_slope)
+            x = self.ups[i](x, finalize)
+            if i == hift.num_upsamples - 1:
+                x = self._reflection_pad(x, finalize)
+            # fusion
+            si = self.source_downs[i](s_stft, finalize)
+            si = self.source_resblocks[i](si, finalize)
+            x = self.fusion_adds[i](x, si)
+            x = self.resblock_adds[i](*[self.resblocks[i * hift.num_kernels + j](x, finalize) for j in range(hift.num_kernels)])
+            x = x / hift.num_kernels
+        x = F.leaky_relu(x)
+        x = self.conv_post(x, finalize)
+        magnitude = torch.exp(x[:, :hift.istft_params["n_fft"] // 2 + 1, :])
+        phase = torch.sin(x[:, hift.istft_params["n_fft"] // 2 + 1:, :])
+        x = self.istft(magnitude, phase, finalize)
+        return torch.clamp(x, -hift.audio_limit, hift.audio_limit)
@@ -13,7 +13,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import queue
-import random
 import time
 import threading
 from typing import Dict, Optional, Callable, List, Generator
@@ -150,10 +149,15 @@ class TransformerLM(torch.nn.Module):
             decoded_tokens: List,
             sampling: int,
             ignore_eos: bool = True,
+            top_k: int = None,
     ):
         num_trials, max_trials = 0, 100
         while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
+            # NOTE top_k overrides the configured sampling top_k, used to trade quality for speed under load
+            if top_k is None:
+                top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
+            else:
+                top_ids = self.sampling(weighted_scores, decoded_tokens, sampling, top_k=top_k)
             if (not ignore_eos) or (self.speech_token_size not in top_ids):
                 break
             num_trials += 1
@@ -208,12 +212,23 @@ class TransformerLM(torch.nn.Module):
         # 5. step by step decode
         out_tokens = []
         offset = 0
-        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # NOTE jit llm only exports forward_chunk, otherwise write key & value into preallocated caches by offset
+        inplace = hasattr(self.llm, 'forward_chunk_inplace')
+        if inplace is True:
+            att_cache, cnn_cache = self.llm.init_inplace_cache(lm_input.shape[1] + max_len, lm_input.device, lm_input.dtype)
+        else:
+            att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            if inplace is True:
+                # single token step sees all history, only the prompt step needs a causal mask
+                att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device, dtype=torch.bool)) \
+                    if i == 0 else torch.ones((0, 0, 0), device=lm_input.device, dtype=torch.bool)
+                y_pred = self.llm.forward_chunk_inplace(lm_input, offset, att_cache, cnn_cache, att_mask)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                                     device=lm_input.device)).to(torch.bool))
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             # force continue decode first token
             if i == 0:
@@ -244,6 +259,20 @@ class Qwen2Encoder(torch.nn.Module):
         )
         return outs.hidden_states[-1], masks.unsqueeze(1)
 
+    def forward_packed(self, xs: torch.Tensor, position_ids: torch.Tensor, seq_ids: torch.Tensor):
+        """ Rows holding several sequences, each attends causally to itself only """
+        if getattr(self.model.config, '_attn_implementation', '') == 'flash_attention_2':
+            # NOTE flash attention finds sequence starts from position_ids resets and runs varlen kernels, no dense mask
+            outs = self.model(inputs_embeds=xs, position_ids=position_ids, output_hidden_states=True, return_dict=True)
+        else:
+            T = xs.size(1)
+            causal = torch.ones(T, T, dtype=torch.bool, device=xs.device).tril()
+            allowed = (seq_ids.unsqueeze(2) == seq_ids.unsqueeze(1)) & causal
+            # block diagonal causal 4d mask, 0 to attend and dtype min elsewhere
+            masks = torch.zeros(allowed.shape, dtype=xs.dtype, device=xs.device).masked_fill(~allowed, torch.finfo(xs.dtype).min).unsqueeze(1)
+            outs = self.model(inputs_embeds=xs, attention_mask=masks, position_ids=position_ids, output_hidden_states=True, return_dict=True)
+        return outs.hidden_states[-1], None
+
     def forward_one_step(self, xs, masks, cache=None):
         input_masks = masks[:, -1, :]
         outs = self.model(
@@ -270,6 +299,7 @@ class Qwen2LM(TransformerLM):
             length_normalized_loss: bool = True,
             lsm_weight: float = 0.0,
             mix_ratio: List[int] = [5, 15],
+            pack_len: int = 0,
     ):
         torch.nn.Module.__init__(self)
         self.llm_input_size = llm_input_size
@@ -296,52 +326,89 @@ class Qwen2LM(TransformerLM):
         # 4. sampling method
         self.sampling = sampling
         self.mix_ratio = mix_ratio
+        # NOTE pack_len > 0 packs several utterances into one row of pack_len in training
+        self.pack_len = pack_len
+        # NOTE forward_dpo returns the drawn layout, cached reference log-probs keep one value per layout
+        self.dpo_bistream_prob = 0.5
 
         # 5. vllm related
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
         self.vllm_output_queue = {}
 
-    def prepare_lm_input_target(self, text_token, text_token_emb, text_token_len, speech_token, speech_token_emb, speech_token_len):
-        lm_target, lm_input = [], []
-        text_token = unpad_sequence(text_token, text_token_len.cpu(), batch_first=True)
-        speech_token = unpad_sequence(speech_token, speech_token_len.cpu(), batch_first=True)
-        text_token_emb = unpad_sequence(text_token_emb, text_token_len.cpu(), batch_first=True)
-        speech_token_emb = unpad_sequence(speech_token_emb, speech_token_len.cpu(), batch_first=True)
-        for i in range(len(text_token)):
-            # bistream sequence
-            if random.random() < 0.5 and speech_token_len[i] / text_token_len[i] > self.mix_ratio[1] / self.mix_ratio[0]:
-                this_lm_target, this_lm_input = [], []
-                this_lm_target.append(IGNORE_ID)
-                this_lm_input.append(self.llm_embedding.weight[self.sos_eos].reshape(1, -1))
-                for j in range(((text_token_len[i] + 1) / self.mix_ratio[0]).ceil().int().item()):
-                    this_text_token = text_token[i][j * self.mix_ratio[0]: (j + 1) * self.mix_ratio[0]].tolist()
-                    this_speech_token = speech_token[i][j * self.mix_ratio[1]: (j + 1) * self.mix_ratio[1]].tolist()
-                    if len(this_text_token) == self.mix_ratio[0]:
-                        assert len(this_speech_token) == self.mix_ratio[1]
-                        this_lm_target += [IGNORE_ID] * (self.mix_ratio[0] - 1)
-                        this_lm_target += this_speech_token
-                        this_lm_target.append(self.speech_token_size + 2)
-                        this_lm_input.append(text_token_emb[i][j * self.mix_ratio[0]: (j + 1) * self.mix_ratio[0]])
-                        this_lm_input.append(speech_token_emb[i][j * self.mix_ratio[1]: (j + 1) * self.mix_ratio[1]])
-                    else:
-                        this_lm_target += [-1] * len(this_text_token)
-                        this_lm_target += speech_token[i][j * self.mix_ratio[1]:].tolist()
-                        this_lm_target.append(self.speech_token_size)
-                        this_lm_input.append(text_token_emb[i][j * self.mix_ratio[0]:])
-                        this_lm_input.append(self.llm_embedding.weight[self.task_id].reshape(1, -1))
-                        this_lm_input.append(speech_token_emb[i][j * self.mix_ratio[1]:])
-                this_lm_target, this_lm_input = torch.tensor(this_lm_target), torch.concat(this_lm_input, dim=0)
-            # unistream sequence
-            else:
-                this_lm_target = torch.tensor([IGNORE_ID] * (1 + text_token_len[i]) + speech_token[i].tolist() + [self.speech_token_size])
-                this_lm_input = torch.concat([self.llm_embedding.weight[self.sos_eos].reshape(1, -1), text_token_emb[i],
-                                              self.llm_embedding.weight[self.task_id].reshape(1, -1), speech_token_emb[i]], dim=0)
-            lm_target.append(this_lm_target)
-            lm_input.append(this_lm_input)
-        lm_input_len = torch.tensor([i.size(0) for i in lm_input], dtype=torch.int32)
-        lm_input = pad_sequence(lm_input, batch_first=True, padding_value=IGNORE_ID)
-        lm_target = pad_sequence(lm_target, batch_first=True, padding_value=IGNORE_ID)
-        return lm_target, lm_input, lm_input_len
+    @staticmethod
+    def pack_rows(seq_len, pack_len):
+        """ First fit decreasing of sequences into rows of pack_len, a longer sequence gets a row of its own.
+            Returns row and offset of every sequence and the filled length of every row.
+        """
+        row, offset, row_fill = [0] * len(seq_len), [0] * len(seq_len), []
+        for i in sorted(range(len(seq_len)), key=lambda i: -seq_len[i]):
+            r = next((r for r, fill in enumerate(row_fill) if fill + seq_len[i] <= pack_len), len(row_fill))
+            if r == len(row_fill):
+                row_fill.append(0)
+            row[i], offset[i] = r, row_fill[r]
+            row_fill[r] += seq_len[i]
+        return row, offset, row_fill
+
+    def prepare_lm_input_target(self, text_token, text_token_emb, text_token_len, speech_token, speech_token_emb, speech_token_len, pack_len=0,
+                                bistream_prob=0.5, bistream=None):
+        """ Scatter sos, text, task id and speech embeddings of every sample into llm rows and build the targets, no per sample loop.
+            unistream: sos text task speech
+            bistream: sos (mix_ratio[0] text, mix_ratio[1] speech)*n text tail task speech tail, every full chunk target ends with a fill token
+            unistream is bistream with n = 0, so both share one layout. With pack_len > 0 samples are packed into rows of pack_len.
+            A sample long enough for bistream goes bistream with bistream_prob, or where the given bistream (B,) is set.
+
+            Returns:
+                lm_target (R, L), lm_input (R, L, D), lm_input_len (R,), position_ids (R, L) and seq_ids (R, L)
+        """
+        device, B = text_token_emb.device, text_token.size(0)
+        a, b = self.mix_ratio
+        text_token_len, speech_token_len = text_token_len.to(device).long(), speech_token_len.to(device).long()
+        if bistream is None:
+            bistream = torch.rand(B, device=device) < bistream_prob
+        bistream = bistream.to(device) & (speech_token_len * a > text_token_len * b)
+        n = torch.where(bistream, text_token_len // a, torch.zeros_like(text_token_len)).unsqueeze(1)
+        T, S = text_token_len.unsqueeze(1), speech_token_len.unsqueeze(1)
+        seq_len = text_token_len + speech_token_len + 2
+        seq_len_list = seq_len.tolist()
+        if pack_len > 0:
+            row, offset, row_fill = self.pack_rows(seq_len_list, pack_len)
+        else:
+            row, offset, row_fill = list(range(B)), [0] * B, seq_len_list
+        R, L = len(row_fill), max(row_fill)
+        # NOTE flat index of every sample start, positions below are relative to it
+        base = (torch.tensor(row, device=device) * L + torch.tensor(offset, device=device)).unsqueeze(1)
+        t = torch.arange(text_token.size(1), device=device).unsqueeze(0)
+        s = torch.arange(speech_token.size(1), device=device).unsqueeze(0)
+        text_pos = torch.where(t < a * n, 1 + (a + b) * (t // a) + t % a, 1 + (a + b) * n + t - a * n)
+        speech_pos = torch.where(s < b * n, 1 + (a + b) * (s // b) + a + s % b, 2 + (a + b) * n + T - a * n + s - b * n)
+        task_pos = 1 + (a + b) * n + T - a * n
+        text_mask, speech_mask = t < T, s < S
+
+        lm_input = text_token_emb.new_full((R * L, text_token_emb.size(2)), IGNORE_ID)
+        lm_input[base.squeeze(1)] = self.llm_embedding.weight[self.sos_eos].to(lm_input.dtype)
+        lm_input[(base + task_pos).squeeze(1)] = self.llm_embedding.weight[self.task_id].to(lm_input.dtype)
+        lm_input[(base + text_pos)[text_mask]] = text_token_emb[text_mask]
+        lm_input[(base + speech_pos)[speech_mask]] = speech_token_emb[speech_mask].to(lm_input.dtype)
+
+        lm_target = torch.full((R * L,), IGNORE_ID, dtype=torch.long, device=device)
+        lm_target[(base + speech_pos - 1)[speech_mask]] = speech_token[speech_mask].long()
+        j = torch.arange(int(n.max()) if B > 0 else 0, device=device).unsqueeze(0)
+        lm_target[(base + (a + b) * (j + 1))[j < n]] = self.speech_token_size + 2
+        lm_target[base.squeeze(1) + seq_len - 1] = self.speech_token_size
+
+        # NOTE every sample restarts position ids, padding after the row fill is a sequence of its own
+        seq_ids = torch.full((R * L,), -1, dtype=torch.long, device=device)
+        position_ids = torch.zeros(R * L, dtype=torch.long, device=device)
+        p = torch.arange(int(seq_len.max()) if B > 0 else 0, device=device).unsqueeze(0)
+        valid = p < seq_len.unsqueeze(1)
+        seq_ids[(base + p)[valid]] = torch.arange(B, device=device).unsqueeze(1).expand_as(p)[valid]
+        position_ids[(base + p)[valid]] = p.expand(B, -1)[valid]
+        row_fill = torch.tensor(row_fill, device=device)
+        col = torch.arange(L, device=device).unsqueeze(0)
+        padding = col >= row_fill.unsqueeze(1)
+        position_ids = torch.where(padding, col - row_fill.unsqueeze(1), position_ids.view(R, L))
+        seq_ids = torch.where(padding, B + torch.arange(R, device=device).unsqueeze(1), seq_ids.view(R, L))
+        return lm_target.view(R, L), lm_input.view(R, L, -1), row_fill.int(), position_ids, seq_ids
 
     def forward(
             self,
@@ -367,13 +434,19 @@ class Qwen2LM(TransformerLM):
         speech_token_emb = self.speech_embedding(speech_token)
 
         # 3. prepare llm_input/target
-        lm_target, lm_input, lm_input_len = self.prepare_lm_input_target(text_token, text_token_emb, text_token_len, speech_token, speech_token_emb, speech_token_len)
-        lm_target = lm_target.to(device)
+        lm_target, lm_input, lm_input_len, position_ids, seq_ids = self.prepare_lm_input_target(text_token, text_token_emb, text_token_len, speech_token,
+                                                                                                speech_token_emb, speech_token_len, pack_len=self.pack_len)
 
         # 4. run lm forward
-        lm_output, lm_output_mask = self.llm(lm_input, lm_input_len.to(device))
+        if self.pack_len > 0:
+            lm_output, lm_output_mask = self.llm.forward_packed(lm_input, position_ids, seq_ids)
+        else:
+            lm_output, lm_output_mask = self.llm(lm_input, lm_input_len)
         logits = self.llm_decoder(lm_output)
-        loss = self.criterion_ce(logits, lm_target.to(device))
+        loss = self.criterion_ce(logits, lm_target)
+        if self.pack_len > 0 and self.criterion_ce.normalize_length is False:
+            # NOTE criterion divides by rows, keep the per utterance normalization of the padded path
+            loss = loss * lm_target.size(0) / text_token.size(0)
         acc = th_accuracy(logits.view(-1, self.speech_token_size + 3), lm_target, ignore_label=IGNORE_ID)
         return {'loss': loss, 'acc': acc}
 
@@ -401,12 +474,18 @@ class Qwen2LM(TransformerLM):
         speech_token_combined_emb = self.speech_embedding(speech_token_combined)
 
         # 3. prepare llm_input/target
-        lm_target, lm_input, lm_input_len = self.prepare_lm_input_target(text_token.repeat(2, 1), text_token_emb.repeat(2, 1, 1), text_token_len.repeat(2),
-                                                                         speech_token_combined, speech_token_combined_emb, speech_token_combined_len)
-        lm_target = lm_target.to(device)
+        # NOTE chosen and rejected logits are split by row, dpo always uses the padded layout
+        # NOTE batch['dpo_bistream'] replays the policy layout on ref_model, else draw one per row
+        if 'dpo_bistream' in batch:
+            bistream = batch['dpo_bistream'].to(device)
+        else:
+            bistream = torch.rand(speech_token_combined_len.size(0), device=device) < self.dpo_bistream_prob
+        lm_target, lm_input, lm_input_len, _, _ = self.prepare_lm_input_target(text_token.repeat(2, 1), text_token_emb.repeat(2, 1, 1), text_token_len.repeat(2),
+                                                                               speech_token_combined, speech_token_combined_emb, speech_token_combined_len,
+                                                                               bistream=bistream)
 
         # 4. run lm forward
-        lm_output, lm_output_mask = self.llm(lm_input, lm_input_len.to(device))
+        lm_output, lm_output_mask = self.llm(lm_input, lm_input_len)
         logits = self.llm_decoder(lm_output)
         chosen_logits = logits[:text_token.shape[0]]
         rejected_logits = logits[text_token.shape[0]:]
@@ -422,7 +501,7 @@ class Qwen2LM(TransformerLM):
         rejected_logps = torch.gather(rejected_logits.log_softmax(dim=-1), dim=2, index=rejected_lm_target.masked_fill(rejected_lm_mask, 0).unsqueeze(dim=-1)).squeeze(dim=-1)
         chosen_logps = (chosen_logps * chosen_lm_mask).sum(dim=-1) / chosen_lm_mask.sum(dim=-1)
         rejected_logps = (rejected_logps * rejected_lm_mask).sum(dim=-1) / rejected_lm_mask.sum(dim=-1)
-        return {'loss': loss, 'acc': acc, 'chosen_logps': chosen_logps, 'rejected_logps': rejected_logps}
+        return {'loss': loss, 'acc': acc, 'chosen_logps': chosen_logps, 'rejected_logps': rejected_logps, 'dpo_bistream': bistream}
 
     @torch.inference_mode()
     def inference(
@@ -438,6 +517,7 @@ class Qwen2LM(TransformerLM):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            top_k: int = None,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
@@ -458,14 +538,14 @@ class Qwen2LM(TransformerLM):
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
         # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, top_k):
             yield token
 
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, top_k=None):
         if hasattr(self, 'vllm'):
             from vllm import SamplingParams, RequestOutput
-            sampling_params = SamplingParams(top_k=sampling,
+            sampling_params = SamplingParams(top_k=sampling if top_k is None else top_k,
                                              stop_token_ids=self.stop_token_ids,
                                              min_tokens=min_len,
                                              max_tokens=max_len)
@@ -500,7 +580,7 @@ class Qwen2LM(TransformerLM):
                                                           masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
                                                           cache=cache)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False, top_k=top_k).item()
                 if top_ids == self.speech_token_size:
                     break
                 if top_ids > self.speech_token_size:
@@ -522,6 +602,7 @@ class Qwen2LM(TransformerLM):
             sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
+            top_k: int = None,
     ) -> Generator[torch.Tensor, None, None]:
 
         device = prompt_text.device
@@ -553,7 +634,8 @@ class Qwen2LM(TransformerLM):
                     logging.info('not enough text token to decode, wait for more')
                     break
             # no prompt_speech_token_emb remain, can decode some speech token
-            if prompt_speech_token_emb.size(1) == 0:
+            # NOTE text may arrive in batches of several tokens, keep decoding while a full text chunk is buffered
+            while prompt_speech_token_emb.size(1) == 0:
                 if (len(out_tokens) != 0 and out_tokens[-1] == self.speech_token_size + 2) or (len(out_tokens) == 0 and lm_input.size(1) == 1):
                     logging.info('get fill token, need to append more text token')
                     if text_cache.size(1) >= self.mix_ratio[0]:
@@ -566,7 +648,7 @@ class Qwen2LM(TransformerLM):
                         text_cache = text_cache[:, self.mix_ratio[0]:]
                     else:
                         logging.info('not enough text token to decode, wait for more')
-                        continue
+                        break
                 while True:
                     seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
                     y_pred, cache = self.llm.forward_one_step(lm_input,
@@ -577,7 +659,7 @@ class Qwen2LM(TransformerLM):
                         top_ids = self.speech_token_size + 2
                         next_fill_index += (self.mix_ratio[1] + 1)
                     else:
-                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True).item()
+                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True, top_k=top_k).item()
                     if top_ids == self.speech_token_size + 2:
                         next_fill_index = len(out_tokens) + self.mix_ratio[1] + 1
                         logging.info('fill_token index {} next fill_token index {}'.format(len(out_tokens), next_fill_index))
@@ -599,7 +681,7 @@ class Qwen2LM(TransformerLM):
                                                       masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
                                                       cache=cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False).item()
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False, top_k=top_k).item()
             out_tokens.append(top_ids)
             if top_ids >= self.speech_token_size:
                 if top_ids == self.speech_token_size:
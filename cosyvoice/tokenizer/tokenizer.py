@@ -1,10 +1,11 @@
 import base64
 import os
 from functools import lru_cache
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 import torch
 from transformers import AutoTokenizer
-from whisper.tokenizer import Tokenizer
+if TYPE_CHECKING:
+    from whisper.tokenizer import Tokenizer
 
 import tiktoken
 
@@ -213,7 +214,9 @@ def get_tokenizer(
     num_languages: int = 99,
     language: Optional[str] = None,
     task: Optional[str] = None,  # Literal["transcribe", "translate", None]
-) -> Tokenizer:
+) -> "Tokenizer":
+    # NOTE whisper is only needed by CosyVoice1 tokenizer
+    from whisper.tokenizer import Tokenizer
     if language is not None:
         language = language.lower()
         if language not in LANGUAGES:
@@ -261,9 +264,11 @@ class QwenTokenizer():
         self.skip_special_tokens = skip_special_tokens
 
     def encode(self, text, **kwargs):
-        tokens = self.tokenizer([text], return_tensors="pt")
-        tokens = tokens["input_ids"][0].cpu().tolist()
-        return tokens
+        # NOTE plain python lists, no round trip through a torch tensor
+        return self.tokenizer(text)["input_ids"]
+
+    def batch_encode(self, texts, **kwargs):
+        return self.tokenizer(list(texts))["input_ids"]
 
     def decode(self, tokens):
         tokens = torch.tensor(tokens, dtype=torch.int64)
@@ -17,10 +17,11 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 
 
 class MultiHeadedAttention(nn.Module):
@@ -49,6 +50,8 @@ class MultiHeadedAttention(nn.Module):
         self.linear_v = nn.Linear(n_feat, n_feat)
         self.linear_out = nn.Linear(n_feat, n_feat)
         self.dropout = nn.Dropout(p=dropout_rate)
+        # NOTE opt-in fused attention, see set_sdpa
+        self.use_sdpa = False
 
     def forward_qkv(
         self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor
@@ -126,6 +129,59 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    def forward_sdpa(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        bias: torch.Tensor = torch.empty(0)
+    ) -> torch.Tensor:
+        """Compute attention context vector with fused scaled_dot_product_attention.
+
+        Args:
+            query (torch.Tensor): Transformed query, size
+                (#batch, n_head, time1, d_k).
+            key (torch.Tensor): Transformed key, size
+                (#batch, n_head, time2, d_k).
+            value (torch.Tensor): Transformed value, size
+                (#batch, n_head, time2, d_k).
+            mask (torch.Tensor): Mask, size (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            bias (torch.Tensor): Additive attention bias already scaled by
+                1 / sqrt(d_k), size (#batch, n_head, time1, time2), empty
+                means no bias.
+
+        Returns:
+            torch.Tensor: Transformed value (#batch, time1, d_model), equals
+                forward_attention on the same scores.
+
+        """
+        n_batch = value.size(0)
+        # NOTE annotate Optional, torch.jit.script compiles this method even when use_sdpa is False
+        attn_mask: Optional[torch.Tensor] = None
+        valid: Optional[torch.Tensor] = None
+        if mask.size(2) > 0:  # time2 > 0
+            mask = mask.unsqueeze(1)[:, :, :, :key.size(2)]  # (batch, 1, *, time2)
+            # NOTE rows without any visible key output zeros in forward_attention,
+            #   let them attend everywhere to avoid nan and zero them afterwards
+            visible = mask.any(dim=-1, keepdim=True)
+            attn_mask, valid = mask | ~visible, visible
+        if bias.size(0) > 0:
+            if attn_mask is None:
+                attn_mask = bias
+            else:
+                attn_mask = bias.masked_fill(~attn_mask, -float('inf'))
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask,
+                                           dropout_p=self.dropout.p if self.training else 0.0)
+        if valid is not None:
+            x = x.masked_fill(~valid, 0.0)
+        x = (x.transpose(1, 2).contiguous().view(n_batch, -1,
+                                                 self.h * self.d_k)
+             )  # (batch, time1, d_model)
+
+        return self.linear_out(x)  # (batch, time1, d_model)
+
     def forward(
         self,
         query: torch.Tensor,
@@ -133,7 +189,8 @@ class MultiHeadedAttention(nn.Module):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute scaled dot product attention.
 
@@ -156,6 +213,9 @@ class MultiHeadedAttention(nn.Module):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_offset (int): >=0 means cache is a preallocated buffer
+                (1, head, max_cache_t, d_k * 2) holding cache_offset frames,
+                which is updated in place, <0 means concat mode.
 
 
         Returns:
@@ -183,16 +243,26 @@ class MultiHeadedAttention(nn.Module):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
-
+        if cache_offset >= 0:
+            # NOTE preallocated cache (1, head, max_cache_t, d_k * 2), write
+            #   new key & value at cache_offset instead of concat and split
+            cache[:, :, cache_offset:cache_offset + k.size(2), :self.d_k] = k
+            cache[:, :, cache_offset:cache_offset + k.size(2), self.d_k:] = v
+            new_cache = cache[:, :, :cache_offset + k.size(2)]
+            k, v = new_cache[:, :, :, :self.d_k], new_cache[:, :, :, self.d_k:]
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+            #   non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
+
+        if self.use_sdpa is True:
+            return self.forward_sdpa(q, k, v, mask), new_cache
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
@@ -253,7 +323,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute 'Scaled Dot Product Attention' with rel. positional encoding.
         Args:
@@ -267,6 +338,9 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_offset (int): >=0 means cache is a preallocated buffer
+                (1, head, max_cache_t, d_k * 2) holding cache_offset frames,
+                which is updated in place, <0 means concat mode.
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
@@ -292,15 +366,23 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if cache_offset >= 0:
+            # NOTE preallocated cache (1, head, max_cache_t, d_k * 2), write
+            #   new key & value at cache_offset instead of concat and split
+            cache[:, :, cache_offset:cache_offset + k.size(2), :self.d_k] = k
+            cache[:, :, cache_offset:cache_offset + k.size(2), self.d_k:] = v
+            new_cache = cache[:, :, :cache_offset + k.size(2)]
+            k, v = new_cache[:, :, :, :self.d_k], new_cache[:, :, :, self.d_k:]
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+            #   non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
@@ -312,19 +394,43 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
 
         # compute attention score
-        # first compute matrix a and matrix c
         # as described in https://arxiv.org/abs/1901.02860 Section 3.3
-        # (batch, head, time1, time2)
-        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
-
-        # compute matrix b and matrix d
+        # first compute matrix b and matrix d
         # (batch, head, time1, time2)
         matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
-        # NOTE(Xiang Lyu): Keep rel_shift since espnet rel_pos_emb is used
-        if matrix_ac.shape != matrix_bd.shape:
+        # NOTE(Xiang Lyu): Keep rel_shift since espnet rel_pos_emb is used,
+        #   matrix ac would be (batch, head, time1, k.size(2))
+        if matrix_bd.size(-1) != k.size(2):
             matrix_bd = self.rel_shift(matrix_bd)
 
+        if self.use_sdpa is True:
+            # NOTE fold matrix bd into attention bias, matrix ac is computed by the fused kernel
+            return self.forward_sdpa(q_with_bias_u, k, v, mask, matrix_bd / math.sqrt(self.d_k)), new_cache
+        # then compute matrix a and matrix c
+        # (batch, head, time1, time2)
+        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
         scores = (matrix_ac + matrix_bd) / math.sqrt(
             self.d_k)  # (batch, head, time1, time2)
 
         return self.forward_attention(v, scores, mask), new_cache
+
+
+def set_sdpa(model: nn.Module, enable: bool = True) -> int:
+    """Switch attention modules of model between manual and fused attention.
+
+    Covers MultiHeadedAttention and its subclasses, and the diffusers Attention
+    used by the flow decoder transformer blocks.
+
+    Returns:
+        int: number of switched modules.
+    """
+    n = 0
+    for module in model.modules():
+        if isinstance(module, MultiHeadedAttention):
+            module.use_sdpa = enable
+            n += 1
+        elif hasattr(module, 'set_processor'):
+            from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+            module.set_processor(AttnProcessor2_0() if enable is True else AttnProcessor())
+            n += 1
+    return n
@@ -271,6 +271,85 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def init_inplace_cache(
+        self,
+        max_cache_t: int,
+        device: torch.device,
+        dtype: torch.dtype = torch.float32,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Preallocate caches for forward_chunk_inplace
+
+        Args:
+            max_cache_t (int): max number of frames fed in one decoding
+
+        Returns:
+            torch.Tensor: att_cache (elayers, head, max_cache_t, d_k * 2)
+            torch.Tensor: cnn_cache (elayers, b=1, hidden-dim, cache_t2),
+                (0, 0, 0, 0) if there is no causal conv module
+        """
+        self_attn = self.encoders[0].self_attn
+        att_cache = torch.zeros((len(self.encoders), self_attn.h, max_cache_t, self_attn.d_k * 2), device=device, dtype=dtype)
+        conv_module = getattr(self.encoders[0], 'conv_module', None)
+        if conv_module is not None and conv_module.lorder > 0:
+            # NOTE zero cache equals the zero padding used for the first chunk
+            cnn_cache = torch.zeros((len(self.encoders), 1, self._output_size, conv_module.lorder), device=device, dtype=dtype)
+        else:
+            cnn_cache = torch.zeros((0, 0, 0, 0), device=device, dtype=dtype)
+        return att_cache, cnn_cache
+
+    @torch.jit.unused
+    def forward_chunk_inplace(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        att_cache: torch.Tensor,
+        cnn_cache: torch.Tensor,
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> torch.Tensor:
+        """ Forward just one chunk with preallocated caches
+
+        Same as forward_chunk with required_cache_size < 0, but key & value
+        are written into att_cache at offset, so no cache is concatenated
+        or sliced per chunk.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim)
+            offset (int): number of frames already in att_cache
+            att_cache (torch.Tensor): preallocated cache from
+                init_inplace_cache, updated in place
+            cnn_cache (torch.Tensor): preallocated cache from
+                init_inplace_cache, updated in place
+            att_mask (torch.Tensor): (b=1, time, offset + time), (0, 0, 0)
+                means every frame sees all history, which holds for a single
+                frame step
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, chunk_size, hidden-dim).
+        """
+        assert xs.size(0) == 1
+        assert offset + xs.size(1) <= att_cache.size(2), 'att_cache is too short, increase max_cache_t'
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        pos_emb = self.embed.position_encoding(offset=0, size=offset + xs.size(1))
+        for i, layer in enumerate(self.encoders):
+            xs, _, _, new_cnn_cache = layer(
+                xs,
+                att_mask,
+                pos_emb,
+                att_cache=att_cache[i:i + 1],
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache,
+                cache_offset=offset)
+            if cnn_cache.size(0) > 0:
+                cnn_cache[i].copy_(new_cnn_cache)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
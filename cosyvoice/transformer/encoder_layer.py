@@ -63,6 +63,7 @@ class TransformerEncoderLayer(nn.Module):
         mask_pad: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         att_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
         cnn_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """Compute encoded features.
 
@@ -79,6 +80,8 @@ class TransformerEncoderLayer(nn.Module):
             cnn_cache (torch.Tensor): Convolution cache in conformer layer
                 (#batch=1, size, cache_t2), not used here, it's for interface
                 compatibility to ConformerEncoderLayer.
+            cache_offset (int): >=0 means att_cache is a preallocated buffer
+                updated in place, see MultiHeadedAttention.forward.
         Returns:
             torch.Tensor: Output tensor (#batch, time, size).
             torch.Tensor: Mask tensor (#batch, time, time).
@@ -90,7 +93,7 @@ class TransformerEncoderLayer(nn.Module):
         residual = x
         if self.normalize_before:
             x = self.norm1(x)
-        x_att, new_att_cache = self.self_attn(x, x, x, mask, pos_emb=pos_emb, cache=att_cache)
+        x_att, new_att_cache = self.self_attn(x, x, x, mask, pos_emb=pos_emb, cache=att_cache, cache_offset=cache_offset)
         x = residual + self.dropout(x_att)
         if not self.normalize_before:
             x = self.norm1(x)
@@ -165,6 +168,7 @@ class ConformerEncoderLayer(nn.Module):
         mask_pad: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         att_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
         cnn_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """Compute encoded features.
 
@@ -180,6 +184,8 @@ class ConformerEncoderLayer(nn.Module):
                 (#batch=1, head, cache_t1, d_k * 2), head * d_k == size.
             cnn_cache (torch.Tensor): Convolution cache in conformer layer
                 (#batch=1, size, cache_t2)
+            cache_offset (int): >=0 means att_cache is a preallocated buffer
+                updated in place, see MultiHeadedAttention.forward.
         Returns:
             torch.Tensor: Output tensor (#batch, time, size).
             torch.Tensor: Mask tensor (#batch, time, time).
@@ -203,7 +209,7 @@ class ConformerEncoderLayer(nn.Module):
         if self.normalize_before:
             x = self.norm_mha(x)
         x_att, new_att_cache = self.self_attn(x, x, x, mask, pos_emb,
-                                              att_cache)
+                                              att_cache, cache_offset)
         x = residual + self.dropout(x_att)
         if not self.normalize_before:
             x = self.norm_mha(x)
@@ -279,7 +279,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
         xs, pos_emb, masks = self.embed(xs, masks)
         if context.size(1) != 0:
             assert self.training is False, 'you have passed context, make sure that you are running inference mode'
-            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context_masks = torch.ones(1, 1, context.size(1), dtype=masks.dtype, device=masks.device)
             context, _, _ = self.embed(context, context_masks, offset=xs.size(1))
         mask_pad = masks  # (B, 1, T/subsample_rate)
         chunk_masks = add_optional_chunk_mask(xs, masks, False, False, 0, self.static_chunk_size if streaming is True else 0, -1)
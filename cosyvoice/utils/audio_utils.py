@@ -0,0 +1,61 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from functools import lru_cache
+import math
+
+import torch
+
+# whisper front end constants, speech tokenizer expects 16k audio
+SAMPLE_RATE = 16000
+N_FFT = 400
+HOP_LENGTH = 160
+
+
+def _hz_to_mel(freq):
+    # slaney mel scale, linear below 1khz and logarithmic above
+    f_sp, min_log_hz = 200.0 / 3, 1000.0
+    if freq < min_log_hz:
+        return freq / f_sp
+    return min_log_hz / f_sp + math.log(freq / min_log_hz) / (math.log(6.4) / 27.0)
+
+
+def _mel_to_hz(mels):
+    f_sp, min_log_hz = 200.0 / 3, 1000.0
+    min_log_mel, logstep = min_log_hz / f_sp, math.log(6.4) / 27.0
+    return torch.where(mels >= min_log_mel, min_log_hz * torch.exp(logstep * (mels - min_log_mel)), f_sp * mels)
+
+
+@lru_cache(maxsize=None)
+def mel_filters(n_mels, sample_rate=SAMPLE_RATE, n_fft=N_FFT):
+    """Slaney normalized mel filterbank (n_mels, n_fft // 2 + 1), same as librosa.filters.mel used by whisper."""
+    fftfreqs = torch.linspace(0, sample_rate / 2, n_fft // 2 + 1, dtype=torch.float64)
+    mel_f = _mel_to_hz(torch.linspace(_hz_to_mel(0.0), _hz_to_mel(sample_rate / 2), n_mels + 2, dtype=torch.float64))
+    fdiff = mel_f[1:] - mel_f[:-1]
+    ramps = mel_f.unsqueeze(1) - fftfreqs.unsqueeze(0)
+    lower = -ramps[:-2] / fdiff[:-1].unsqueeze(1)
+    upper = ramps[2:] / fdiff[1:].unsqueeze(1)
+    weights = torch.clamp(torch.minimum(lower, upper), min=0)
+    enorm = 2.0 / (mel_f[2:n_mels + 2] - mel_f[:n_mels])
+    return (weights * enorm.unsqueeze(1)).float()
+
+
+def log_mel_spectrogram(audio: torch.Tensor, n_mels: int = 128):
+    """Drop-in for whisper.log_mel_spectrogram on 16k audio tensor (*, T), returns (*, n_mels, T // 160)."""
+    window = torch.hann_window(N_FFT, device=audio.device)
+    stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=window, return_complex=True)
+    magnitudes = stft[..., :-1].abs() ** 2
+    mel_spec = mel_filters(n_mels).to(audio.device) @ magnitudes
+    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+    return (log_spec + 4.0) / 4.0
@@ -140,14 +140,25 @@ def random_sampling(weighted_scores, decoded_tokens, sampling):
 
 
 def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+    # NOTE pass window as a tensor on the same device to blend without host round trip
+    if isinstance(window, np.ndarray):
+        window = torch.from_numpy(window)
+    window = window.to(fade_in_mel)
     mel_overlap_len = int(window.shape[0] / 2)
-    if fade_in_mel.device == torch.device('cpu'):
-        fade_in_mel = fade_in_mel.clone()
+    fade_in_mel = fade_in_mel.clone()
     fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
         fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+    return fade_in_mel
+
+
+def to_host(x):
+    """Copy x to cpu with a single async copy, only waiting for the current stream."""
+    if x.device.type != 'cuda':
+        return x
+    y = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+    y.copy_(x, non_blocking=True)
+    torch.cuda.current_stream(x.device).synchronize()
+    return y
 
 
 def set_all_random_seed(seed):
@@ -184,3 +195,30 @@ class TrtContextWrapper:
 
     def release_estimator(self, context, stream):
         self.trt_context_pool.put([context, stream])
+
+
+class DeviceTokenBuffer:
+    """Device resident copy of a session's speech token list.
+
+    Only tokens appended since the last call are uploaded, through a pinned staging
+    buffer, so a streaming hop does not rebuild and copy the whole token prefix.
+    """
+    def __init__(self, device, capacity=1024):
+        self.device = device
+        self.size = 0
+        self.host = torch.zeros(capacity, dtype=torch.int32, pin_memory=torch.device(device).type == 'cuda')
+        self.buffer = torch.zeros(1, capacity, dtype=torch.int32, device=device)
+
+    def __call__(self, tokens, length):
+        """Return tokens[:length] as a (1, length) device tensor."""
+        if length > self.size:
+            if length > self.buffer.shape[1]:
+                capacity = max(length, 2 * self.buffer.shape[1])
+                host = torch.zeros(capacity, dtype=torch.int32, pin_memory=self.host.is_pinned())
+                buffer = torch.zeros(1, capacity, dtype=torch.int32, device=self.device)
+                buffer[:, :self.size] = self.buffer[:, :self.size]
+                self.host, self.buffer = host, buffer
+            self.host[self.size:length] = torch.tensor(tokens[self.size:length], dtype=torch.int32)
+            self.buffer[0, self.size:length].copy_(self.host[self.size:length], non_blocking=True)
+            self.size = length
+        return self.buffer[:, :length]
@@ -20,15 +20,18 @@ import os
 import torch
 import torch.distributed as dist
 
-from cosyvoice.utils.train_utils import update_parameter_and_lr, log_per_step, log_per_save, batch_forward, batch_backward, save_model, cosyvoice_join
+from cosyvoice.utils.train_utils import update_parameter_and_lr, log_per_step, log_per_save, batch_forward, batch_backward, save_model, cosyvoice_join, \
+    update_throughput, StepProfiler
 
 
 class Executor:
 
-    def __init__(self, gan: bool = False, ref_model: torch.nn.Module = None, dpo_loss: torch.nn.Module = None):
+    def __init__(self, gan: bool = False, ref_model: torch.nn.Module = None, dpo_loss: torch.nn.Module = None,
+                 teacher_model: torch.nn.Module = None):
         self.gan = gan
         self.ref_model = ref_model
         self.dpo_loss = dpo_loss
+        self.teacher_model = teacher_model
         self.step = 0
         self.epoch = 0
         self.rank = int(os.environ.get('RANK', 0))
@@ -48,15 +51,20 @@ class Executor:
         model.train()
         if self.ref_model is not None:
             self.ref_model.eval()
+        if self.teacher_model is not None:
+            self.teacher_model.eval()
         model_context = model.join if info_dict['train_engine'] == 'torch_ddp' else nullcontext
+        profiler = StepProfiler(info_dict)
         with model_context():
             for batch_idx, batch_dict in enumerate(train_data_loader):
+                profiler.mark('dataloader')
                 info_dict["tag"] = "TRAIN"
                 info_dict["step"] = self.step
                 info_dict["epoch"] = self.epoch
                 info_dict["batch_idx"] = batch_idx
                 if cosyvoice_join(group_join, info_dict):
                     break
+                batch_dict = profiler.to_device(batch_dict)
 
                 # Disable gradient synchronizations across DDP processes.
                 # Within this context, gradients will be accumulated on module
@@ -69,10 +77,16 @@ class Executor:
                     context = nullcontext
 
                 with context():
-                    info_dict = batch_forward(model, batch_dict, scaler, info_dict, ref_model=self.ref_model, dpo_loss=self.dpo_loss)
+                    info_dict = batch_forward(model, batch_dict, scaler, info_dict, ref_model=self.ref_model, dpo_loss=self.dpo_loss,
+                                              teacher_model=self.teacher_model)
+                    profiler.mark('forward')
                     info_dict = batch_backward(model, scaler, info_dict)
+                    profiler.mark('backward')
 
                 info_dict = update_parameter_and_lr(model, optimizer, scheduler, scaler, info_dict)
+                profiler.mark('optimizer')
+                info_dict = update_throughput(info_dict, batch_dict)
+                info_dict = profiler.step(info_dict, batch_dict)
                 log_per_step(writer, info_dict)
                 # NOTE specify save_per_step in cosyvoice2.yaml if you want to enable step save
                 if info_dict['save_per_step'] > 0 and (self.step + 1) % info_dict['save_per_step'] == 0 and \
@@ -82,6 +96,8 @@ class Executor:
                     model.train()
                 if (batch_idx + 1) % info_dict["accum_grad"] == 0:
                     self.step += 1
+                profiler.reset()
+        profiler.close()
         dist.barrier()
         self.cv(model, cv_data_loader, writer, info_dict, on_batch_end=True)
 
@@ -99,14 +115,17 @@ class Executor:
         # with uneven inputs across participating processes.
         model.train()
         model_context = model.join if info_dict['train_engine'] == 'torch_ddp' else nullcontext
+        profiler = StepProfiler(info_dict)
         with model_context():
             for batch_idx, batch_dict in enumerate(train_data_loader):
+                profiler.mark('dataloader')
                 info_dict["tag"] = "TRAIN"
                 info_dict["step"] = self.step
                 info_dict["epoch"] = self.epoch
                 info_dict["batch_idx"] = batch_idx
                 if cosyvoice_join(group_join, info_dict):
                     break
+                batch_dict = profiler.to_device(batch_dict)
 
                 # Disable gradient synchronizations across DDP processes.
                 # Within this context, gradients will be accumulated on module
@@ -121,16 +140,24 @@ class Executor:
                 with context():
                     batch_dict['turn'] = 'discriminator'
                     info_dict = batch_forward(model, batch_dict, scaler, info_dict)
+                    profiler.mark('forward_d')
                     info_dict = batch_backward(model, scaler, info_dict)
+                    profiler.mark('backward_d')
                 info_dict = update_parameter_and_lr(model, optimizer_d, scheduler_d, scaler, info_dict)
                 optimizer.zero_grad()
+                profiler.mark('optimizer_d')
                 log_per_step(writer, info_dict)
                 with context():
                     batch_dict['turn'] = 'generator'
                     info_dict = batch_forward(model, batch_dict, scaler, info_dict)
+                    profiler.mark('forward')
                     info_dict = batch_backward(model, scaler, info_dict)
+                    profiler.mark('backward')
                 info_dict = update_parameter_and_lr(model, optimizer, scheduler, scaler, info_dict)
                 optimizer_d.zero_grad()
+                profiler.mark('optimizer')
+                info_dict = update_throughput(info_dict, batch_dict)
+                info_dict = profiler.step(info_dict, batch_dict)
                 log_per_step(writer, info_dict)
                 # NOTE specify save_per_step in cosyvoice2.yaml if you want to enable step save
                 if info_dict['save_per_step'] > 0 and (self.step + 1) % info_dict['save_per_step'] == 0 and \
@@ -140,6 +167,8 @@ class Executor:
                     model.train()
                 if (batch_idx + 1) % info_dict["accum_grad"] == 0:
                     self.step += 1
+                profiler.reset()
+        profiler.close()
         dist.barrier()
         self.cv(model, cv_data_loader, writer, info_dict, on_batch_end=True)
 
@@ -161,7 +190,7 @@ class Executor:
 
             if self.gan is True:
                 batch_dict['turn'] = 'generator'
-            info_dict = batch_forward(model, batch_dict, None, info_dict)
+            info_dict = batch_forward(model, batch_dict, None, info_dict, teacher_model=self.teacher_model)
 
             for k, v in info_dict['loss_dict'].items():
                 if k not in total_loss_dict:
@@ -17,7 +17,6 @@
 import os
 import json
 import torch
-import torchaudio
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 logging.basicConfig(level=logging.DEBUG,
@@ -42,6 +41,7 @@ def read_json_lists(list_file):
 
 
 def load_wav(wav, target_sr):
+    import torchaudio
     speech, sample_rate = torchaudio.load(wav, backend='soundfile')
     speech = speech.mean(dim=0, keepdim=True)
     if sample_rate != target_sr:
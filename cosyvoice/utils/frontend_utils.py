@@ -62,25 +62,14 @@ def spell_out_number(text: str, inflect_parser):
 # 1. per sentence max len token_max_n, min len token_min_n, merge if last sentence len less than merge_len
 # 2. cal sentence len according to lang
 # 3. split sentence according to puncatation
-def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False):
-    def calc_utt_length(_text: str):
-        if lang == "zh":
-            return len(_text)
-        else:
-            return len(tokenize(_text))
-
-    def should_merge(_text: str):
-        if lang == "zh":
-            return len(_text) < merge_len
-        else:
-            return len(tokenize(_text)) < merge_len
-
+def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False, batch_tokenize=None):
     if lang == "zh":
         pounc = ['。', '？', '！', '；', '：', '、', '.', '?', '!', ';']
     else:
         pounc = ['.', '?', '!', ';', ':']
     if comma_split:
         pounc.extend(['，', ','])
+    pounc = set(pounc)
 
     if text[-1] not in pounc:
         if lang == "zh":
@@ -92,7 +81,7 @@ def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=
     utts = []
     for i, c in enumerate(text):
         if c in pounc:
-            if len(text[st: i]) > 0:
+            if i > st:
                 utts.append(text[st: i] + c)
             if i + 1 < len(text) and text[i + 1] in ['"', '”']:
                 tmp = utts.pop(-1)
@@ -101,22 +90,68 @@ def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=
             else:
                 st = i + 1
 
+    # NOTE each sentence is measured once and lengths are accumulated, instead of re-tokenizing the merged text,
+    # for en the sum of sentence token counts may differ from the merged text by a token at sentence boundaries
+    if lang == "zh":
+        utt_lens = [len(utt) for utt in utts]
+    elif batch_tokenize is not None:
+        utt_lens = [len(i) for i in batch_tokenize(utts)] if len(utts) > 0 else []
+    else:
+        utt_lens = [len(tokenize(utt)) for utt in utts]
+
     final_utts = []
-    cur_utt = ""
-    for utt in utts:
-        if calc_utt_length(cur_utt + utt) > token_max_n and calc_utt_length(cur_utt) > token_min_n:
-            final_utts.append(cur_utt)
-            cur_utt = ""
-        cur_utt = cur_utt + utt
+    cur_utt, cur_len = [], 0
+    for utt, utt_len in zip(utts, utt_lens):
+        if cur_len + utt_len > token_max_n and cur_len > token_min_n:
+            final_utts.append(''.join(cur_utt))
+            cur_utt, cur_len = [], 0
+        cur_utt.append(utt)
+        cur_len += utt_len
     if len(cur_utt) > 0:
-        if should_merge(cur_utt) and len(final_utts) != 0:
-            final_utts[-1] = final_utts[-1] + cur_utt
+        if cur_len < merge_len and len(final_utts) != 0:
+            final_utts[-1] = final_utts[-1] + ''.join(cur_utt)
         else:
-            final_utts.append(cur_utt)
+            final_utts.append(''.join(cur_utt))
 
     return final_utts
 
 
+# safe boundary of streaming text
+# 1. full width punctuation is always a boundary
+# 2. ascii punctuation is a boundary once the next char is seen and it does not end inside a number or an abbreviation
+# 3. fall back to the last blank when no boundary is found in max_len chars
+stream_zh_pounc = set('。？！；：，、')
+stream_en_pounc = set('.?!;:,')
+stream_abbreviations = {'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'vs', 'etc', 'e.g', 'i.e', 'no', 'fig', 'inc', 'ltd', 'co', 'u.s', 'a.m', 'p.m'}
+
+
+def find_stream_boundary(text: str, max_len=50):
+    for i in range(len(text) - 1, -1, -1):
+        c = text[i]
+        if c in stream_zh_pounc:
+            return i + 1
+        if c not in stream_en_pounc or i + 1 == len(text):
+            continue
+        if c in '.,:' and text[i - 1: i].isdigit() and text[i + 1].isdigit():
+            continue
+        if c == '.':
+            if text[i + 1].isascii() and not text[i + 1].isspace():
+                continue
+            word = re.search(r'[A-Za-z.]*$', text[:i]).group(0).lower()
+            if word in stream_abbreviations or len(word) == 1:
+                continue
+        j = i + 1
+        while j < len(text) and text[j].isspace():
+            j += 1
+        return j
+    if len(text) > max_len:
+        blank = text.rstrip().rfind(' ')
+        if blank > 0:
+            return blank + 1
+        return len(re.sub(r'[0-9A-Za-z.,:]+$', '', text))
+    return 0
+
+
 # remove blank between chinese character
 def replace_blank(text: str):
     out_str = []
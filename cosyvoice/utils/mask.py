@@ -230,7 +230,10 @@ def add_optional_chunk_mask(xs: torch.Tensor,
     else:
         chunk_masks = masks
     assert chunk_masks.dtype == torch.bool
-    if (chunk_masks.sum(dim=-1) == 0).sum().item() != 0:
+    if torch.is_inference_mode_enabled():
+        # NOTE same as below, but without .item() host sync in streaming inference
+        chunk_masks = chunk_masks | (chunk_masks.sum(dim=-1, keepdim=True) == 0)
+    elif (chunk_masks.sum(dim=-1) == 0).sum().item() != 0:
         print('get chunk_masks all false at some timestep, force set to true, make sure they are masked in futuer computation!')
         chunk_masks[chunk_masks.sum(dim=-1) == 0] = True
     return chunk_masks
@@ -0,0 +1,227 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+from io import BytesIO
+import json
+import logging
+import os
+import threading
+
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+def _lock(f):
+    """Exclusive lock of the store lock file, flock on posix and a one byte region lock on windows."""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+    elif msvcrt is not None:
+        position = f.tell()
+        f.seek(0)
+        # NOTE LK_LOCK gives up after 10 tries, keep retrying while another process appends
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                pass
+        f.seek(position)
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        position = f.tell()
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        f.seek(position)
+
+
+def spk_store_dir(spk2info):
+    """Store dir next to a legacy spk2info.pt, '' keeps speakers in memory only."""
+    return os.path.join(os.path.dirname(spk2info), 'spk_store') if spk2info != '' else ''
+
+
+class SpeakerStore:
+    """Indexed on disk speaker profiles, a drop in for the spk2info dict.
+
+    Profiles are appended to data.bin, index.jsonl maps every spk_id to the offset and length of
+    its latest record, nothing is ever rewritten. A profile is only read and moved to device when
+    it is used, and at most cache_size profiles stay resident in a LRU. Speakers added by
+    __setitem__ live in memory until save() appends them, same as spk2info before save_spkinfo.
+    Appends hold an exclusive lock on a lock file (flock, or msvcrt.locking on windows), readers only parse
+    complete index lines, so several processes can serve from and append to the same store.
+    """
+
+    def __init__(self, store_dir, device='cpu', cache_size=64, legacy_spk2info=''):
+        self.store_dir = store_dir
+        self.device = device
+        self.cache_size = cache_size
+        self.index = {}
+        self.index_offset = 0
+        self.pending = {}
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.data_fd = None
+        if store_dir != '' and not os.path.exists(os.path.join(store_dir, 'index.jsonl')) and os.path.exists(legacy_spk2info):
+            self._import_legacy(legacy_spk2info)
+        self._refresh()
+
+    def _import_legacy(self, legacy_spk2info):
+        spk2info = torch.load(legacy_spk2info, map_location='cpu')
+        try:
+            os.makedirs(self.store_dir, exist_ok=True)
+            # NOTE replicas started together all see no index, only the first one to take the lock imports
+            if self._append(spk2info, only_if_empty=True) is True:
+                logging.info('import {} speakers of {} into {}'.format(len(spk2info), legacy_spk2info, self.store_dir))
+        except OSError as ex:
+            # NOTE read only model dir, keep legacy speakers in memory
+            logging.warning('failed to create speaker store {}, ex info {}'.format(self.store_dir, ex))
+            self.store_dir = ''
+            self.pending.update(spk2info)
+
+    def _path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    def _refresh(self):
+        """Read index lines appended since the last refresh, possibly by another process."""
+        if self.store_dir == '' or not os.path.exists(self._path('index.jsonl')):
+            return
+        with open(self._path('index.jsonl'), 'rb') as f:
+            f.seek(self.index_offset)
+            data = f.read()
+        # NOTE a line being appended right now has no trailing newline yet, leave it to the next refresh
+        data = data[:data.rfind(b'\n') + 1]
+        for line in data.splitlines():
+            record = json.loads(line)
+            if record.get('deleted', False) is True:
+                self.index.pop(record['spk_id'], None)
+            else:
+                self.index[record['spk_id']] = (record['offset'], record['length'])
+            self.cache.pop(record['spk_id'], None)
+        self.index_offset += len(data)
+        if self.data_fd is None and len(self.index) > 0:
+            self.data_fd = os.open(self._path('data.bin'), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+    def _append(self, profiles, deleted=(), only_if_empty=False):
+        # NOTE lock a separate file, windows region locks are mandatory and would block readers of index.jsonl
+        with open(self._path('lock'), 'ab') as lock_file, open(self._path('data.bin'), 'ab') as data_file, \
+                open(self._path('index.jsonl'), 'ab') as index_file:
+            _lock(lock_file)
+            try:
+                if only_if_empty is True and os.path.getsize(self._path('index.jsonl')) > 0:
+                    return False
+                data_file.seek(0, os.SEEK_END)
+                offset, lines = data_file.tell(), []
+                for spk_id, profile in profiles.items():
+                    buffer = BytesIO()
+                    torch.save({k: v.cpu() if isinstance(v, torch.Tensor) else v for k, v in profile.items()}, buffer)
+                    data_file.write(buffer.getvalue())
+                    lines.append({'spk_id': spk_id, 'offset': offset, 'length': buffer.tell()})
+                    offset += buffer.tell()
+                lines += [{'spk_id': spk_id, 'deleted': True} for spk_id in deleted]
+                data_file.flush()
+                os.fsync(data_file.fileno())
+                # NOTE index is written after data is durable, one write so readers never see a record without data
+                index_file.write(''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in lines).encode('utf8'))
+                index_file.flush()
+            finally:
+                _unlock(lock_file)
+        return True
+
+    def _load(self, spk_id):
+        offset, length = self.index[spk_id]
+        # NOTE no os.pread on windows, seek + read is safe as every caller holds self.lock
+        os.lseek(self.data_fd, offset, os.SEEK_SET)
+        data = b''
+        while len(data) < length:
+            chunk = os.read(self.data_fd, length - len(data))
+            if len(chunk) == 0:
+                raise IOError('speaker store {} is truncated at offset {}'.format(self.store_dir, offset + len(data)))
+            data += chunk
+        profile = torch.load(BytesIO(data), map_location=self.device)
+        self.cache[spk_id] = profile
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return profile
+
+    def __getitem__(self, spk_id):
+        with self.lock:
+            if spk_id in self.pending:
+                profile = self.pending[spk_id]
+            elif spk_id in self.cache:
+                self.cache.move_to_end(spk_id)
+                profile = self.cache[spk_id]
+            else:
+                if spk_id not in self.index:
+                    self._refresh()
+                if spk_id not in self.index:
+                    raise KeyError(spk_id)
+                profile = self._load(spk_id)
+        # NOTE callers add text and drop prompt keys on what they get, never hand out the cached dict
+        return dict(profile)
+
+    def __setitem__(self, spk_id, profile):
+        with self.lock:
+            self.pending[spk_id] = profile
+            self.cache.pop(spk_id, None)
+
+    def __delitem__(self, spk_id):
+        with self.lock:
+            if spk_id not in self.pending and spk_id not in self.index:
+                raise KeyError(spk_id)
+            self.pending.pop(spk_id, None)
+            self.cache.pop(spk_id, None)
+            if spk_id in self.index:
+                self._append({}, deleted=[spk_id])
+                self.index.pop(spk_id)
+
+    def __contains__(self, spk_id):
+        with self.lock:
+            if spk_id not in self.pending and spk_id not in self.index:
+                self._refresh()
+            return spk_id in self.pending or spk_id in self.index
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            self._refresh()
+            return list(self.index.keys()) + [i for i in self.pending if i not in self.index]
+
+    def save(self):
+        """Append speakers added since the last save, existing records are left untouched."""
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            if self.store_dir == '':
+                logging.warning('speaker store has no directory, {} speakers are not saved'.format(len(self.pending)))
+                return
+            os.makedirs(self.store_dir, exist_ok=True)
+            self._append(self.pending)
+            self.pending = {}
+            self._refresh()
@@ -0,0 +1,108 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import logging
+from contextlib import contextmanager
+
+import torch
+
+ROLES = ['llm', 'flow', 'onnx', 'asr']
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ThreadBudget:
+    """Split the cores of the host between llm, flow, frontend onnx and asr work.
+
+    Every role gets a number of threads and, when pin is True, a disjoint set of cores.
+    torch intra-op threads are a process wide setting, apply() sets them once to the
+    larger of llm and flow. Only affinity is per role, the compute of a role runs in
+    `with budget.enter(role):`, so the intra-op thread team it spawns stays on the cores
+    of that role and the calling thread gets its previous cores back afterwards.
+    """
+
+    def __init__(self, llm=None, flow=None, onnx=1, asr=1, interop=1, pin=False):
+        cores = available_cores()
+        # NOTE by default llm and flow share what is left after onnx and asr evenly
+        left = max(len(cores) - onnx - asr, 2)
+        llm = left // 2 if llm is None else llm
+        flow = left - left // 2 if flow is None else flow
+        self.threads = {'llm': llm, 'flow': flow, 'onnx': onnx, 'asr': asr}
+        self.interop = interop
+        self.pin = pin
+        if sum(self.threads.values()) > len(cores):
+            logging.warning('thread budget {} exceeds {} available cores, cores will be shared'.format(self.threads, len(cores)))
+        self.cores, start = {}, 0
+        for role in ROLES:
+            self.cores[role] = [cores[(start + i) % len(cores)] for i in range(self.threads[role])]
+            start += self.threads[role]
+
+    @classmethod
+    def parse(cls, spec, pin=False):
+        """Build a budget from a spec like 'llm=4,flow=3,onnx=1,asr=1'."""
+        kwargs = {}
+        for item in spec.split(','):
+            if item.strip() == '':
+                continue
+            key, value = item.split('=')
+            kwargs[key.strip()] = int(value)
+        return cls(pin=pin, **kwargs)
+
+    def __repr__(self):
+        return 'ThreadBudget({}, interop {}, pin {})'.format(
+            ', '.join('{} {}'.format(role, self.cores[role] if self.pin else self.threads[role]) for role in ROLES), self.interop, self.pin)
+
+    def apply(self):
+        """Process wide settings, call once before any torch work."""
+        os.environ['OMP_NUM_THREADS'] = str(max(self.threads['llm'], self.threads['flow']))
+        torch.set_num_threads(max(self.threads['llm'], self.threads['flow']))
+        if torch.get_num_interop_threads() != self.interop:
+            try:
+                torch.set_num_interop_threads(self.interop)
+            except RuntimeError:
+                # NOTE interop threads can only be set before any parallel work starts
+                logging.warning('torch interop threads already started, keep {}'.format(torch.get_num_interop_threads()))
+        logging.info('apply {}'.format(self))
+
+    @contextmanager
+    def enter(self, role):
+        """Limit the calling thread to the cores of role inside the with block, thread counts are left to apply()."""
+        # NOTE torch.set_num_threads is process wide, setting it here would let concurrent
+        #   llm and flow threads overwrite each other's count
+        if not self.pin or not hasattr(os, 'sched_setaffinity'):
+            yield
+            return
+        # NOTE on linux pid 0 is the calling thread, threads it spawns later inherit the mask,
+        #   restore it so frontend, onnx and playback work on a shared thread is not left on these cores
+        previous = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, self.cores[role])
+        try:
+            yield
+        finally:
+            os.sched_setaffinity(0, previous)
+
+    def session_options(self, role='onnx'):
+        import onnxruntime
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        option.intra_op_num_threads = self.threads[role]
+        option.inter_op_num_threads = 1
+        if self.pin and len(self.cores[role]) > 1:
+            # NOTE ort pins its intra op threads except the caller thread, one ';' separated entry per extra thread
+            option.add_session_config_entry('session.intra_op_thread_affinities', ';'.join(str(i + 1) for i in self.cores[role][1:]))
+        return option
@@ -18,8 +18,9 @@ import logging
 import os
 import torch
 import json
-import re
 import datetime
+import threading
+import time
 import yaml
 
 import deepspeed
@@ -33,6 +34,7 @@ from torch.nn.utils import clip_grad_norm_
 from deepspeed.runtime.zero.stage_1_and_2 import estimate_zero2_model_states_mem_needs_all_live
 
 from cosyvoice.dataset.dataset import Dataset
+from cosyvoice.dataset.processor import PARQUET_COLUMNS
 from cosyvoice.utils.scheduler import WarmupLR, NoamHoldAnnealing, ConstantLR
 
 
@@ -52,8 +54,23 @@ def init_distributed(args):
 
 def init_dataset_and_dataloader(args, configs, gan, dpo):
     data_pipeline = configs['data_pipeline_gan'] if gan is True else configs['data_pipeline']
-    train_dataset = Dataset(args.train_data, data_pipeline=data_pipeline, mode='train', gan=gan, dpo=dpo, shuffle=True, partition=True)
-    cv_dataset = Dataset(args.cv_data, data_pipeline=data_pipeline, mode='train', gan=gan, dpo=dpo, shuffle=False, partition=False)
+    # NOTE only read the parquet columns the trained model needs, gan training keeps all
+    columns = None if gan is True else 'dpo' if dpo is True else args.model if args.model in PARQUET_COLUMNS else None
+    # NOTE llm only consumes text and speech token, audio free mode never reads or decodes audio bytes
+    audio_free = getattr(args, 'audio_free', False) is True
+    if audio_free is True:
+        assert args.model == 'llm', 'audio free data pipeline only supports llm training'
+        columns = PARQUET_COLUMNS['llm_audio_free'] + (['reject_speech_token'] if dpo is True else [])
+    # NOTE audio_data is still read, utts without an up to date feature shard fall back to on the fly extraction
+    feature_dir = getattr(args, 'feature_dir', None)
+    ref_logps = dpo is True and getattr(args, 'ref_logps', False) is True
+    ref_logp_dir = getattr(args, 'ref_logp_dir', None)
+    profile = getattr(args, 'profile', False) is True
+    train_dataset = Dataset(args.train_data, data_pipeline=data_pipeline, mode='train', gan=gan, dpo=dpo, shuffle=True, partition=True,
+                            columns=columns, audio_free=audio_free, feature_dir=feature_dir, ref_logps=ref_logps, ref_logp_dir=ref_logp_dir,
+                            profile=profile)
+    cv_dataset = Dataset(args.cv_data, data_pipeline=data_pipeline, mode='train', gan=gan, dpo=dpo, shuffle=False, partition=False,
+                         columns=columns, audio_free=audio_free, feature_dir=feature_dir, ref_logps=ref_logps, ref_logp_dir=ref_logp_dir)
 
     # do not use persistent_workers=True, as whisper tokenizer opens tiktoken file each time when the for loop starts
     train_data_loader = DataLoader(train_dataset,
@@ -192,26 +209,85 @@ def init_summarywriter(args):
     return writer
 
 
+# NOTE at most one checkpoint is written in background, which bounds host memory to one extra snapshot
+_checkpoint_thread = None
+# NOTE exception of the background writer, raised in the training thread by wait_checkpoint
+_checkpoint_error = None
+
+
+def wait_checkpoint():
+    """ Block until the checkpoint being written in background is on disk, raise if writing it failed """
+    global _checkpoint_thread, _checkpoint_error
+    if _checkpoint_thread is not None:
+        _checkpoint_thread.join()
+        _checkpoint_thread = None
+    if _checkpoint_error is not None:
+        ex, _checkpoint_error = _checkpoint_error, None
+        raise ex
+
+
+def load_checkpoint(path):
+    """ State dict of a .pt or .safetensors checkpoint written by save_model """
+    if path.endswith('.safetensors'):
+        from safetensors import safe_open
+        with safe_open(path, framework='pt', device='cpu') as f:
+            state_dict = {k: f.get_tensor(k) for k in f.keys()}
+            state_dict.update({k: int(v) for k, v in (f.metadata() or {}).items() if k in ['epoch', 'step']})
+        return state_dict
+    return torch.load(path, map_location='cpu')
+
+
+def _write_checkpoint(state_dict, save_model_path, info_path, info, save_format):
+    global _checkpoint_error
+    try:
+        # NOTE write to a tmp file and rename, a crash never leaves a truncated checkpoint behind
+        tmp_path = save_model_path + '.tmp'
+        if save_format == 'safetensors':
+            from safetensors.torch import save_file
+            save_file({k: v for k, v in state_dict.items() if isinstance(v, torch.Tensor)}, tmp_path,
+                      metadata={k: str(v) for k, v in state_dict.items() if not isinstance(v, torch.Tensor)})
+        else:
+            torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, save_model_path)
+        # yaml goes last, average_model only picks checkpoints whose yaml exists
+        with open(info_path + '.tmp', 'w') as fout:
+            fout.write(info)
+        os.replace(info_path + '.tmp', info_path)
+        logging.info('[Rank 0] Checkpoint: save to checkpoint {}'.format(save_model_path))
+    except Exception as ex:
+        logging.error('failed to save checkpoint {}, ex info {}'.format(save_model_path, ex))
+        _checkpoint_error = ex
+
+
 def save_model(model, model_name, info_dict):
+    global _checkpoint_thread
     rank = int(os.environ.get('RANK', 0))
     model_dir = info_dict["model_dir"]
-    save_model_path = os.path.join(model_dir, '{}.pt'.format(model_name))
+    save_format = info_dict.get('save_format', 'pt')
+    save_model_path = os.path.join(model_dir, '{}.{}'.format(model_name, 'safetensors' if save_format == 'safetensors' else 'pt'))
+    info_path = os.path.join(model_dir, '{}.yaml'.format(model_name))
 
     if info_dict["train_engine"] == "torch_ddp":
         if rank == 0:
-            torch.save({**model.module.state_dict(), 'epoch': info_dict['epoch'], 'step': info_dict['step']}, save_model_path)
+            # NOTE snapshot on host, training goes on while the snapshot is written in background
+            state_dict = {k: v.detach().to('cpu', copy=True).contiguous() for k, v in model.module.state_dict().items()}
+            state_dict.update({'epoch': info_dict['epoch'], 'step': info_dict['step']})
+            info_dict['save_time'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+            info = yaml.dump(info_dict)
+            wait_checkpoint()
+            _checkpoint_thread = threading.Thread(target=_write_checkpoint, args=(state_dict, save_model_path, info_path, info, save_format))
+            _checkpoint_thread.start()
     else:
         with torch.no_grad():
             model.save_checkpoint(save_dir=model_dir,
                                   tag=model_name,
                                   client_state=info_dict)
-    if rank == 0:
-        info_path = re.sub('.pt$', '.yaml', save_model_path)
-        info_dict['save_time'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-        with open(info_path, 'w') as fout:
-            data = yaml.dump(info_dict)
-            fout.write(data)
-        logging.info('[Rank {}] Checkpoint: save to checkpoint {}'.format(rank, save_model_path))
+        if rank == 0:
+            info_dict['save_time'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+            with open(info_path, 'w') as fout:
+                data = yaml.dump(info_dict)
+                fout.write(data)
+            logging.info('[Rank {}] Checkpoint: save to checkpoint {}'.format(rank, save_model_path))
 
 
 def cosyvoice_join(group_join, info_dict):
@@ -235,7 +311,7 @@ def cosyvoice_join(group_join, info_dict):
         return False
 
 
-def batch_forward(model, batch, scaler, info_dict, ref_model=None, dpo_loss=None):
+def batch_forward(model, batch, scaler, info_dict, ref_model=None, dpo_loss=None, teacher_model=None):
     device = int(os.environ.get('LOCAL_RANK', 0))
 
     dtype = info_dict["dtype"]
@@ -252,15 +328,29 @@ def batch_forward(model, batch, scaler, info_dict, ref_model=None, dpo_loss=None
         autocast = torch.cuda.amp.autocast(enabled=True, dtype=dtype, cache_enabled=False)
 
     with autocast:
+        if teacher_model is not None:
+            # distillation target, teacher forward is forward_teacher
+            with torch.no_grad():
+                batch['teacher'] = teacher_model(batch, device)
         info_dict['loss_dict'] = model(batch, device)
-        if ref_model is not None and dpo_loss is not None:
+        if dpo_loss is not None:
             chosen_logps = info_dict['loss_dict']["chosen_logps"]
             rejected_logps = info_dict['loss_dict']["rejected_logps"]
             sft_loss = info_dict['loss_dict']['loss']
-            with torch.no_grad():
-                ref_loss_dict = ref_model(batch, device)
-            reference_chosen_logps = ref_loss_dict["chosen_logps"]
-            reference_rejected_logps = ref_loss_dict["rejected_logps"]
+            # NOTE layout drawn for every chosen and rejected row, not a loss so it is not logged
+            bistream = info_dict['loss_dict'].pop('dpo_bistream')
+            if 'ref_chosen_logps' in batch:
+                # NOTE reference log-probs precomputed by compute_ref_logps, (unistream, bistream) per utt, take the policy layout
+                B = chosen_logps.size(0)
+                reference_chosen_logps = batch['ref_chosen_logps'].to(device).gather(1, bistream[:B].long().unsqueeze(1)).squeeze(1)
+                reference_rejected_logps = batch['ref_rejected_logps'].to(device).gather(1, bistream[B:].long().unsqueeze(1)).squeeze(1)
+            else:
+                assert ref_model is not None, 'batch has no cached reference log-probs and no ref_model is given'
+                batch['dpo_bistream'] = bistream
+                with torch.no_grad():
+                    ref_loss_dict = ref_model(batch, device)
+                reference_chosen_logps = ref_loss_dict["chosen_logps"]
+                reference_rejected_logps = ref_loss_dict["rejected_logps"]
             preference_loss, chosen_reward, reject_reward = dpo_loss(
                 chosen_logps, rejected_logps, reference_chosen_logps, reference_rejected_logps
             )
@@ -320,6 +410,89 @@ def update_parameter_and_lr(model, optimizer, scheduler, scaler, info_dict):
     return info_dict
 
 
+def update_throughput(info_dict, batch_dict):
+    """ Padding ratio and effective (non padding) samples/s, frames/s and tokens/s of the train batches since the last log """
+    now = time.time()
+    stats = info_dict.setdefault('throughput_stats', {'start': now, 'num_samples': 0, 'num_frames': 0, 'padded_frames': 0, 'num_tokens': 0})
+    stats['num_samples'] += len(batch_dict['utts'])
+    for k in ['num_frames', 'padded_frames', 'num_tokens']:
+        stats[k] += batch_dict.get(k, 0)
+    if (info_dict['batch_idx'] + 1) % info_dict['log_interval'] == 0 and stats['padded_frames'] > 0:
+        cost = max(now - stats['start'], 1e-6)
+        info_dict['padding_ratio'] = 1 - stats['num_frames'] / stats['padded_frames']
+        info_dict['samples_per_sec'] = stats['num_samples'] / cost
+        info_dict['frames_per_sec'] = stats['num_frames'] / cost
+        info_dict['tokens_per_sec'] = stats['num_tokens'] / cost
+        info_dict['throughput_stats'] = {'start': now, 'num_samples': 0, 'num_frames': 0, 'padded_frames': 0, 'num_tokens': 0}
+    return info_dict
+
+
+class StepProfiler:
+    """ Wall time of the phases of a train step, dataloader wait, h2d, forward, backward and optimizer,
+        plus the per stage processor time carried by the batches. Phases are cut by mark(), which
+        synchronizes cuda so gpu work is charged to the phase that launched it, so it is only enabled
+        with --profile. An optional torch.profiler trace covers a window of steps on rank 0.
+    """
+
+    def __init__(self, info_dict):
+        self.enabled = info_dict.get('profile', False) is True
+        self.device = torch.device('cuda:{}'.format(int(os.environ.get('LOCAL_RANK', 0)))) if torch.cuda.is_available() else torch.device('cpu')
+        self.phase_time, self.stage_time, self.num_steps = {}, {}, 0
+        self.last = time.perf_counter()
+        self.trace = None
+        trace_dir = info_dict.get('profile_trace_dir', None)
+        if trace_dir and int(os.environ.get('RANK', 0)) == 0:
+            wait, warmup, active = [int(i) for i in info_dict.get('profile_trace_steps', '10,2,5').split(',')]
+            activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+            self.trace = torch.profiler.profile(activities=activities,
+                                                schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                                                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                                                record_shapes=True, with_stack=False)
+            self.trace.start()
+
+    def reset(self):
+        """ Restart the clock, e.g. after cv, so it is not charged to the next dataloader wait """
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        if self.enabled is False:
+            return
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        self.phase_time[phase] = self.phase_time.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def to_device(self, batch_dict):
+        """ Explicit h2d copy so it is timed on its own, models move tensors already on device for free """
+        if self.enabled is False:
+            return batch_dict
+        batch_dict = {k: v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v for k, v in batch_dict.items()}
+        self.mark('h2d')
+        return batch_dict
+
+    def step(self, info_dict, batch_dict):
+        """ Called once per batch after the optimizer, publishes ms per step at log_interval """
+        if self.trace is not None:
+            self.trace.step()
+        if self.enabled is False:
+            return info_dict
+        for k, v in batch_dict.get('stage_time', {}).items():
+            self.stage_time[k] = self.stage_time.get(k, 0.0) + v
+        self.num_steps += 1
+        if (info_dict['batch_idx'] + 1) % info_dict['log_interval'] == 0:
+            info_dict['phase_time'] = {k: v * 1000 / self.num_steps for k, v in self.phase_time.items()}
+            # NOTE stage time is spent in the dataloader workers, it only stalls training when it exceeds the dataloader wait
+            info_dict['phase_time'].update({'stage_{}'.format(k): v * 1000 / self.num_steps for k, v in self.stage_time.items()})
+            self.phase_time, self.stage_time, self.num_steps = {}, {}, 0
+        return info_dict
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+
 def log_per_step(writer, info_dict):
     tag = info_dict["tag"]
     epoch = info_dict.get('epoch', 0)
@@ -336,6 +509,11 @@ def log_per_step(writer, info_dict):
                 writer.add_scalar('{}/{}'.format(tag, k), info_dict[k], step + 1)
             for k, v in loss_dict.items():
                 writer.add_scalar('{}/{}'.format(tag, k), v, step + 1)
+            for k in ['padding_ratio', 'samples_per_sec', 'frames_per_sec', 'tokens_per_sec']:
+                if k in info_dict:
+                    writer.add_scalar('{}/{}'.format(tag, k), info_dict[k], step + 1)
+            for k, v in info_dict.get('phase_time', {}).items():
+                writer.add_scalar('{}/time_ms/{}'.format(tag, k), v, step + 1)
 
     # TRAIN & CV, Shell log (stdout)
     if (info_dict['batch_idx'] + 1) % info_dict['log_interval'] == 0:
@@ -345,6 +523,11 @@ def log_per_step(writer, info_dict):
         if tag == "TRAIN":
             log_str += 'lr {:.8f} grad_norm {:.6f}'.format(
                 info_dict["lr"], info_dict['grad_norm'])
+            if 'padding_ratio' in info_dict:
+                log_str += ' padding_ratio {:.3f} samples/s {:.1f} frames/s {:.1f} tokens/s {:.1f}'.format(
+                    info_dict['padding_ratio'], info_dict['samples_per_sec'], info_dict['frames_per_sec'], info_dict['tokens_per_sec'])
+            if 'phase_time' in info_dict:
+                log_str += ' time_ms ' + ' '.join('{} {:.1f}'.format(k, v) for k, v in info_dict['phase_time'].items())
         log_str += ' rank {}'.format(rank)
         logging.debug(log_str)
 
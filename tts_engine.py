@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+可插拔 TTS 引擎：统一接口 + Matcha ONNX 轻量兜底 + 按 SLO 路由
+"""
+import io
+import os
+import re
+import sys
+import time
+import wave
+import argparse
+import threading
+import numpy as np
+
+MATCHA_TTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "third_party", "Matcha-TTS")
+if MATCHA_TTS_PATH not in sys.path:
+    sys.path.append(MATCHA_TTS_PATH)
+
+
+# ---------- 文本切分 ----------
+def split_text_by_punctuation(text: str, max_chars: int = 80):
+    text = text.strip()
+    if not text:
+        return []
+    parts = re.split(r'([。！？.!?]\s*)', text)
+    segs, buf = [], ""
+    for p in parts:
+        if not p.strip():
+            continue
+        if len(buf) + len(p) > max_chars and buf:
+            segs.append(buf.strip())
+            buf = ""
+        buf += p
+        while len(buf) > max_chars:
+            segs.append(buf[:max_chars])
+            buf = buf[max_chars:]
+    if buf.strip():
+        segs.append(buf.strip())
+    # 过滤纯标点/空白
+    return [s for s in segs if re.search(r'\w', s, flags=re.UNICODE)]
+
+
+def resample_audio(audio: np.ndarray, orig_sr: int, target_sr: int) -> np.ndarray:
+    """线性插值重采样，兜底音频对齐到主引擎采样率用"""
+    if audio is None or orig_sr == target_sr or len(audio) == 0:
+        return audio
+    n = int(round(len(audio) * target_sr / orig_sr))
+    return np.interp(np.arange(n) * (orig_sr / target_sr), np.arange(len(audio)), audio).astype(np.float32)
+
+
+class TTSEngine:
+    """
+    TTS 引擎接口，子类至少实现 synthesize
+    synthesize(text) -> 单声道 float32 音频
+    """
+    name = "base"
+    sample_rate = 22050
+
+    @property
+    def ready(self) -> bool:
+        return True
+
+    def can_voice(self, text: str) -> bool:
+        """引擎能否合成该文本（语种是否支持）"""
+        return True
+
+    def synthesize(self, text: str, **kwargs) -> np.ndarray:
+        raise NotImplementedError
+
+    def synthesize_batch(self, texts, **kwargs):
+        return [self.synthesize(t, **kwargs) for t in texts]
+
+    def synthesize_stream(self, text: str, **kwargs):
+        """按句切分，逐句产出音频块"""
+        for seg in split_text_by_punctuation(text):
+            yield self.synthesize(seg, **kwargs)
+
+    # ------------ 生成音频数据（不播放）------------
+    def generate_audio(self, text: str, **kwargs):
+        """返回: (audio_data, sample_rate) 或 None"""
+        segments = split_text_by_punctuation(text)
+        if not segments:
+            print("[提示] 没有有效可合成文本")
+            return None
+        audio_segments = [a for a in self.synthesize_batch(segments, **kwargs) if a is not None and len(a) > 0]
+        if not audio_segments:
+            return None
+        return (np.concatenate(audio_segments), self.sample_rate)
+
+    # ------------ 将numpy音频转换为WAV字节流 ------------
+    def audio_to_wav_bytes(self, audio_data: np.ndarray, sample_rate: int):
+        if len(audio_data.shape) > 1:
+            audio_data = audio_data[:, 0] if audio_data.shape[1] > 0 else audio_data
+        if np.max(np.abs(audio_data)) > 0:
+            audio_data = audio_data / np.max(np.abs(audio_data))
+        audio_int16 = (audio_data * 32767).astype(np.int16)
+        wav_buffer = io.BytesIO()
+        with wave.open(wav_buffer, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(audio_int16.tobytes())
+        wav_buffer.seek(0)
+        return wav_buffer.read()
+
+
+class MatchaOnnxEngine(TTSEngine):
+    """
+    Matcha-TTS ONNX 引擎（matcha/onnx/export.py 导出）
+    非自回归，一次前向出整句，批量时按长度补齐一起跑
+    默认 english_cleaners2 只能合成英文，含中文的文本 can_voice 返回 False，
+    换成中文模型时传 languages=("zh", "en") 及对应 cleaners
+    """
+    name = "matcha"
+
+    def __init__(self, model_path: str, vocoder_path: str = None, sample_rate: int = 22050,
+                 temperature: float = 0.667, speaking_rate: float = 1.0, spk: int = 0,
+                 cleaners=("english_cleaners2",), languages=("en",), use_gpu: bool = False):
+        import onnxruntime as ort
+        from matcha.text import cleaners as matcha_cleaners
+        from matcha.text.symbols import symbols
+
+        providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if use_gpu else ["CPUExecutionProvider"]
+        self.model = ort.InferenceSession(model_path, providers=providers)
+        self.vocoder = ort.InferenceSession(vocoder_path, providers=providers) if vocoder_path else None
+        self.has_vocoder_embedded = self.model.get_outputs()[0].name == "wav"
+        if not self.has_vocoder_embedded and self.vocoder is None:
+            raise ValueError(f"{model_path} 未内嵌声码器，需要提供 vocoder_path")
+        self.is_multi_speaker = len(self.model.get_inputs()) == 4
+        self.sample_rate = sample_rate
+        self.scales = np.array([temperature, speaking_rate], dtype=np.float32)
+        self.spk = spk
+        self.cleaners = [getattr(matcha_cleaners, name) for name in cleaners]
+        self.languages = languages
+        self.symbol_to_id = {s: i for i, s in enumerate(symbols)}
+
+    def can_voice(self, text: str) -> bool:
+        return "zh" in self.languages or re.search(r"[\u4e00-\u9fff]", text) is None
+
+    def _text_to_ids(self, text: str):
+        for cleaner in self.cleaners:
+            text = cleaner(text)
+        # 未登录符号直接丢弃，避免 KeyError
+        ids = [self.symbol_to_id[c] for c in text if c in self.symbol_to_id]
+        # 插入 blank
+        result = [0] * (len(ids) * 2 + 1)
+        result[1::2] = ids
+        return result
+
+    def synthesize_batch(self, texts, **kwargs):
+        if not texts:
+            return []
+        ids = [self._text_to_ids(t) for t in texts]
+        x_lengths = np.array([len(i) for i in ids], dtype=np.int64)
+        x = np.zeros((len(ids), x_lengths.max()), dtype=np.int64)
+        for i, seq in enumerate(ids):
+            x[i, :len(seq)] = seq
+        inputs = {"x": x, "x_lengths": x_lengths, "scales": self.scales}
+        if self.is_multi_speaker:
+            inputs["spks"] = np.repeat(self.spk, len(ids)).astype(np.int64)
+        if self.has_vocoder_embedded:
+            wavs, wav_lengths = self.model.run(None, inputs)
+        else:
+            mels, mel_lengths = self.model.run(None, inputs)
+            wavs = self.vocoder.run(None, {self.vocoder.get_inputs()[0].name: mels})[0].squeeze(1)
+            wav_lengths = mel_lengths * 256
+        return [wav[:n].astype(np.float32) for wav, n in zip(wavs, wav_lengths)]
+
+    def synthesize(self, text: str, **kwargs) -> np.ndarray:
+        return self.synthesize_batch([text], **kwargs)[0]
+
+    def synthesize_stream(self, text: str, batch_size: int = 4, **kwargs):
+        """每 batch_size 句跑一次，首包只等第一批"""
+        segments = split_text_by_punctuation(text)
+        for i in range(0, len(segments), batch_size):
+            for audio in self.synthesize_batch(segments[i:i + batch_size], **kwargs):
+                yield audio
+
+
+class TTSRouter(TTSEngine):
+    """
+    主引擎（CosyVoice2）预计排队时间超过 slo 或尚未就绪时，切到兜底引擎
+    预计排队时间 = (在途请求数 + 1) * 主引擎单请求耗时的滑动平均
+    兜底引擎合成不了的文本（如英文模型遇到中文）不走兜底，只能排队等主引擎
+    synthesize/synthesize_batch/synthesize_stream 返回的音频统一为 sample_rate，
+    兜底引擎采样率不同时（Matcha 22050，CosyVoice2 24000）在路由里重采样
+    """
+    name = "router"
+
+    def __init__(self, primary: TTSEngine = None, fallback: TTSEngine = None, slo: float = 2.0, ema: float = 0.2):
+        self.primary = primary
+        self.fallback = fallback
+        self.slo = slo
+        self.ema = ema
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.avg_cost = None
+        self.route_count = {"primary": 0, "fallback": 0, "unvoiceable": 0}
+
+    def set_primary(self, primary: TTSEngine):
+        """主引擎预热完成后接入"""
+        with self.lock:
+            self.primary = primary
+            self.avg_cost = None
+
+    @property
+    def ready(self) -> bool:
+        return (self.primary is not None and self.primary.ready) or self.fallback is not None
+
+    @property
+    def sample_rate(self):
+        engine = self.primary if self.primary is not None else self.fallback
+        return engine.sample_rate
+
+    def expected_wait(self) -> float:
+        if self.avg_cost is None:
+            return 0.0
+        return (self.inflight + 1) * self.avg_cost
+
+    def _pick(self, texts):
+        fallback = self.fallback
+        if fallback is not None and not all(fallback.can_voice(text) for text in texts):
+            print(f"[路由] 兜底引擎 {fallback.name} 无法合成该文本，跳过兜底：{texts[0][:20]}")
+            fallback = None
+        with self.lock:
+            if fallback is None and self.fallback is not None:
+                self.route_count["unvoiceable"] += 1
+            use_primary = self.primary is not None and self.primary.ready
+            if use_primary and fallback is not None and self.expected_wait() > self.slo:
+                use_primary = False
+            if not use_primary and fallback is None:
+                # 无兜底时只能排队等主引擎
+                if self.primary is None:
+                    raise RuntimeError("没有可用的 TTS 引擎" if self.fallback is None else "主引擎未就绪，兜底引擎无法合成该文本")
+                use_primary = True
+            if use_primary:
+                self.inflight += 1
+            self.route_count["primary" if use_primary else "fallback"] += 1
+            return (self.primary if use_primary else fallback), use_primary
+
+    def _done(self, use_primary, cost):
+        if not use_primary:
+            return
+        with self.lock:
+            self.inflight -= 1
+            self.avg_cost = cost if self.avg_cost is None else (1 - self.ema) * self.avg_cost + self.ema * cost
+
+    def _route(self, method, texts, *args, **kwargs):
+        """返回 (结果, 产出引擎, 调用方期望的采样率)"""
+        engine, use_primary = self._pick(texts)
+        sample_rate = self.sample_rate
+        start = time.time()
+        try:
+            return getattr(engine, method)(*args, **kwargs), engine, sample_rate
+        finally:
+            self._done(use_primary, time.time() - start)
+
+    def synthesize(self, text: str, **kwargs):
+        audio, engine, sample_rate = self._route("synthesize", [text], text, **kwargs)
+        return resample_audio(audio, engine.sample_rate, sample_rate)
+
+    def synthesize_batch(self, texts, **kwargs):
+        audios, engine, sample_rate = self._route("synthesize_batch", list(texts), texts, **kwargs)
+        return [resample_audio(audio, engine.sample_rate, sample_rate) for audio in audios]
+
+    def generate_audio(self, text: str, **kwargs):
+        # 返回值自带产出引擎的采样率，无需重采样
+        return self._route("generate_audio", [text], text, **kwargs)[0]
+
+    def synthesize_stream(self, text: str, **kwargs):
+        engine, use_primary = self._pick([text])
+        sample_rate = self.sample_rate
+        start = time.time()
+        try:
+            for audio in engine.synthesize_stream(text, **kwargs):
+                yield resample_audio(audio, engine.sample_rate, sample_rate)
+        finally:
+            self._done(use_primary, time.time() - start)
+
+
+# -------------------- 多进程副本 --------------------
+def _cosyvoice_worker(worker_id, model_path, ref_audio, num_threads, request_queue, result_queue):
+    """副本子进程：权重 mmap 只读加载，逐个处理请求"""
+    import torch
+    from TTS import CosyvoiceRealTimeTTS
+    torch.set_num_threads(num_threads)
+    try:
+        engine = CosyvoiceRealTimeTTS(model_path, ref_audio, mmap_weights=True)
+        # 预热一次，避免首个请求承担冷启动
+        engine.generate_audio("启动完毕。")
+    except Exception as e:
+        result_queue.put(("error", worker_id, None, repr(e)))
+        return
+    result_queue.put(("ready", worker_id, engine.sample_rate, None))
+    while True:
+        req = request_queue.get()
+        if req is None:
+            break
+        req_id, method, args, kwargs = req
+        try:
+            result_queue.put(("done", req_id, getattr(engine, method)(*args, **kwargs), None))
+        except Exception as e:
+            result_queue.put(("done", req_id, None, repr(e)))
+
+
+class CosyvoiceWorkerPool(TTSEngine):
+    """
+    多个 CosyVoice2 副本进程，权重 mmap 只读映射同一份文件（共享页缓存）
+    新增副本只增加激活、KV cache 和 ONNX 会话的内存；请求分发给在途数最少的就绪副本
+    """
+    name = "cosyvoice_pool"
+
+    def __init__(self, model_path: str, reference_audio_path: str = None, num_workers: int = 2, num_threads: int = None):
+        import multiprocessing as mp
+        # spawn：Windows 唯一可用方式，且不继承父进程的 CUDA / 线程池状态
+        ctx = mp.get_context("spawn")
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self.sample_rate = 24000
+        self.lock = threading.Lock()
+        self.inflight = [0] * num_workers
+        self.ready_workers = set()
+        self.pending = {}
+        self.next_id = 0
+        self.result_queue = ctx.Queue()
+        self.request_queues = [ctx.Queue() for _ in range(num_workers)]
+        self.workers = [ctx.Process(target=_cosyvoice_worker, daemon=True,
+                                    args=(i, model_path, reference_audio_path, num_threads, self.request_queues[i], self.result_queue))
+                        for i in range(num_workers)]
+        for w in self.workers:
+            w.start()
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    @property
+    def ready(self) -> bool:
+        return len(self.ready_workers) > 0
+
+    def _collect(self):
+        while True:
+            kind, key, value, error = self.result_queue.get()
+            if kind == "ready":
+                self.sample_rate = value
+                with self.lock:
+                    self.ready_workers.add(key)
+                print(f"[副本] worker {key} 就绪，共 {len(self.ready_workers)}/{len(self.workers)}")
+            elif kind == "error":
+                print(f"[副本] worker {key} 初始化失败：{error}")
+            else:
+                with self.lock:
+                    request = self.pending.pop(key)
+                    self.inflight[request["worker"]] -= 1
+                request["result"], request["error"] = value, error
+                request["event"].set()
+
+    def _call(self, method, *args, **kwargs):
+        with self.lock:
+            if not self.ready_workers:
+                raise RuntimeError("没有就绪的 CosyVoice2 副本")
+            worker = min(self.ready_workers, key=lambda i: self.inflight[i])
+            self.inflight[worker] += 1
+            req_id, self.next_id = self.next_id, self.next_id + 1
+            request = {"worker": worker, "event": threading.Event()}
+            self.pending[req_id] = request
+        self.request_queues[worker].put((req_id, method, args, kwargs))
+        while not request["event"].wait(1.0):
+            if not self.workers[worker].is_alive():
+                with self.lock:
+                    self.ready_workers.discard(worker)
+                    self.pending.pop(req_id, None)
+                raise RuntimeError(f"worker {worker} 进程已退出")
+        if request["error"] is not None:
+            raise RuntimeError(f"worker {worker} 合成失败：{request['error']}")
+        return request["result"]
+
+    def synthesize(self, text: str, **kwargs):
+        return self._call("synthesize", text, **kwargs)
+
+    def synthesize_batch(self, texts, **kwargs):
+        return self._call("synthesize_batch", texts, **kwargs)
+
+    def generate_audio(self, text: str, **kwargs):
+        return self._call("generate_audio", text, **kwargs)
+
+    def memory(self):
+        """各副本 (Rss, Pss)，单位 MB；Pss 把共享页按进程数平摊，仅 Linux 可用"""
+        usage = []
+        for w in self.workers:
+            stats = {}
+            try:
+                with open(f"/proc/{w.pid}/smaps_rollup") as f:
+                    for line in f:
+                        key, _, value = line.partition(":")
+                        if key in ("Rss", "Pss"):
+                            stats[key] = int(value.split()[0]) / 1024
+            except OSError:
+                pass
+            usage.append((stats.get("Rss"), stats.get("Pss")))
+        return usage
+
+    def shutdown(self):
+        for q in self.request_queues:
+            q.put(None)
+        for w in self.workers:
+            w.join(timeout=10)
+
+
+# -------------------- 过载压测 --------------------
+def benchmark(args):
+    from concurrent.futures import ThreadPoolExecutor
+    from TTS import CosyvoiceRealTimeTTS
+
+    if args.workers > 0:
+        return pool_benchmark(args)
+    if args.matcha_model is None:
+        raise ValueError("对比兜底需要 --matcha_model")
+
+    primary = CosyvoiceRealTimeTTS(args.cosyvoice_model, args.ref_audio)
+    fallback = MatchaOnnxEngine(args.matcha_model, args.matcha_vocoder)
+    texts = [args.text] * args.num_requests
+    # 预热
+    primary.generate_audio(args.text)
+    fallback.generate_audio(args.text)
+    for name, router in [("无兜底", TTSRouter(primary, None, args.slo)), ("有兜底", TTSRouter(primary, fallback, args.slo))]:
+        def request(text):
+            start = time.time()
+            router.generate_audio(text)
+            return time.time() - start
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            cost = np.array(list(pool.map(request, texts)))
+        print(f"[{name}] 并发 {args.concurrency} 请求 {args.num_requests}：p50 {np.percentile(cost, 50):.2f}s "
+              f"p95 {np.percentile(cost, 95):.2f}s p99 {np.percentile(cost, 99):.2f}s 路由 {router.route_count}")
+
+
+def pool_benchmark(args):
+    """副本数 1..workers 的吞吐与内存，Pss 总和应近似 权重一份 + 每副本激活"""
+    from concurrent.futures import ThreadPoolExecutor
+    for n in range(1, args.workers + 1):
+        pool = CosyvoiceWorkerPool(args.cosyvoice_model, args.ref_audio, num_workers=n)
+        while len(pool.ready_workers) < n:
+            time.sleep(1)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(pool.generate_audio, [args.text] * args.num_requests))
+        cost = time.time() - start
+        usage = pool.memory()
+        rss = sum(u[0] or 0 for u in usage)
+        pss = sum(u[1] or 0 for u in usage)
+        print(f"[副本 {n}] {args.num_requests / cost:.2f} 请求/秒，Rss 总和 {rss:.0f}MB，Pss 总和 {pss:.0f}MB")
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="过载下 TTS 尾延迟压测，对比有无 Matcha 兜底；或多副本内存压测")
+    parser.add_argument("--cosyvoice_model", default=r"Model\CosyVoice2-0.5B")
+    parser.add_argument("--ref_audio", default=r"audio\zjj.wav")
+    parser.add_argument("--matcha_model", default=None, help="matcha/onnx/export.py 导出的 onnx")
+    parser.add_argument("--matcha_vocoder", default=None, help="未内嵌声码器时的 vocoder onnx")
+    parser.add_argument("--text", default="Hello, this is a short test sentence for the magic mirror.")
+    parser.add_argument("--num_requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--slo", type=float, default=2.0, help="预计排队时间上限（秒）")
+    parser.add_argument("--workers", type=int, default=0, help=">0 时改测 1..workers 个共享权重副本的吞吐与内存")
+    benchmark(parser.parse_args())